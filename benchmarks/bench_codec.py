@@ -0,0 +1,55 @@
+"""Encode and decode throughput of the installed json backends.
+
+Uses the shapes that go through the hot paths: an executor output line, a
+RUN_STATUS frame, a bulk batch of messages and a websocket delta.
+
+    python -m benchmarks.bench_codec [--seconds 0.5]
+"""
+import argparse
+import time
+
+from common.codec import available_codecs
+
+MESSAGE = {"msg": "Open port 443/tcp https on 10.0.0.12", "color": "darkgreen", "by": "nmap"}
+SHAPES = {
+    "message": MESSAGE,
+    "run_status": {
+        "action": "RUN_STATUS", "executor_name": "nmap", "run_id": "0" * 32, "successful": True,
+        "state": "finished", "message": "Executor nmap from agent-1 finished successfully",
+    },
+    "batch_500": [dict(MESSAGE, id=index) for index in range(500)],
+    "delta": {
+        "action": "delta", "reset": False, "cursor": 100500,
+        "messages": [dict(MESSAGE, id=index) for index in range(50)],
+        "agents": [{"name": f"agent-{index}", "addr": f"10.0.0.{index}:5000", "color": "grey", "decay_in": None,
+                    "executors": [{"name": "nmap", "color": "goldenrod", "decay_in": 0.4}]} for index in range(10)],
+        "removed_agents": [],
+    },
+}
+
+
+def rate(f, value, seconds: float) -> float:
+    count = 0
+    start = time.perf_counter()
+    deadline = start + seconds
+    while time.perf_counter() < deadline:
+        for _ in range(100):
+            f(value)
+        count += 100
+    return count / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--seconds", type=float, default=0.5, help="time per measurement")
+    args = parser.parse_args()
+    for shape, value in SHAPES.items():
+        print(shape)
+        for codec in available_codecs():
+            encoded = codec.dumps(value)
+            print(f"  {codec.name:>8}: encode {rate(codec.dumps, value, args.seconds):>12,.0f}/s "
+                  f"decode {rate(codec.loads, encoded, args.seconds):>12,.0f}/s")
+
+
+if __name__ == "__main__":
+    main()
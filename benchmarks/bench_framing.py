@@ -0,0 +1,59 @@
+"""Compares the framings of the agent socket protocol.
+
+Every framing encodes the same messages and decodes them back from a
+StreamReader, as the server and the dispatcher do.
+
+    python -m benchmarks.bench_framing [--messages 50000] [--payload 200]
+"""
+import argparse
+import asyncio
+import time
+
+from common.framing import available_framings, get_framer
+
+
+def build_messages(count: int, payload: int) -> list:
+    return [
+        {
+            "action": "RUN_STATUS",
+            "executor_name": "nmap",
+            "run_id": f"{index:032x}",
+            "state": "finished",
+            "message": "x" * payload,
+        }
+        for index in range(count)
+    ]
+
+
+async def decode_all(framer, data: bytes, count: int):
+    reader = asyncio.StreamReader(limit=len(data) + 1)
+    reader.feed_data(data)
+    reader.feed_eof()
+    for _ in range(count):
+        await framer.read(reader)
+
+
+def bench(name: str, messages: list):
+    framer = get_framer(name)
+    start = time.perf_counter()
+    data = b"".join(framer.encode(message) for message in messages)
+    encoded = time.perf_counter()
+    asyncio.run(decode_all(framer, data, len(messages)))
+    decoded = time.perf_counter()
+    print(f"{name:>14}: {len(data) / 1024 / 1024:8.2f} MB "
+          f"encode {len(messages) / (encoded - start):>10,.0f} msg/s "
+          f"decode {len(messages) / (decoded - encoded):>10,.0f} msg/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=50 * 1000)
+    parser.add_argument("--payload", type=int, default=200, help="size of the message field")
+    args = parser.parse_args()
+    messages = build_messages(args.messages, args.payload)
+    for name in reversed(available_framings()):
+        bench(name, messages)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""Compares the asyncio event loop and uvloop on the two hot paths.
+
+Socket frames: a client sends `--frames` OUTPUT frames through a
+FramedWriter to a server reading them with the same framer, over loopback.
+Subprocess pipe: an executor writes `--size` MB of json lines that are read
+with the LineReader of the dispatcher.
+
+    python -m benchmarks.bench_loop [--frames 200000] [--size 512] [--framing msgpack]
+"""
+import argparse
+import asyncio
+import sys
+import time
+
+from common import event_loop
+from common.framing import get_framer
+from common.writer import FramedWriter
+from dispatcher.logic.line_reader import LineReader
+
+STREAM_LIMIT = 64 * 1024
+
+EXECUTOR = """
+import sys
+line = ('{"msg": "%s", "color": "darkgreen"}\\n' % ('x' * 80)).encode()
+block = line * (1024 * 1024 // len(line))
+for _ in range(int(sys.argv[1])):
+    sys.stdout.buffer.write(block)
+"""
+
+
+async def socket_frames(framing: str, frames: int) -> float:
+    framer = get_framer(framing)
+    message = dict(action="OUTPUT", seq=1, messages=[dict(msg="x" * 80, color="darkgreen")])
+    received = asyncio.Event()
+
+    async def handle(reader, writer):
+        count = 0
+        while count < frames and await framer.read(reader) is not None:
+            count += 1
+        received.set()
+        writer.close()
+
+    server = await asyncio.start_server(handle, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+    start = time.perf_counter()
+    _, writer = await asyncio.open_connection("127.0.0.1", port)
+    sender = FramedWriter(writer, framer)
+    for _ in range(frames):
+        await sender.send(message)
+    await received.wait()
+    elapsed = time.perf_counter() - start
+    await sender.close()
+    server.close()
+    return frames / elapsed
+
+
+async def subprocess_pipe(size: int) -> float:
+    start = time.perf_counter()
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, "-c", EXECUTOR, str(size), stdout=asyncio.subprocess.PIPE, limit=STREAM_LIMIT
+    )
+    lines = LineReader(process.stdout, STREAM_LIMIT)
+    while await lines.readline() is not None:
+        pass
+    await process.wait()
+    return size / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--frames", type=int, default=200 * 1000)
+    parser.add_argument("--size", type=int, default=512, help="MB of executor output")
+    parser.add_argument("--framing", default="json-lp")
+    args = parser.parse_args()
+    for name in reversed(event_loop.available_loops()):
+        event_loop.install(name)
+        frames_per_second = asyncio.run(socket_frames(args.framing, args.frames))
+        megabytes_per_second = asyncio.run(subprocess_pipe(args.size))
+        print(f"{name:>8}: {frames_per_second:>10,.0f} {args.framing} frames/s "
+              f"{megabytes_per_second:8.1f} MB/s from the executor pipe")
+    if len(event_loop.available_loops()) == 1:
+        print("uvloop is not installed, only the asyncio loop was measured")
+
+
+if __name__ == "__main__":
+    main()
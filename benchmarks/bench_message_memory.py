@@ -0,0 +1,45 @@
+"""Memory per stored message, as dicts and as StoredMessage slots.
+
+    python -m benchmarks.bench_message_memory [--messages 100000]
+"""
+import argparse
+import tracemalloc
+
+from common import codec
+from server.message_store import StoredMessage
+
+
+def build_payloads(count: int) -> list:
+    return [codec.dumps(dict(msg=f"Open port {index % 65535}/tcp", color="darkgreen")) for index in range(count)]
+
+
+def measure(name: str, store_f, payloads: list):
+    tracemalloc.start()
+    stored = store_f(payloads)
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{name:>14}: {size / len(stored):7.1f} bytes per message")
+    return size
+
+
+def as_dicts(payloads: list) -> list:
+    # The previous representation, a (id, message, size) tuple
+    return [(message_id, codec.loads(payload), 0) for message_id, payload in enumerate(payloads, 1)]
+
+
+def as_slots(payloads: list) -> list:
+    return [StoredMessage(message_id, codec.loads(payload)) for message_id, payload in enumerate(payloads, 1)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=100 * 1000)
+    args = parser.parse_args()
+    payloads = build_payloads(args.messages)
+    dicts = measure("dict", as_dicts, payloads)
+    slots = measure("StoredMessage", as_slots, payloads)
+    print(f"{100 * (dicts - slots) / dicts:.0f}% less memory")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""Compares reading executor output line by line with the chunked LineReader.
+
+A synthetic output of `--size` MB of json lines is fed to a StreamReader in
+chunks, as the pipe of an executor would, and read with the old
+readline/decode/slice loop and with LineReader.
+
+    python -m benchmarks.bench_reader [--size 2048] [--line 120]
+"""
+import argparse
+import asyncio
+import json
+import time
+
+from dispatcher.logic.line_reader import LineReader
+
+FEED_SIZE = 1024 * 1024
+STREAM_LIMIT = 64 * 1024
+
+
+def build_block(line_size: int) -> bytes:
+    line = json.dumps(dict(msg="x" * max(line_size - 40, 1), color="darkgreen")).encode() + b'\n'
+    return line * (FEED_SIZE // len(line))
+
+
+async def feed(reader: asyncio.StreamReader, block: bytes, size: int):
+    fed = 0
+    while fed < size:
+        reader.feed_data(block)
+        fed += len(block)
+        # Let the consumer catch up, as the pipe transport would
+        while len(reader._buffer) > 2 * STREAM_LIMIT:
+            await asyncio.sleep(0)
+    reader.feed_eof()
+
+
+async def readline_loop(reader: asyncio.StreamReader) -> int:
+    count = 0
+    while True:
+        line = await reader.readline()
+        line = line.decode('utf-8')
+        if line[:-1] == "":
+            return count
+        count += 1
+
+
+async def line_reader_loop(reader: asyncio.StreamReader) -> int:
+    lines = LineReader(reader, STREAM_LIMIT)
+    count = 0
+    while await lines.readline() is not None:
+        count += 1
+    return count
+
+
+async def bench(name: str, read_f, block: bytes, size: int):
+    reader = asyncio.StreamReader(limit=STREAM_LIMIT)
+    start = time.perf_counter()
+    count, _ = await asyncio.gather(read_f(reader), feed(reader, block, size))
+    elapsed = time.perf_counter() - start
+    print(f"{name:>12}: {size / 1024 / 1024 / elapsed:8.1f} MB/s {count / elapsed:>12,.0f} lines/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", type=int, default=2048, help="MB of output")
+    parser.add_argument("--line", type=int, default=120, help="bytes per line")
+    args = parser.parse_args()
+    block = build_block(args.line)
+    size = args.size * 1024 * 1024
+    asyncio.run(bench("readline", readline_loop, block, size))
+    asyncio.run(bench("LineReader", line_reader_loop, block, size))
+
+
+if __name__ == "__main__":
+    main()
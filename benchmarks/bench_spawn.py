@@ -0,0 +1,58 @@
+"""Compares starting executors through /bin/sh and with exec.
+
+Launches the same command many times, `--concurrency` at a time, with
+create_subprocess_shell and create_subprocess_exec, and reports the spawn
+latency (until the process is created) and the throughput of whole runs.
+
+    python -m benchmarks.bench_spawn [--runs 500] [--concurrency 20] [--cmd "true"]
+"""
+import argparse
+import asyncio
+import shlex
+import statistics
+import time
+
+
+async def run_one(cmd: str, shell: bool, latencies: list):
+    start = time.perf_counter()
+    if shell:
+        process = await asyncio.create_subprocess_shell(
+            cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+        )
+    else:
+        process = await asyncio.create_subprocess_exec(
+            *shlex.split(cmd), stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+        )
+    latencies.append(time.perf_counter() - start)
+    await process.communicate()
+
+
+async def bench(cmd: str, shell: bool, runs: int, concurrency: int):
+    slots = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def limited():
+        async with slots:
+            await run_one(cmd, shell, latencies)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(limited() for _ in range(runs)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    print(f"{'shell' if shell else 'exec':>6}: {runs / elapsed:8.1f} runs/s "
+          f"spawn p50 {statistics.median(latencies) * 1000:7.2f} ms "
+          f"p99 {latencies[int(0.99 * (len(latencies) - 1))] * 1000:7.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--cmd", default="true")
+    args = parser.parse_args()
+    for shell in (True, False):
+        asyncio.run(bench(args.cmd, shell, args.runs, args.concurrency))
+
+
+if __name__ == "__main__":
+    main()
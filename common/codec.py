@@ -0,0 +1,78 @@
+"""Json codec shared by the dispatcher and the server.
+
+The fastest installed backend among orjson, msgspec and ujson is used, the
+stdlib json otherwise. `dumps` returns bytes and `loads` accepts bytes, so
+payloads read from sockets and pipes are parsed without decoding them first.
+The CODEC_BACKEND environment variable forces a backend."""
+import json
+import os
+from typing import Callable, List, NamedTuple, Union
+
+BACKENDS = ("orjson", "msgspec", "ujson", "json")
+
+
+class Codec(NamedTuple):
+    name: str
+    dumps: Callable[[object], bytes]
+    loads: Callable[[Union[bytes, str]], object]
+
+
+def _orjson() -> Codec:
+    import orjson
+    return Codec("orjson", orjson.dumps, orjson.loads)
+
+
+def _msgspec() -> Codec:
+    import msgspec
+    encoder, decoder = msgspec.json.Encoder(), msgspec.json.Decoder()
+    return Codec("msgspec", encoder.encode, decoder.decode)
+
+
+def _ujson() -> Codec:
+    import ujson
+    return Codec("ujson", lambda obj: ujson.dumps(obj, ensure_ascii=False).encode(), ujson.loads)
+
+
+def _json() -> Codec:
+    return Codec("json", lambda obj: json.dumps(obj).encode(), json.loads)
+
+
+_FACTORIES = {"orjson": _orjson, "msgspec": _msgspec, "ujson": _ujson, "json": _json}
+
+
+def get_codec(name: str) -> Codec:
+    """Raises ImportError when the backend is not installed"""
+    if name not in _FACTORIES:
+        raise ValueError(f"Unknown json backend {name}")
+    return _FACTORIES[name]()
+
+
+def available_codecs() -> List[Codec]:
+    codecs = []
+    for name in BACKENDS:
+        try:
+            codecs.append(get_codec(name))
+        except ImportError:
+            pass
+    return codecs
+
+
+def _select() -> Codec:
+    forced = os.environ.get("CODEC_BACKEND")
+    if forced:
+        return get_codec(forced)
+    return available_codecs()[0]
+
+
+codec = _select()
+BACKEND = codec.name
+dumps = codec.dumps
+loads = codec.loads
+
+# Every backend raises a subclass of ValueError for invalid json
+DecodeError = ValueError
+
+
+def dumps_str(obj) -> str:
+    """For the APIs that need a str, like the aiohttp json helpers"""
+    return dumps(obj).decode()
@@ -0,0 +1,36 @@
+"""Event loop selection shared by the dispatcher and the server.
+
+"auto" uses uvloop when it is installed and the asyncio loop otherwise;
+"uvloop" and "asyncio" force one of them. The EVENT_LOOP environment
+variable overrides the name given by the command line or the config."""
+import asyncio
+import os
+from typing import List
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+LOOPS = ("auto", "uvloop", "asyncio")
+
+
+def available_loops() -> List[str]:
+    return ["uvloop", "asyncio"] if uvloop is not None else ["asyncio"]
+
+
+def install(name: str = None) -> str:
+    """Sets the event loop policy, before any loop is created. Returns the
+    loop used, and raises ValueError if it is not installed"""
+    name = os.environ.get("EVENT_LOOP") or name or "auto"
+    if name not in LOOPS:
+        raise ValueError(f"Unknown event loop {name}, expected one of {', '.join(LOOPS)}")
+    if name == "auto":
+        name = available_loops()[0]
+    if name == "uvloop":
+        if uvloop is None:
+            raise ValueError("The uvloop event loop is not installed")
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    else:
+        asyncio.set_event_loop_policy(asyncio.DefaultEventLoopPolicy())
+    return name
@@ -0,0 +1,169 @@
+"""Framing of the messages sent between the dispatcher and the server.
+
+The connection always starts with newline delimited json. The dispatcher
+offers the framings it supports in the JOIN message, and the server answers
+with a JOIN_ACK naming the one chosen, written with the line framing. After
+the JOIN_ACK both ends use the chosen framing.
+
+A framing name is the payload codec, optionally followed by "+" and the
+compression used for big frames, e.g. "msgpack+zlib" or "json-lp"."""
+import struct
+import zlib
+from asyncio import IncompleteReadError, StreamReader
+from typing import List, Optional
+
+from common import codec
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+LINES = "json"
+DEFAULT_MAX_FRAME_SIZE = 64 * 1024 * 1024   # 64 MB
+COMPRESSION_THRESHOLD = 4 * 1024            # Smaller frames are not compressed
+
+
+class FramingError(ValueError):
+    pass
+
+
+class Framer:
+    name = None
+
+    def encode(self, message: dict) -> bytes:
+        raise NotImplementedError("Must be implemented")
+
+    async def read(self, reader: StreamReader) -> Optional[dict]:
+        """Returns the next message, or None when the connection is closed"""
+        raise NotImplementedError("Must be implemented")
+
+
+class LineFramer(Framer):
+    name = LINES
+
+    def encode(self, message: dict) -> bytes:
+        return codec.dumps(message) + b'\n'
+
+    async def read(self, reader: StreamReader) -> Optional[dict]:
+        data = await reader.readline()
+        return codec.loads(data) if len(data) > 0 else None
+
+
+class LengthPrefixedFramer(Framer):
+    """Frames with a header holding the payload length and its flags"""
+
+    HEADER = struct.Struct('>IB')
+    FLAG_COMPRESSED = 1
+
+    def __init__(self, name: str, dumps, loads, compressor=None, decompressor=None,
+                 max_frame_size: int = DEFAULT_MAX_FRAME_SIZE):
+        self.name = name
+        self.dumps = dumps
+        self.loads = loads
+        self.compressor = compressor
+        self.decompressor = decompressor
+        self.max_frame_size = max_frame_size
+
+    def encode(self, message: dict) -> bytes:
+        payload = self.dumps(message)
+        flags = 0
+        if self.compressor is not None and len(payload) > COMPRESSION_THRESHOLD:
+            payload = self.compressor(payload)
+            flags |= self.FLAG_COMPRESSED
+        if len(payload) > self.max_frame_size:
+            raise FramingError(f"Frame of {len(payload)} bytes exceeds the max frame size")
+        return self.HEADER.pack(len(payload), flags) + payload
+
+    async def read(self, reader: StreamReader) -> Optional[dict]:
+        try:
+            length, flags = self.HEADER.unpack(await reader.readexactly(self.HEADER.size))
+        except IncompleteReadError as e:
+            if e.partial:
+                raise FramingError("Connection closed in the middle of a frame header")
+            return None
+        if length > self.max_frame_size:
+            raise FramingError(f"Frame of {length} bytes exceeds the max frame size")
+        payload = await reader.readexactly(length)
+        if flags & self.FLAG_COMPRESSED:
+            # Bounded, a small frame can expand to gigabytes
+            payload = self.decompressor(payload, self.max_frame_size)
+        return self.loads(payload)
+
+
+def _zlib_decompress(payload: bytes, max_size: int) -> bytes:
+    decompressor = zlib.decompressobj()
+    try:
+        data = decompressor.decompress(payload, max_size)
+    except zlib.error as e:
+        raise FramingError(f"Invalid compressed frame: {e}")
+    if decompressor.unconsumed_tail:
+        raise FramingError(f"Decompressed frame exceeds the max frame size of {max_size} bytes")
+    if not decompressor.eof:
+        raise FramingError("Truncated compressed frame")
+    return data
+
+
+def _zstd_decompress(payload: bytes, max_size: int) -> bytes:
+    data = bytearray()
+    try:
+        with zstandard.ZstdDecompressor().stream_reader(payload) as reader:
+            while len(data) <= max_size:
+                chunk = reader.read(max_size + 1 - len(data))
+                if not chunk:
+                    break
+                data += chunk
+    except zstandard.ZstdError as e:
+        raise FramingError(f"Invalid compressed frame: {e}")
+    if len(data) > max_size:
+        raise FramingError(f"Decompressed frame exceeds the max frame size of {max_size} bytes")
+    return bytes(data)
+
+
+def _codecs() -> dict:
+    codecs = {"json-lp": (codec.dumps, codec.loads)}
+    if msgpack is not None:
+        codecs["msgpack"] = (msgpack.packb, lambda payload: msgpack.unpackb(payload, raw=False))
+    return codecs
+
+
+def _compressions() -> dict:
+    compressions = {"zlib": (lambda payload: zlib.compress(payload, 1), _zlib_decompress)}
+    if zstandard is not None:
+        compressions["zstd"] = (zstandard.ZstdCompressor().compress, _zstd_decompress)
+    return compressions
+
+
+def available_framings() -> List[str]:
+    """The framings supported in this environment, preferred first"""
+    framings = []
+    for codec_name in reversed(list(_codecs())):
+        framings.extend(f"{codec_name}+{compression}" for compression in reversed(list(_compressions())))
+        framings.append(codec_name)
+    return framings + [LINES]
+
+
+def get_framer(name: str, max_frame_size: int = DEFAULT_MAX_FRAME_SIZE) -> Framer:
+    if name == LINES:
+        return LineFramer()
+    codec_name, _, compression = name.partition("+")
+    codecs, compressions = _codecs(), _compressions()
+    if codec_name not in codecs or (compression and compression not in compressions):
+        raise FramingError(f"Unsupported framing {name}")
+    dumps, loads = codecs[codec_name]
+    compressor, decompressor = compressions[compression] if compression else (None, None)
+    return LengthPrefixedFramer(name, dumps, loads, compressor, decompressor, max_frame_size)
+
+
+def negotiate(offered: List[str]) -> str:
+    """The first offered framing supported here, the line framing otherwise"""
+    available = available_framings()
+    for name in offered:
+        if name in available:
+            return name
+    return LINES
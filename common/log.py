@@ -0,0 +1,138 @@
+"""Logging pipeline shared by the dispatcher and the server.
+
+Loggers only put their records in a queue. A QueueListener thread formats
+them and writes them to the console and to the log file, so a slow terminal
+or disk never blocks the event loop. Hot paths log through child loggers
+with a RateLimitFilter or a SampleFilter, which drop records before they are
+queued."""
+import atexit
+import logging
+import os
+import queue
+import time
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from pathlib import Path
+from typing import Dict, List, Optional
+
+FORMAT = (
+    '%(asctime)s - %(name)s - %(levelname)s {%(threadName)s} [%(filename)s:%(lineno)s - %(funcName)s()]  '
+    '%(message)s'
+)
+
+LEVELS = ("DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL")
+
+# The running listeners and the logger each one serves
+_pipelines: Dict[QueueListener, logging.Logger] = {}
+
+
+def parse_level(name: str) -> int:
+    if name.upper() not in LEVELS:
+        raise ValueError(f"Unknown log level {name}, expected one of {', '.join(LEVELS)}")
+    return getattr(logging, name.upper())
+
+
+class LazyQueueHandler(QueueHandler):
+    """Only merges the message with its args in the thread logging it, so a
+    mutable argument is logged as it was. The formatter runs in the listener
+    thread."""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+class RateLimitFilter(logging.Filter):
+    """Lets through `rate` records per second, in bursts of up to `burst`.
+    The first record let through after dropping some tells how many."""
+
+    def __init__(self, rate: float, burst: int = None):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst or max(int(rate), 1)
+        self.dropped = 0
+        self.__tokens = float(self.burst)
+        self.__last = time.monotonic()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        now = time.monotonic()
+        self.__tokens = min(self.burst, self.__tokens + (now - self.__last) * self.rate)
+        self.__last = now
+        if self.__tokens < 1:
+            self.dropped += 1
+            return False
+        self.__tokens -= 1
+        if self.dropped:
+            record.msg = f"[{self.dropped} records dropped] " + str(record.msg)
+            self.dropped = 0
+        return True
+
+
+class SampleFilter(logging.Filter):
+    """Lets through one of every `every` records"""
+
+    def __init__(self, every: int):
+        super().__init__()
+        self.every = max(every, 1)
+        self.__count = 0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        self.__count += 1
+        return self.__count % self.every == 1 or self.every == 1
+
+
+def set_filter(logger: logging.Logger, log_filter: Optional[logging.Filter]):
+    """Replaces the rate limit or sample filter of the logger, None removes it"""
+    for existing in list(logger.filters):
+        if isinstance(existing, (RateLimitFilter, SampleFilter)):
+            logger.removeFilter(existing)
+    if log_filter is not None:
+        logger.addFilter(log_filter)
+
+
+def rotating_file_handler(path: Path, max_bytes: int, backup_count: int) -> RotatingFileHandler:
+    path = Path(path).expanduser()
+    path.parent.mkdir(parents=True, exist_ok=True)
+    return RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count)
+
+
+def start_listener(logger: logging.Logger, handlers: List[logging.Handler]) -> QueueListener:
+    """Replaces the handlers of the logger by a queue, the returned listener
+    thread runs the given handlers"""
+    records = queue.SimpleQueue()
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    logger.addHandler(LazyQueueHandler(records))
+    listener = QueueListener(records, *handlers, respect_handler_level=True)
+    listener.start()
+    _pipelines[listener] = logger
+    return listener
+
+
+def stop_listener(listener: QueueListener):
+    """Writes the records still queued and stops the thread"""
+    if _pipelines.pop(listener, None) is not None:
+        listener.stop()
+
+
+def stop_logger_listeners(logger: logging.Logger):
+    """Stops the listeners of the logger, also the ones restarted after a fork"""
+    for listener, served in list(_pipelines.items()):
+        if served is logger:
+            stop_listener(listener)
+
+
+@atexit.register
+def _stop_listeners():
+    for listener in list(_pipelines):
+        stop_listener(listener)
+
+
+def _restart_listeners():
+    # A forked process has no listener threads, like the server workers
+    for listener, logger in list(_pipelines.items()):
+        del _pipelines[listener]
+        start_listener(logger, list(listener.handlers))
+
+
+os.register_at_fork(after_in_child=_restart_listeners)
@@ -0,0 +1,222 @@
+"""Metrics of the dispatcher and the server, in the Prometheus text format.
+
+Metrics are updated from the event loop thread only, so an update is a
+plain attribute change, without locks. Hot paths keep a reference to the
+child of their labels instead of looking it up on each update. Gauges of
+values the code already keeps, like queue depths, are read with a function
+when the metrics are exposed."""
+import bisect
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Seconds, from a fast message post to a long executor run
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+LabelValues = Tuple[str, ...]
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = None,
+                   constant: Dict[str, str] = None) -> str:
+    pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+    if constant:
+        pairs.extend(f'{name}="{_escape(str(value))}"' for name, value in constant.items())
+    if extra is not None:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    type = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.__children: Dict[LabelValues, "Metric"] = {}
+
+    def labels(self, *values) -> "Metric":
+        """The child of the given label values, created on first use"""
+        if len(values) != len(self.labelnames):
+            raise ValueError(f"{self.name} expects the labels {', '.join(self.labelnames)}")
+        key = tuple(str(value) for value in values)
+        child = self.__children.get(key)
+        if child is None:
+            child = self.__children[key] = self._new_child()
+        return child
+
+    def _new_child(self) -> "Metric":
+        raise NotImplementedError("Must be implemented")
+
+    def samples(self) -> Iterator[Tuple[str, LabelValues, str, float]]:
+        """(suffix, label values, extra label, value) of every sample"""
+        if self.labelnames:
+            for values, child in list(self.__children.items()):
+                for suffix, _, extra, value in child.samples():
+                    yield suffix, values, extra, value
+        else:
+            yield from self._own_samples()
+
+    def _own_samples(self) -> Iterator[Tuple[str, LabelValues, str, float]]:
+        raise NotImplementedError("Must be implemented")
+
+    @property
+    def exposed_name(self) -> str:
+        return self.name
+
+    def expose(self, constant_labels: Dict[str, str] = None) -> List[str]:
+        name = self.exposed_name
+        lines = [f"# HELP {name} {self.documentation}", f"# TYPE {name} {self.type}"]
+        for suffix, values, extra, value in self.samples():
+            labels = _format_labels(self.labelnames, values, extra, constant_labels)
+            lines.append(f"{name}{suffix}{labels} {_format_value(value)}")
+        return lines
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self.value = 0
+
+    def _new_child(self) -> "Counter":
+        return Counter(self.name, self.documentation)
+
+    @property
+    def exposed_name(self) -> str:
+        # The 0.0.4 text format has no suffixes for counters, the name of the
+        # family is the name of its samples
+        return f"{self.name}_total"
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+    def _own_samples(self):
+        yield "", (), None, self.value
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self.value = 0
+        self.__function: Optional[Callable[[], float]] = None
+
+    def _new_child(self) -> "Gauge":
+        return Gauge(self.name, self.documentation)
+
+    def set(self, value: float):
+        self.value = value
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+    def dec(self, amount: float = 1):
+        self.value -= amount
+
+    def set_function(self, function: Callable[[], float]):
+        """The value is read from `function` when the metrics are exposed"""
+        self.__function = function
+
+    def _own_samples(self):
+        yield "", (), None, self.__function() if self.__function is not None else self.value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # One count per bucket, not cumulative, plus the +Inf one
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+
+    def _new_child(self) -> "Histogram":
+        return Histogram(self.name, self.documentation, buckets=self.buckets)
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    @contextmanager
+    def time(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def _own_samples(self):
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            cumulative += count
+            yield "_bucket", (), f'le="{_format_value(bound)}"', cumulative
+        yield "_sum", (), None, self.sum
+        yield "_count", (), None, cumulative
+
+
+class Registry:
+
+    def __init__(self):
+        self.metrics: Dict[str, Metric] = {}
+
+    def __register(self, metric: Metric) -> Metric:
+        if metric.name in self.metrics:
+            raise ValueError(f"The metric {metric.name} is already registered")
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self.__register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self.__register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self.__register(Histogram(name, documentation, labelnames, buckets))
+
+    def expose(self, constant_labels: Dict[str, str] = None) -> bytes:
+        """The metrics in the text format, `constant_labels` are added to
+        every sample"""
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.expose(constant_labels))
+        return ("\n".join(lines) + "\n").encode()
+
+
+def merge_expositions(expositions: List[bytes]) -> bytes:
+    """Merges the metrics of processes with the same registry, the samples of
+    every family are put together under its HELP and TYPE lines"""
+    families: Dict[str, Tuple[List[str], List[str]]] = {}
+    for exposition in expositions:
+        family = None
+        for line in exposition.decode().splitlines():
+            if line.startswith("# HELP ") or line.startswith("# TYPE "):
+                family = line.split(" ", 3)[2]
+                headers, _ = families.setdefault(family, ([], []))
+                if line not in headers:
+                    headers.append(line)
+            elif line and family is not None:
+                families[family][1].append(line)
+    lines = [line for headers, samples in families.values() for line in headers + samples]
+    return ("\n".join(lines) + "\n").encode()
+
+
+REGISTRY = Registry()
@@ -0,0 +1,51 @@
+"""Declarative schemas of the messages produced by the executors.
+
+A Schema lists the required and optional keys with their types, and is
+compiled once into a validator closure. The validators return None for a
+valid message or the reason it is invalid, so both ends can report it."""
+from typing import Callable, Dict, Optional, Tuple, Type, Union
+
+Types = Union[Type, Tuple[Type, ...]]
+
+
+class Schema:
+
+    def __init__(self, name: str, required: Dict[str, Types], optional: Dict[str, Types] = None,
+                 allow_extra: bool = True):
+        self.name = name
+        self.required = required
+        self.optional = optional or {}
+        self.allow_extra = allow_extra
+        self.validate = self.__compile()
+
+    def __compile(self) -> Callable[[object], Optional[str]]:
+        required = tuple(self.required.items())
+        optional = tuple(self.optional.items())
+        known = frozenset(self.required) | frozenset(self.optional)
+        allow_extra = self.allow_extra
+        name = self.name
+
+        def validate(message) -> Optional[str]:
+            if type(message) is not dict:
+                return f"{name} must be a json object"
+            for key, types in required:
+                value = message.get(key)
+                if value is None:
+                    return f"{name} requires the {key} key"
+                if not isinstance(value, types):
+                    return f"{key} of {name} has an invalid type"
+            for key, types in optional:
+                value = message.get(key)
+                if value is not None and not isinstance(value, types):
+                    return f"{key} of {name} has an invalid type"
+            if not allow_extra and not known.issuperset(message):
+                return f"{name} has unknown keys: {', '.join(sorted(set(message) - known))}"
+            return None
+
+        return validate
+
+
+OUTPUT_MESSAGE = Schema(
+    "output message",
+    required={"msg": str, "color": str},
+)
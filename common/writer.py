@@ -0,0 +1,100 @@
+"""Write side of the agent socket shared by the server and the dispatcher.
+
+Frames are encoded when queued and written by a single flusher task, which
+joins everything queued since its last write in one transport write before
+awaiting drain. Producers that can wait use `send`, which blocks while the
+queued and unsent bytes are above the high watermark, until they get below
+the low watermark."""
+import asyncio
+import logging
+from asyncio import StreamWriter
+from typing import List, Optional
+
+from common.framing import Framer
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_HIGH_WATER = 1024 * 1024    # 1 MB
+DEFAULT_LOW_WATER = 256 * 1024      # 256 KB
+
+
+class FramedWriter:
+
+    def __init__(self, writer: StreamWriter, framer: Framer,
+                 high_water: int = DEFAULT_HIGH_WATER, low_water: int = DEFAULT_LOW_WATER):
+        if low_water > high_water:
+            raise ValueError("The low watermark can't be greater than the high watermark")
+        self.writer = writer
+        self.framer = framer
+        self.high_water = high_water
+        self.low_water = low_water
+        self.__chunks: List[bytes] = []
+        self.__queued_bytes = 0
+        self.__pending = asyncio.Event()
+        self.__writable = asyncio.Event()
+        self.__writable.set()
+        self.__flusher: Optional[asyncio.Task] = None
+        self.error: Optional[Exception] = None
+        self.closed = False
+
+    @property
+    def depth(self) -> int:
+        """Bytes queued here plus the ones still in the transport buffer"""
+        transport = self.writer.transport
+        buffered = transport.get_write_buffer_size() if not transport.is_closing() else 0
+        return self.__queued_bytes + buffered
+
+    def write(self, message: dict):
+        """Queues a frame without waiting, for the small control messages"""
+        if self.closed:
+            logger.debug("Dropping %s, the connection is closed", message.get("action"))
+            return
+        frame = self.framer.encode(message)
+        self.__chunks.append(frame)
+        self.__queued_bytes += len(frame)
+        if self.__flusher is None:
+            self.__flusher = asyncio.ensure_future(self.__flush_loop())
+        self.__pending.set()
+        if self.__writable.is_set() and self.depth >= self.high_water:
+            logger.debug("Write buffer reached %d bytes, pausing producers", self.depth)
+            self.__writable.clear()
+
+    async def wait_writable(self):
+        await self.__writable.wait()
+
+    async def send(self, message: dict):
+        await self.wait_writable()
+        self.write(message)
+
+    async def __flush_loop(self):
+        try:
+            while True:
+                if not self.__chunks:
+                    if self.closed:
+                        return
+                    # Everything was handed to the transport and drained
+                    self.__writable.set()
+                    await self.__pending.wait()
+                    self.__pending.clear()
+                    continue
+                chunks, self.__chunks = self.__chunks, []
+                self.__queued_bytes = 0
+                self.writer.write(b"".join(chunks))
+                await self.writer.drain()
+                if not self.__writable.is_set() and self.depth <= self.low_water:
+                    self.__writable.set()
+        except (ConnectionError, asyncio.IncompleteReadError) as e:
+            logger.debug("Error writing to the socket: %s", e)
+            self.error = e
+            self.closed = True
+            self.__chunks = []
+            self.__queued_bytes = 0
+            # Producers are released, their frames are dropped from now on
+            self.__writable.set()
+
+    async def close(self):
+        """Writes the queued frames and stops the flusher"""
+        self.closed = True
+        if self.__flusher is not None:
+            self.__pending.set()
+            await self.__flusher
@@ -26,9 +26,12 @@ import click
 from aiohttp import ClientSession
 from pathlib import Path
 
-from dispatcher.config import DispatcherGlobals, reset_config
+from common import event_loop
+from common.log import parse_level
+from dispatcher.config import DispatcherGlobals, Sections, instance as config, reset_config
 from dispatcher.logic.dispatcher import Dispatcher
-from dispatcher.utils.logger import get_logger
+from dispatcher.logic.metrics import start_metrics_server
+from dispatcher.utils.logger import get_logger, setup_hot_path_logging, setup_logging
 from dispatcher.utils.text_utils import Colors
 
 logger = get_logger()
@@ -54,8 +57,6 @@ def process_config_file(config_filepath: Path):
 
 async def main(config_file):
 
-    config_file = process_config_file(config_file)
-
     async with ClientSession(raise_for_status=True) as session:
         try:
             dispatcher = Dispatcher(session, config_file)
@@ -65,17 +66,37 @@ async def main(config_file):
             print(f'Try checking your config file located at {Colors.BOLD}'
                   f'{DispatcherGlobals.CONFIG_FILENAME}{Colors.ENDC}')
             return 1
-        loop = asyncio.get_event_loop()
-        await dispatcher.connect(loop)
-        loop.close()
+        metrics_runner = None
+        if dispatcher.metrics_port is not None:
+            metrics_runner = await start_metrics_server(dispatcher.metrics_port)
+        try:
+            await dispatcher.connect()
+        finally:
+            if metrics_runner is not None:
+                await metrics_runner.cleanup()
 
     return 0
 
 
 @click.command(help="dispatcher")
 @click.option("-c", "--config-file", default=None, help="Path to config ini file")
-def run(config_file):
+@click.option("--loop", type=click.Choice(event_loop.LOOPS), default=None,
+              help="Event loop, overrides the event_loop of the agent section")
+def run(config_file, loop):
     logger = get_logger()
+    config_file = process_config_file(config_file)
+    agent_config = config[Sections.AGENT] if config.has_section(Sections.AGENT) else {}
+    try:
+        level = agent_config.get("log_level")
+        setup_logging(parse_level(level) if level else None, agent_config.get("log_file"))
+        setup_hot_path_logging(
+            float(agent_config.get("log_rate_limit", DispatcherGlobals.LOG_RATE_LIMIT)),
+            int(agent_config.get("log_output_sample", DispatcherGlobals.LOG_OUTPUT_SAMPLE)),
+        )
+        logger.info("Using the %s event loop", event_loop.install(loop or agent_config.get("event_loop")))
+    except ValueError as ex:
+        print(f'{Colors.FAIL}Error configuring dispatcher: {Colors.BOLD}{str(ex)}{Colors.ENDC}')
+        sys.exit(1)
     try:
         exit_code = asyncio.run(main(config_file))
     except KeyboardInterrupt:
@@ -17,10 +17,18 @@ from dispatcher.utils.control_values_utils import (
     control_str,
     control_host,
     control_list,
+    control_labels,
+    control_framing,
+    control_choice,
+    control_float,
+    control_str_nullable,
 )
 
 import logging
 import configparser
+
+from common.event_loop import LOOPS
+from common.log import LEVELS
 from pathlib import Path
 from configparser import DuplicateSectionError
 
@@ -32,9 +40,14 @@ class DispatcherGlobals:
     CONFIG_PATH = DISPATCHER_PATH / 'config'
     CONFIG_FILENAME = CONFIG_PATH / 'dispatcher.ini'
 
+    ARTIFACTS_PATH = DISPATCHER_PATH / 'artifacts'
+    SPOOL_PATH = DISPATCHER_PATH / 'spool'
+
     DEFAULT_EXECUTOR_VERIFY_NAME = "unnamed_executor"
 
     LOGGING_LEVEL = logging.DEBUG
+    LOG_RATE_LIMIT = 100    # records per second of the frames logger
+    LOG_OUTPUT_SAMPLE = 100     # one of every N records of the executor output logger
 
 
 instance = configparser.ConfigParser()
@@ -51,6 +64,11 @@ def reset_config(filepath: Path):
         raise ValueError(f'The config in {filepath} contains duplicated sections', True)
 
 
+def parse_labels(value: str) -> dict:
+    labels = [label.split("=", 1) for label in value.split(",") if label.strip()]
+    return {key.strip(): label_value.strip() for key, label_value in labels}
+
+
 def check_filepath(filepath: str = None):
     if filepath is None:
         raise ValueError("Filepath needed to save")
@@ -120,10 +138,25 @@ __control_dict = {
         Sections.SERVER: {
             "host": control_host,
             "port": control_int(),
+            "agents_port": control_int(True),
+            "framing": control_framing,
+            "output_transport": control_choice(["http", "socket"], nullable=True),
+            "output_window": control_int(True),
         },
         Sections.AGENT: {
             "agent_name": control_str,
-            "executors": control_list(can_repeat=False)
+            "executors": control_list(can_repeat=False),
+            "max_concurrent_jobs": control_int(True),
+            "max_pending_jobs": control_int(True),
+            "shutdown_timeout": control_int(True),
+            "max_artifacts": control_int(True),
+            "labels": control_labels,
+            "event_loop": control_choice(list(LOOPS), nullable=True),
+            "log_level": control_choice(list(LEVELS), nullable=True),
+            "log_file": control_str_nullable,
+            "log_rate_limit": control_float(True),
+            "log_output_sample": control_int(True),
+            "metrics_port": control_int(True),
         },
     }
 
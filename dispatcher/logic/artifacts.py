@@ -0,0 +1,169 @@
+# Copyright (C) 2019  Infobyte LLC (http://www.infobytesec.com/)
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+import fcntl
+import hashlib
+import os
+import re
+import shutil
+from pathlib import Path
+from typing import Dict, List
+
+import dispatcher.utils.logger as logging
+from dispatcher.models.executor import Executor
+
+logger = logging.get_logger()
+
+ENV_VARIABLE = re.compile(r"\$(\w+)|\$\{(\w+)\}")
+
+
+class BuildError(Exception):
+    pass
+
+
+def expand_env(value: str, env: Dict[str, str]) -> str:
+    return ENV_VARIABLE.sub(lambda match: env.get(match.group(1) or match.group(2), match.group(0)), value)
+
+
+class ArtifactCache:
+    """Artifacts of the executor build phase, keyed by the hash of the build
+    cmd and the content of its sources. Every artifact lives in its own
+    directory of `path`; the build is locked with an asyncio lock between the
+    runs of this dispatcher and with flock between dispatchers. Using an
+    artifact touches its directory, so the least recently used are evicted
+    when there are more than `max_artifacts`."""
+
+    def __init__(self, path: Path, max_artifacts: int):
+        self.path = Path(path)
+        self.max_artifacts = max_artifacts
+        self.__locks: Dict[str, asyncio.Lock] = {}
+
+    @staticmethod
+    def sources(executor: Executor, env: Dict[str, str]) -> List[Path]:
+        """The build sources as absolute paths, the build runs in another
+        directory"""
+        return [Path(expand_env(source, env)).expanduser().resolve() for source in executor.build_source]
+
+    def key(self, executor: Executor, env: Dict[str, str]) -> str:
+        digest = hashlib.sha256(executor.build_cmd.encode())
+        for source_path in self.sources(executor, env):
+            try:
+                with open(source_path, 'rb') as source_file:
+                    digest.update(source_path.name.encode())
+                    for chunk in iter(lambda: source_file.read(1024 * 1024), b''):
+                        digest.update(chunk)
+            except OSError as e:
+                raise BuildError(f"Can't read build source {source_path}: {e}")
+        return digest.hexdigest()
+
+    async def get(self, executor: Executor, env: Dict[str, str]) -> Path:
+        """The artifact of the executor, built if its sources changed"""
+        key = self.key(executor, env)
+        artifact_dir = self.path / key
+        artifact = artifact_dir / "artifact"
+        lock = self.__locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            if not artifact.exists():
+                self.path.mkdir(parents=True, exist_ok=True)
+                lock_file = await self.__lock(key)
+                try:
+                    # Another dispatcher may have built it while waiting
+                    if not artifact.exists():
+                        await self.__build(executor, env, artifact_dir)
+                finally:
+                    lock_file.close()
+            os.utime(artifact_dir)
+        self.evict()
+        return artifact
+
+    async def __lock(self, key: str):
+        """The flock'ed lock file of the key. evict() deletes lock files, so
+        the lock is taken again when the file was replaced while waiting"""
+        lock_path = self.path / f"{key}.lock"
+        loop = asyncio.get_event_loop()
+        while True:
+            lock_file = open(lock_path, 'a')
+            try:
+                await loop.run_in_executor(None, fcntl.flock, lock_file, fcntl.LOCK_EX)
+                if os.stat(lock_path).st_ino == os.fstat(lock_file.fileno()).st_ino:
+                    return lock_file
+            except FileNotFoundError:
+                pass
+            except BaseException:
+                lock_file.close()
+                raise
+            lock_file.close()
+
+    async def __build(self, executor: Executor, env: Dict[str, str], artifact_dir: Path):
+        building_dir = artifact_dir.with_name(f"{artifact_dir.name}.building")
+        shutil.rmtree(building_dir, ignore_errors=True)
+        building_dir.mkdir()
+        build_env = {
+            **env,
+            "BUILD_SOURCE": " ".join(str(source) for source in self.sources(executor, env)),
+            "BUILD_ARTIFACT": str(building_dir / "artifact"),
+        }
+        logger.info("Building %s executor", executor.name)
+        process = await asyncio.create_subprocess_shell(
+            executor.build_cmd,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            env=build_env,
+            cwd=building_dir,
+        )
+        try:
+            _, stderr = await process.communicate()
+        except asyncio.CancelledError:
+            # The run was cancelled, the build is not left running
+            if process.returncode is None:
+                process.kill()
+            await process.wait()
+            shutil.rmtree(building_dir, ignore_errors=True)
+            raise
+        if process.returncode != 0 or not (building_dir / "artifact").exists():
+            shutil.rmtree(building_dir, ignore_errors=True)
+            logger.error("Build of %s executor failed: %s", executor.name, stderr.decode(errors='replace'))
+            raise BuildError(f"Build of {executor.name} executor failed")
+        try:
+            # Left by a build interrupted or an eviction, it has no artifact
+            shutil.rmtree(artifact_dir, ignore_errors=True)
+            # The rename is atomic, so a half built artifact is never used
+            os.rename(building_dir, artifact_dir)
+        except OSError as e:
+            shutil.rmtree(building_dir, ignore_errors=True)
+            raise BuildError(f"Can't store the artifact of {executor.name} executor: {e}")
+
+    def evict(self):
+        artifact_dirs = [
+            artifact_dir for artifact_dir in self.path.iterdir()
+            if artifact_dir.is_dir() and not artifact_dir.name.endswith(".building")
+        ]
+        if len(artifact_dirs) <= self.max_artifacts:
+            return
+        artifact_dirs.sort(key=lambda artifact_dir: artifact_dir.stat().st_mtime)
+        for artifact_dir in artifact_dirs[:len(artifact_dirs) - self.max_artifacts]:
+            lock_path = self.path / f"{artifact_dir.name}.lock"
+            with open(lock_path, 'a') as lock_file:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    # Being built by another dispatcher, it is evicted later
+                    continue
+                logger.info("Evicting artifact %s", artifact_dir.name)
+                shutil.rmtree(artifact_dir, ignore_errors=True)
+                # Unlinked while locked, a dispatcher waiting for the old file
+                # sees it was replaced and locks the new one
+                lock_path.unlink()
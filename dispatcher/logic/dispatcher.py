@@ -16,19 +16,39 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import os
-import json
+import time
 
 import asyncio
 
-from dispatcher.config import instance as config, reset_config, Sections, control_config
+from common.framing import LineFramer, available_framings, get_framer
+from common.writer import FramedWriter
+from dispatcher.config import instance as config, reset_config, DispatcherGlobals, Sections, control_config, parse_labels
+from dispatcher.logic import metrics
+from dispatcher.logic.artifacts import ArtifactCache, BuildError
+from dispatcher.logic.process import spawn
+from dispatcher.logic.spool import SpoolManager
 from dispatcher.logic.line_processor import StdErrLineProcessor, StdOutLineProcessor
+from dispatcher.logic.scheduler import JobScheduler, JobState
+from dispatcher.logic.worker_pool import WorkerPool
+from dispatcher.logic.uploader import MessageUploader, OutputChannel, OutputTransport, SocketUploader
 from dispatcher.models.executor import Executor
-from dispatcher.utils.logger import get_logger, setup_logging
+from dispatcher.utils.logger import FRAMES_LOGGER, get_logger, setup_logging
 
 
 logger = get_logger()
+frames_logger = get_logger(FRAMES_LOGGER)
 setup_logging()
 
+RUN_CORRELATION_KEYS = ("run_id", "group_id")
+MAX_REDIRECTS = 3
+
+
+class RunState:
+    STARTED = "started"
+    FINISHED = "finished"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+
 
 class Dispatcher:
 
@@ -42,7 +62,18 @@ class Dispatcher:
         self.config_path = config_path
         self.host = config.get(Sections.SERVER, "host")
         self.port = config.get(Sections.SERVER, "port")
+        self.agents_port = int(config[Sections.SERVER].get("agents_port", 8888))
+        framing = config[Sections.SERVER].get("framing")
+        # The framings offered to the server in the JOIN, the connection uses
+        # json lines until the server acknowledges one of them
+        self.framings = [name.strip() for name in framing.split(",")] if framing else available_framings()
+        self.framer = LineFramer()
+        # The executor output goes to the server with HTTP requests, or with
+        # OUTPUT frames through the agent socket
+        self.output_transport = config[Sections.SERVER].get("output_transport", OutputTransport.HTTP)
+        self.output = OutputChannel(self.send, int(config[Sections.SERVER].get("output_window", 16)))
         self.agent_name = config.get(Sections.AGENT, "agent_name")
+        self.labels = parse_labels(config[Sections.AGENT].get("labels", ""))
         self.session = session
         executors_list_str = config[Sections.AGENT].get("executors", []).split(",")
         if "" in executors_list_str:
@@ -51,35 +82,138 @@ class Dispatcher:
             executor_name:
                 Executor(executor_name, config) for executor_name in executors_list_str
         }
+        self.worker_pools = {
+            name: WorkerPool(executor, executor_env(executor))
+            for name, executor in self.executors.items() if executor.workers is not None
+        }
+        self.artifacts = ArtifactCache(
+            DispatcherGlobals.ARTIFACTS_PATH, int(config[Sections.AGENT].get("max_artifacts", 32))
+        )
+        self.spools = SpoolManager(session, DispatcherGlobals.SPOOL_PATH)
+        self.shutdown_timeout = int(config[Sections.AGENT].get("shutdown_timeout", 30))
+        self.scheduler = JobScheduler(
+            self.run_once,
+            max_concurrent=int(config[Sections.AGENT].get("max_concurrent_jobs", 4)),
+            max_pending=int(config[Sections.AGENT].get("max_pending_jobs", 64)),
+            executor_limits={name: executor.max_concurrent for name, executor in self.executors.items()},
+        )
+        self.sender = None
+        metric_port = config[Sections.AGENT].get("metrics_port")
+        self.metrics_port = int(metric_port) if metric_port else None
+        metrics.jobs.labels(JobState.PENDING).set_function(self.scheduler.pending_count)
+        metrics.jobs.labels(JobState.RUNNING).set_function(
+            lambda: len(self.scheduler.jobs) - self.scheduler.pending_count()
+        )
+        metrics.write_queue.set_function(lambda: self.sender.depth if self.sender is not None else 0)
 
     def write(self, data: dict):
-        data = json.dumps(data).encode() + b'\n'
-        self.writer.write(data)
+        metrics.frames_sent.labels(data.get("action")).inc()
+        self.sender.write(data)
+
+    async def send(self, data: dict):
+        metrics.frames_sent.labels(data.get("action")).inc()
+        # Waits while the socket buffer is over its high watermark
+        await self.sender.send(data)
+
+    def write_run_status(self, run_data: dict, status: dict):
+        # The ids the server sent with the RUN are sent back to correlate the status
+        for key in RUN_CORRELATION_KEYS:
+            if key in run_data:
+                status[key] = run_data[key]
+        self.write({"action": "RUN_STATUS", **status})
 
     async def read(self) -> dict:
-        data = await self.reader.readline()
-        logger.info('Parsing data: %s', data)
-        return json.loads(data.decode())
+        data = await self.framer.read(self.reader)
+        frames_logger.debug('Parsing data: %s', data)
+        if data is not None:
+            metrics.frames_received.labels(data.get("action")).inc()
+        return data
 
-    async def connect(self, loop):
+    async def connect(self):
 
         connected_data = {
                     'action': 'JOIN',
                     'name': self.agent_name,
+                    'labels': self.labels,
+                    'framing': self.framings,
                     'executors': [{"name": executor.name, "args": executor.params}
                                   for executor in self.executors.values()]
                 }
 
-        self.reader, self.writer = await asyncio.open_connection(self.host, 8888, loop=loop)
-        self.write(connected_data)
+        # A server in cluster mode redirects the agent to the node owning it
+        host, port = self.host, self.agents_port
+        for _ in range(MAX_REDIRECTS + 1):
+            self.reader, self.writer = await asyncio.open_connection(host, port)
+            self.sender = FramedWriter(self.writer, self.framer)
+            self.write(connected_data)
+            data = await self.read()
+            if data is None or data.get("action") != "REDIRECT":
+                break
+            logger.info("Redirected to %s:%s", data["host"], data["port"])
+            await self.sender.close()
+            self.writer.close()
+            host, port = data["host"], data["port"]
+        else:
+            raise ConnectionError(f"More than {MAX_REDIRECTS} redirects connecting to the server")
         logger.info("Connection to server succeeded")
+        self.spools.resume()
 
-        await self.run_await()  # This line can we called from outside (in main)
+        await self.run_await(data)  # This line can we called from outside (in main)
 
-    async def run_await(self):
-        while True:
-            data = await self.read()
-            asyncio.create_task(self.run_once(data))
+    async def run_await(self, data: dict = None):
+        try:
+            if data is None:
+                data = await self.read()
+            while data is not None:
+                if data.get("action") == "JOIN_ACK":
+                    self.framer = self.sender.framer = get_framer(data.get("framing", LineFramer.name))
+                    logger.info("Using %s framing", self.framer.name)
+                elif data.get("action") == "OUTPUT_ACK":
+                    self.output.ack(data["seq"])
+                elif data.get("action") == "CANCEL":
+                    self.cancel(data)
+                else:
+                    self.schedule(data)
+                data = await self.read()
+            logger.info("Server closed the connection")
+        finally:
+            self.output.close()
+            await self.scheduler.drain(timeout=self.shutdown_timeout)
+            await asyncio.gather(*(pool.close() for pool in self.worker_pools.values()))
+            await self.spools.close(timeout=self.shutdown_timeout)
+            await self.sender.close()
+
+    def schedule(self, data: dict):
+        executor_name = data.get("code_executor")
+        if self.scheduler.submit(executor_name, data) is None:
+            self.write_run_status(
+                data,
+                {
+                    "executor_name": executor_name,
+                    "running": False,
+                    "state": RunState.FAILED,
+                    "message": f"Job queue of {self.agent_name} agent is full, "
+                               f"{executor_name} executor was not run"
+                }
+            )
+
+    def cancel(self, data: dict):
+        job = self.scheduler.find("run_id", data.get("run_id"))
+        if job is None:
+            logger.info("Run %s to cancel not found", data.get("run_id"))
+            return
+        if job.state == JobState.PENDING:
+            # The job never started, so run_once will not report it
+            self.write_run_status(
+                job.data,
+                {
+                    "executor_name": job.executor_name,
+                    "successful": False,
+                    "state": RunState.CANCELLED,
+                    "message": f"Executor {job.executor_name} from {self.agent_name} was cancelled"
+                }
+            )
+        self.scheduler.cancel(job.id)
 
     def control_data(self, data):
         if "action" not in data:
@@ -95,10 +229,11 @@ class Dispatcher:
         if data["action"] == "RUN":
             if "code_executor" not in data:
                 logger.error("No executor selected")
-                self.write(
+                self.write_run_status(
+                    data,
                     {
-                        "action": "RUN_STATUS",
                         "running": False,
+                        "state": RunState.FAILED,
                         "message": f"No executor selected to {self.agent_name} agent"
                     }
                 )
@@ -106,11 +241,12 @@ class Dispatcher:
 
             if data["code_executor"] not in self.executors:
                 logger.error("The selected executor not exists")
-                self.write(
+                self.write_run_status(
+                    data,
                     {
-                        "action": "RUN_STATUS",
                         "executor_name": data["code_executor"],
                         "running": False,
+                        "state": RunState.FAILED,
                         "message": f"The selected executor {data['code_executor']} not exists in {self.agent_name} "
                                    f"agent"
                     }
@@ -131,11 +267,12 @@ class Dispatcher:
                 ])
             if not all_accepted:
                 logger.error("Unexpected argument passed to {} executor".format(executor.name))
-                self.write(
+                self.write_run_status(
+                    data,
                     {
-                        "action": "RUN_STATUS",
                         "executor_name": executor.name,
                         "running": False,
+                        "state": RunState.FAILED,
                         "message": f"Unexpected argument(s) passed to {executor.name} executor from {self.agent_name} "
                                    f"agent"
                     }
@@ -151,11 +288,12 @@ class Dispatcher:
             )
             if not mandatory_full:
                 logger.error("Mandatory argument not passed to {} executor".format(executor.name))
-                self.write(
+                self.write_run_status(
+                    data,
                     {
-                        "action": "RUN_STATUS",
                         "executor_name": executor.name,
                         "running": False,
+                        "state": RunState.FAILED,
                         "message": f"Mandatory argument(s) not passed to {executor.name} executor from "
                                    f"{self.agent_name} agent"
                     }
@@ -171,63 +309,139 @@ class Dispatcher:
             passed_params = data['args'] if 'args' in data else {}
 
             running_msg = f"Running {executor.name} executor from {self.agent_name} agent"
-            logger.info("Running {} executor".format(executor.name))
-
-            process = await self.create_process(executor, passed_params)
-            tasks = [
-                StdOutLineProcessor(process, self.session).process_f(),
-                StdErrLineProcessor(process).process_f(),
-            ]
-            self.write(
-                {
-                    "action": "RUN_STATUS",
-                    "executor_name": executor.name,
-                    "running": True,
-                    "message": running_msg
-                }
-            )
-            await asyncio.gather(*tasks)
-            await process.communicate()
+            logger.info("Running %s executor", executor.name)
+
+            process = uploader = None
+            try:
+                # A cancel or an error while building, waiting for a worker
+                # or spawning is reported too, or the run would stay queued
+                process = await self.create_process(executor, passed_params)
+                uploader = self.create_uploader(executor, data)
+                tasks = [StdOutLineProcessor(process, self.session, uploader, executor.max_size).process_f()]
+                if process.stderr is not None:
+                    tasks.append(StdErrLineProcessor(process, executor.max_size).process_f())
+                self.write_run_status(
+                    data,
+                    {
+                        "executor_name": executor.name,
+                        "running": True,
+                        "state": RunState.STARTED,
+                        "message": running_msg
+                    }
+                )
+                started = time.perf_counter()
+                await asyncio.gather(*tasks)
+                await process.wait()
+            except asyncio.CancelledError:
+                metrics.runs.labels(executor.name, RunState.CANCELLED).inc()
+                logger.warning("Executor {} cancelled".format(executor.name))
+                await self.stop_run(process, uploader)
+                self.write_run_status(
+                    data,
+                    {
+                        "executor_name": executor.name,
+                        "successful": False,
+                        "state": RunState.CANCELLED,
+                        "message": f"Executor {executor.name} from {self.agent_name} was cancelled"
+                    }
+                )
+                raise
+            except Exception as e:
+                metrics.runs.labels(executor.name, RunState.FAILED).inc()
+                if isinstance(e, BuildError):
+                    message = f"{e} in {self.agent_name} agent"
+                elif process is None:
+                    message = f"Executor {executor.name} from {self.agent_name} could not be started: {e}"
+                else:
+                    message = f"Executor {executor.name} from {self.agent_name} failed: {e}"
+                logger.error(message)
+                await self.stop_run(process, uploader)
+                self.write_run_status(
+                    data,
+                    {
+                        "executor_name": executor.name,
+                        "running": False,
+                        "state": RunState.FAILED,
+                        "message": message
+                    }
+                )
+                return
             assert process.returncode is not None
+            metrics.run_seconds.labels(executor.name).observe(time.perf_counter() - started)
+            metrics.runs.labels(
+                executor.name, RunState.FINISHED if process.returncode == 0 else RunState.FAILED
+            ).inc()
             if process.returncode == 0:
-                logger.info("Executor {} finished successfully".format(executor.name))
-                self.write(
+                logger.info("Executor %s finished successfully", executor.name)
+                self.write_run_status(
+                    data,
                     {
-                        "action": "RUN_STATUS",
                         "executor_name": executor.name,
                         "successful": True,
+                        "state": RunState.FINISHED,
                         "message": f"Executor {executor.name} from {self.agent_name} finished successfully"
                     }
                 )
             else:
                 logger.warning(
                     f"Executor {executor.name} finished with exit code {process.returncode}")
-                self.write(
+                self.write_run_status(
+                    data,
                     {
-                        "action": "RUN_STATUS",
                         "executor_name": executor.name,
                         "successful": False,
+                        "state": RunState.FAILED,
                         "message": f"Executor {executor.name} from {self.agent_name} failed"
                     }
                 )
 
     @staticmethod
-    async def create_process(executor: Executor, args):
-        env = os.environ.copy()
-        if isinstance(args, dict):
-            for k in args:
-                env[f"EXECUTOR_CONFIG_{k.upper()}"] = str(args[k])
-        else:
+    async def stop_run(process, uploader):
+        """Kills the executor of a run ended early, the output already read is
+        still uploaded"""
+        if process is not None:
+            if process.returncode is None:
+                process.kill()
+            await process.wait()
+        if uploader is not None:
+            await uploader.close()
+
+    def create_uploader(self, executor: Executor, data: dict):
+        if executor.spool:
+            return self.spools.open(data.get("run_id"))
+        if self.output_transport == OutputTransport.SOCKET:
+            # Without batch_size every line is sent in its own frame
+            return SocketUploader(
+                self.output, executor.batch_size or 1, executor.batch_timeout, executor.max_in_flight,
+                run_id=data.get("run_id"),
+            )
+        if executor.batch_size is not None:
+            return MessageUploader(
+                self.session, executor.batch_size, executor.batch_timeout, executor.max_in_flight
+            )
+        return None
+
+    async def create_process(self, executor: Executor, args):
+        if not isinstance(args, dict):
             logger.error("Args from data received has a not supported type")
             raise ValueError("Args from data received has a not supported type")
-        for varenv, value in executor.varenvs.items():
-            env[f"{varenv.upper()}"] = value
-        process = await asyncio.create_subprocess_shell(
-            executor.cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE,
-            env=env,
-            limit=executor.max_size
-            # If the config is not set, use async.io default
-        )
-        return process
+        with metrics.start_seconds.labels(executor.name).time():
+            return await self.__create_process(executor, args)
+
+    async def __create_process(self, executor: Executor, args: dict):
+        args_env = {f"EXECUTOR_CONFIG_{k.upper()}": str(args[k]) for k in args}
+        if executor.build_cmd is not None:
+            artifact = await self.artifacts.get(executor, executor_env(executor))
+            args_env["BUILD_ARTIFACT"] = str(artifact)
+        if executor.name in self.worker_pools:
+            # The worker already has the varenvs, only the args change by job
+            return await self.worker_pools[executor.name].submit(args_env)
+        env = {**executor_env(executor), **args_env}
+        return await spawn(executor, env)
+
+
+def executor_env(executor: Executor) -> dict:
+    env = os.environ.copy()
+    for varenv, value in executor.varenvs.items():
+        env[f"{varenv.upper()}"] = value
+    return env
@@ -13,32 +13,33 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-import json
-from json import JSONDecodeError
-
+from common import codec
+from common.schema import OUTPUT_MESSAGE
 import dispatcher.utils.logger as logging
-from dispatcher.config import instance as config
+from dispatcher.logic import metrics
+from dispatcher.logic.line_reader import LineReader
+from dispatcher.logic.uploader import JSON_HEADERS, BatchUploader, messages_url
 from dispatcher.utils.text_utils import Colors
 
 from aiohttp import ClientSession
 
 logger = logging.get_logger()
+output_logger = logging.get_logger(logging.MESSAGES_LOGGER)
+
+DEFAULT_MAX_LINE = 64 * 1024
+POST_SECONDS = metrics.post_seconds.labels("messages")
 
 
 class FileLineProcessor:
 
     @staticmethod
     async def _process_lines(line_getter, process_line_f, logger_f, name):
-        while True:
-            try:
-                line = await line_getter()
-                if line != "":
-                    await process_line_f(line)
-                    logger_f(line)
-                else:
-                    break
-            except ValueError:
-                logger.error("ValueError raised processing {}, try with bigger limiting size in config".format(name))
+        line = await line_getter()
+        while line is not None:
+            if line != "":
+                await process_line_f(line)
+                logger_f(line)
+            line = await line_getter()
         print(f"{Colors.WARNING}{name} sent empty data, {Colors.ENDC}")
 
     def __init__(self, name):
@@ -59,31 +60,47 @@ class FileLineProcessor:
 
 class StdOutLineProcessor(FileLineProcessor):
 
-    def __init__(self, process, session: ClientSession):
+    def __init__(self, process, session: ClientSession, uploader: BatchUploader = None,
+                 max_line: int = DEFAULT_MAX_LINE):
         super().__init__("stdout")
         self.process = process
         self.__session = session
+        self.__uploader = uploader
+        self.rejected = 0
+        # Pool workers already split the output of their jobs
+        self.__lines = process.lines if hasattr(process, "lines") else LineReader(process.stdout, max_line)
 
     async def next_line(self):
-        line = await self.process.stdout.readline()
-        line = line.decode('utf-8')
-        return line[:-1]
+        return await self.__lines.readline()
 
     def post_url(self):
-        host = config.get('server', 'host')
-        port = config.get('server', 'port')
-        return f"http://{host}:{port}/messages"
+        return messages_url()
 
     async def processing(self, line):
+        metrics.output_lines.inc()
         try:
-            loaded_json = json.loads(line)
+            loaded_json = codec.loads(line)
+            error = OUTPUT_MESSAGE.validate(loaded_json)
+            if error is not None:
+                # Rejected here, so invalid output never reaches the server
+                self.rejected += 1
+                metrics.output_rejected.inc()
+                logger.error("Invalid executor output: {}".format(error))
+                print(f"{Colors.WARNING}Invalid executor output: {error}{Colors.ENDC}")
+                return
             print(f"{Colors.OKBLUE}{line}{Colors.ENDC}")
 
-            res = await self.__session.post(
-                self.post_url(),
-                json=loaded_json,
-                raise_for_status=False,
-            )
+            if self.__uploader is not None:
+                await self.__uploader.add(loaded_json)
+                return
+
+            with POST_SECONDS.time():
+                res = await self.__session.post(
+                    self.post_url(),
+                    data=codec.dumps(loaded_json),
+                    headers=JSON_HEADERS,
+                    raise_for_status=False,
+                )
             if res.status == 201:
                 logger.info("Message sent to server")
             else:
@@ -92,27 +109,31 @@ class StdOutLineProcessor(FileLineProcessor):
                     "endpoint. Server responded: {} {}".format(res.status, await res.text())
                     )
 
-        except JSONDecodeError as e:
+        except codec.DecodeError as e:
             logger.error("JSON Parsing error: {}".format(e))
             print(f"{Colors.WARNING}JSON Parsing error: {e}{Colors.ENDC}")
 
+    async def process_f(self):
+        await super().process_f()
+        if self.__uploader is not None:
+            await self.__uploader.close()
+
     def log(self, line):
-        logger.debug(f"Output line: {line}")
+        output_logger.debug("Output line: %s", line)
 
 
 class StdErrLineProcessor(FileLineProcessor):
 
-    def __init__(self, process):
+    def __init__(self, process, max_line: int = DEFAULT_MAX_LINE):
         super().__init__("stderr")
         self.process = process
+        self.__lines = LineReader(process.stderr, max_line)
 
     async def next_line(self):
-        line = await self.process.stderr.readline()
-        line = line.decode('utf-8')
-        return line[:-1]
+        return await self.__lines.readline()
 
     async def processing(self, line):
         print(f"{Colors.FAIL}{line}{Colors.ENDC}")
 
     def log(self, line):
-        logger.debug(f"Error line: {line}")
+        output_logger.debug("Error line: %s", line)
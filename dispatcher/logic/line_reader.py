@@ -0,0 +1,96 @@
+# Copyright (C) 2019  Infobyte LLC (http://www.infobytesec.com/)
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from asyncio import StreamReader
+from collections import deque
+from typing import Deque, List, Optional
+
+from dispatcher.logic import metrics
+
+DEFAULT_CHUNK_SIZE = 256 * 1024
+TRUNCATED_MARKER = b"...[truncated]"
+
+
+class LineReader:
+    """Reads the output of an executor in big chunks instead of line by line.
+
+    Every chunk is appended to a bytearray, and everything up to its last
+    newline is decoded with a single call and split in lines. A line longer
+    than `max_line` bytes is truncated and ends with TRUNCATED_MARKER; the
+    rest of it is discarded while it arrives, so it is never buffered."""
+
+    def __init__(self, stream: StreamReader, max_line: int, chunk_size: int = DEFAULT_CHUNK_SIZE):
+        self.stream = stream
+        self.max_line = max_line
+        self.chunk_size = chunk_size
+        self.truncated = 0
+        self.__buffer = bytearray()
+        self.__lines: Deque[str] = deque()
+        self.__discarding = False
+        self.__eof = False
+
+    async def readline(self) -> Optional[str]:
+        """The next line without its newline, None at the end of the output"""
+        while not self.__lines:
+            if self.__eof:
+                return None
+            await self.__fill()
+        return self.__lines.popleft()
+
+    async def __fill(self):
+        chunk = await self.stream.read(self.chunk_size)
+        if not chunk:
+            self.__eof = True
+            if self.__buffer and not self.__discarding:
+                self.__lines.extend(self.__split(bytes(self.__buffer)))
+            self.__buffer.clear()
+            return
+        if self.__discarding:
+            newline = chunk.find(b'\n')
+            if newline == -1:
+                return
+            chunk = chunk[newline + 1:]
+            self.__discarding = False
+        self.__buffer += chunk
+        end = self.__buffer.rfind(b'\n')
+        if end == -1:
+            if len(self.__buffer) > self.max_line:
+                self.__truncate_buffer()
+            return
+        block = bytes(self.__buffer[:end])
+        # Deleting from the start of a bytearray only moves its start
+        del self.__buffer[:end + 1]
+        self.__lines.extend(self.__split(block))
+        if len(self.__buffer) > self.max_line:
+            self.__truncate_buffer()
+
+    def __truncate_buffer(self):
+        self.__lines.append(self.__truncate(bytes(self.__buffer)).decode('utf-8', errors='replace'))
+        self.__buffer.clear()
+        self.__discarding = True
+
+    def __truncate(self, line: bytes) -> bytes:
+        self.truncated += 1
+        metrics.output_truncated.inc()
+        return line[:self.max_line] + TRUNCATED_MARKER
+
+    def __split(self, block: bytes) -> List[str]:
+        if len(block) <= self.max_line:
+            # No line can be too long, the whole block is decoded at once
+            return block.decode('utf-8', errors='replace').split('\n')
+        return [
+            (self.__truncate(line) if len(line) > self.max_line else line).decode('utf-8', errors='replace')
+            for line in block.split(b'\n')
+        ]
@@ -0,0 +1,56 @@
+# Copyright (C) 2019  Infobyte LLC (http://www.infobytesec.com/)
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from aiohttp import web
+
+from common.metrics import CONTENT_TYPE, REGISTRY
+import dispatcher.utils.logger as logging
+
+logger = logging.get_logger()
+
+FAST_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+jobs = REGISTRY.gauge("dispatcher_jobs", "Jobs accepted by the scheduler", ["state"])
+runs = REGISTRY.counter("dispatcher_runs", "Executor runs ended", ["executor", "state"])
+run_seconds = REGISTRY.histogram("dispatcher_run_seconds", "Duration of the executor runs", ["executor"])
+start_seconds = REGISTRY.histogram(
+    "dispatcher_start_seconds", "Time to start an executor, build and spawn included", ["executor"], FAST_BUCKETS
+)
+
+output_lines = REGISTRY.counter("dispatcher_output_lines", "Lines of executor output read")
+output_rejected = REGISTRY.counter("dispatcher_output_rejected", "Lines of executor output rejected by the schema")
+output_truncated = REGISTRY.counter("dispatcher_output_truncated", "Lines of executor output truncated")
+post_seconds = REGISTRY.histogram(
+    "dispatcher_post_seconds", "Latency of the HTTP posts of output to the server", ["endpoint"], FAST_BUCKETS
+)
+
+frames_received = REGISTRY.counter("dispatcher_frames_received", "Frames received from the server", ["action"])
+frames_sent = REGISTRY.counter("dispatcher_frames_sent", "Frames sent to the server", ["action"])
+write_queue = REGISTRY.gauge("dispatcher_write_queue_bytes", "Bytes queued to be written to the server socket")
+
+
+async def get_metrics(request):
+    return web.Response(body=REGISTRY.expose(), headers={"Content-Type": CONTENT_TYPE})
+
+
+async def start_metrics_server(port: int) -> web.AppRunner:
+    """Serves /metrics until the returned runner is cleaned up"""
+    app = web.Application()
+    app.add_routes([web.get('/metrics', get_metrics)])
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, '0.0.0.0', port).start()
+    logger.info("Serving metrics on port %d", port)
+    return runner
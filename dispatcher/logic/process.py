@@ -0,0 +1,39 @@
+# Copyright (C) 2019  Infobyte LLC (http://www.infobytesec.com/)
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+from typing import Dict
+
+from dispatcher.models.executor import Executor
+
+
+async def spawn(executor: Executor, env: Dict[str, str], **kwargs) -> asyncio.subprocess.Process:
+    """Starts the executor cmd, without a shell in between when it has an argv"""
+    kwargs.setdefault("stdout", asyncio.subprocess.PIPE)
+    kwargs.setdefault("stderr", asyncio.subprocess.PIPE)
+    if executor.argv is not None:
+        return await asyncio.create_subprocess_exec(
+            *executor.argv,
+            env=env,
+            limit=executor.max_size,
+            **kwargs
+        )
+    return await asyncio.create_subprocess_shell(
+        executor.cmd,
+        env=env,
+        limit=executor.max_size,
+        # If the config is not set, use async.io default
+        **kwargs
+    )
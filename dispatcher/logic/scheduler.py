@@ -0,0 +1,122 @@
+# Copyright (C) 2019  Infobyte LLC (http://www.infobytesec.com/)
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+import itertools
+from typing import Dict, List, Optional
+
+import dispatcher.utils.logger as logging
+
+logger = logging.get_logger()
+
+
+class JobState:
+    PENDING = "pending"
+    RUNNING = "running"
+
+
+class Job:
+
+    def __init__(self, job_id: int, executor_name: str, data: dict):
+        self.id = job_id
+        self.executor_name = executor_name
+        self.data = data
+        self.state = JobState.PENDING
+        self.task: Optional[asyncio.Task] = None
+
+    def __str__(self):
+        return f"Job[id:{self.id}, executor:{self.executor_name}, state:{self.state}]"
+
+    def __repr__(self):
+        return self.__str__()
+
+
+class JobScheduler:
+    """Runs the jobs received from the server with a global concurrency cap and
+    a cap per executor. Jobs waiting for a slot are pending, and at most
+    `max_pending` of them are accepted."""
+
+    def __init__(self, run_f, max_concurrent: int, max_pending: int, executor_limits: Dict[str, int]):
+        self.__run_f = run_f
+        self.__global_slots = asyncio.Semaphore(max_concurrent)
+        self.__executor_slots = {
+            name: asyncio.Semaphore(limit) for name, limit in executor_limits.items() if limit is not None
+        }
+        self.max_pending = max_pending
+        self.jobs: Dict[int, Job] = {}
+        self.__ids = itertools.count(1)
+
+    def pending_count(self) -> int:
+        return sum(1 for job in self.jobs.values() if job.state == JobState.PENDING)
+
+    def is_full(self) -> bool:
+        return self.pending_count() >= self.max_pending
+
+    def submit(self, executor_name: str, data: dict) -> Optional[Job]:
+        if self.is_full():
+            logger.warning("Job queue is full, rejecting job for %s executor", executor_name)
+            return None
+        job = Job(next(self.__ids), executor_name, data)
+        job.task = asyncio.create_task(self.__run(job))
+        job.task.add_done_callback(lambda _: self.jobs.pop(job.id, None))
+        self.jobs[job.id] = job
+        return job
+
+    async def __run(self, job: Job):
+        executor_slot = self.__executor_slots.get(job.executor_name)
+        # The executor slot is taken first, so a job blocked by its executor
+        # limit does not hold a global slot
+        if executor_slot is not None:
+            await executor_slot.acquire()
+        try:
+            async with self.__global_slots:
+                job.state = JobState.RUNNING
+                await self.__run_f(job.data)
+        finally:
+            if executor_slot is not None:
+                executor_slot.release()
+
+    def list_jobs(self) -> List[Job]:
+        return list(self.jobs.values())
+
+    def cancel(self, job_id: int) -> bool:
+        job = self.jobs.get(job_id)
+        if job is None:
+            return False
+        job.task.cancel()
+        return True
+
+    def find(self, key: str, value) -> Optional[Job]:
+        for job in self.jobs.values():
+            if job.data.get(key) == value:
+                return job
+        return None
+
+    def cancel_all(self):
+        for job in self.list_jobs():
+            job.task.cancel()
+
+    async def drain(self, timeout: float = None):
+        """Waits for the running and pending jobs, cancelling the ones still
+        alive after `timeout` seconds"""
+        tasks = [job.task for job in self.list_jobs()]
+        if not tasks:
+            return
+        logger.info("Waiting for %d jobs to finish", len(tasks))
+        _, still_running = await asyncio.wait(tasks, timeout=timeout)
+        for task in still_running:
+            task.cancel()
+        if still_running:
+            await asyncio.wait(still_running)
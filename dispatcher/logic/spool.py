@@ -0,0 +1,223 @@
+# Copyright (C) 2019  Infobyte LLC (http://www.infobytesec.com/)
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+import os
+import random
+import uuid
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+from aiohttp import ClientError, ClientSession
+
+from common import codec
+import dispatcher.utils.logger as logging
+from dispatcher.logic.uploader import messages_url
+
+logger = logging.get_logger()
+
+NDJSON_HEADERS = {"Content-Type": "application/x-ndjson"}
+MAX_UPLOAD_BYTES = 4 * 1024 * 1024      # The server accepts up to 32 MB
+BACKOFF_BASE = 0.5                      # seconds
+BACKOFF_MAX = 30.0                      # seconds
+PERMANENT_ERRORS = (400, 413, 415, 422)
+REJECTED_FOLDER = "rejected"                # Dead-letter files of the lines rejected
+
+
+class Spool:
+    """Append-only ndjson file with the output of a run, and the offset of the
+    bytes already uploaded, kept in a .offset file next to it"""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.offset_path = path.with_suffix(".offset")
+        self.offset = int(self.offset_path.read_text()) if self.offset_path.exists() else 0
+        self.__file = None
+        self.closed = True
+
+    def open(self):
+        self.__file = open(self.path, 'ab')
+        self.closed = False
+
+    def append(self, message: dict):
+        self.__file.write(codec.dumps(message) + b'\n')
+
+    def flush(self):
+        if self.__file is not None:
+            self.__file.flush()
+
+    def close(self):
+        if self.__file is not None:
+            self.__file.close()
+            self.__file = None
+        self.closed = True
+
+    def read_pending(self, max_bytes: int) -> bytes:
+        """Whole lines after the uploaded offset, up to max_bytes unless a
+        single line is bigger"""
+        self.flush()
+        with open(self.path, 'rb') as spool_file:
+            spool_file.seek(self.offset)
+            data = spool_file.read(max_bytes)
+            end = data.rfind(b'\n')
+            if end == -1 and len(data) == max_bytes:
+                data += spool_file.readline()
+                end = data.rfind(b'\n')
+        return data[:end + 1]
+
+    def checkpoint(self, uploaded: int):
+        self.offset += uploaded
+        temporary_path = self.offset_path.with_suffix(".offset.tmp")
+        temporary_path.write_text(str(self.offset))
+        os.replace(temporary_path, self.offset_path)
+
+    def delete(self):
+        self.close()
+        for path in (self.path, self.offset_path):
+            if path.exists():
+                path.unlink()
+
+
+class SpoolUploader:
+    """Writes the output of a run to its spool, at disk speed, while a
+    background task drains the spool to the bulk endpoint. A failed upload is
+    retried with exponential backoff, so the executor never waits for the
+    server and nothing is lost while it is down."""
+
+    def __init__(self, manager: "SpoolManager", spool: Spool):
+        self.__manager = manager
+        self.spool = spool
+        self.__pending = asyncio.Event()
+        self.drain_task = asyncio.ensure_future(self.__drain())
+
+    async def add(self, message: dict):
+        self.spool.append(message)
+        self.__pending.set()
+
+    async def close(self):
+        # The run does not wait for the upload, the spool is drained later
+        self.spool.close()
+        self.__pending.set()
+
+    async def __drain(self):
+        attempt = 0
+        while True:
+            data = self.spool.read_pending(MAX_UPLOAD_BYTES)
+            if not data:
+                if self.spool.closed:
+                    self.spool.delete()
+                    return
+                self.__pending.clear()
+                await self.__pending.wait()
+                continue
+            done = await self.__manager.upload(data, self.spool.path.name)
+            if done:
+                self.spool.checkpoint(done)
+                attempt = 0
+            if done < len(data):
+                delay = min(BACKOFF_BASE * 2 ** attempt, BACKOFF_MAX) * random.uniform(0.5, 1)
+                attempt += 1
+                logger.warning("Upload of %s failed, retrying in %.1f seconds", self.spool.path.name, delay)
+                await asyncio.sleep(delay)
+
+
+class SpoolManager:
+    """The spools of the runs under `path`. Spools left by a previous
+    dispatcher are drained again when it starts."""
+
+    def __init__(self, session: ClientSession, path: Path):
+        self.__session = session
+        self.path = Path(path)
+        self.uploaders: Dict[Path, SpoolUploader] = {}
+
+    def open(self, name: str = None) -> SpoolUploader:
+        self.path.mkdir(parents=True, exist_ok=True)
+        spool = Spool(self.path / f"{name or uuid.uuid4().hex}.ndjson")
+        spool.open()
+        return self.__track(SpoolUploader(self, spool))
+
+    def resume(self):
+        if not self.path.exists():
+            return
+        for spool_path in self.path.glob("*.ndjson"):
+            if spool_path not in self.uploaders:
+                logger.info("Resuming upload of spool %s", spool_path.name)
+                self.__track(SpoolUploader(self, Spool(spool_path)))
+
+    def __track(self, uploader: SpoolUploader) -> SpoolUploader:
+        self.uploaders[uploader.spool.path] = uploader
+        uploader.drain_task.add_done_callback(lambda _: self.uploaders.pop(uploader.spool.path, None))
+        return uploader
+
+    async def upload(self, data: bytes, spool_name: str) -> int:
+        """Uploads whole lines of a spool, returns how many bytes of `data` are
+        done, the rest must be retried. The lines rejected by the server are
+        moved to a dead-letter file, named like the spool."""
+        rejected = []
+        done = await self.__upload(data, rejected)
+        if rejected:
+            rejected_path = self.path / REJECTED_FOLDER / spool_name
+            rejected_path.parent.mkdir(parents=True, exist_ok=True)
+            with open(rejected_path, 'ab') as rejected_file:
+                rejected_file.writelines(line for line, _ in rejected)
+            logger.error(
+                "%d spooled messages rejected by the bulk message endpoint, moved to %s. Server responded: %s",
+                len(rejected), rejected_path, rejected[-1][1]
+            )
+        return done
+
+    async def __upload(self, data: bytes, rejected: List[Tuple[bytes, str]]) -> int:
+        try:
+            res = await self.__session.post(
+                messages_url("/bulk"),
+                data=data,
+                headers=NDJSON_HEADERS,
+                raise_for_status=False,
+            )
+        except (ClientError, OSError) as e:
+            logger.error("Error uploading spooled messages: %s", e)
+            return 0
+        if res.status == 201:
+            logger.info("Spooled messages sent to server")
+            return len(data)
+        if res.status not in PERMANENT_ERRORS:
+            logger.error("Server responded %d to spooled messages", res.status)
+            return 0
+        lines = data.splitlines(keepends=True)
+        if len(lines) == 1:
+            rejected.append((data, f"{res.status} {await res.text()}"))
+            return len(data)
+        # Retrying the batch would block the spool forever, it is split until
+        # the lines rejected are found and the others are uploaded
+        first = b''.join(lines[:len(lines) // 2])
+        done = await self.__upload(first, rejected)
+        if done < len(first):
+            return done
+        return done + await self.__upload(data[len(first):], rejected)
+
+    async def close(self, timeout: float = None):
+        """Waits for the spools to be drained, what is left is uploaded on the
+        next start"""
+        tasks = [uploader.drain_task for uploader in self.uploaders.values()]
+        if not tasks:
+            return
+        for uploader in list(self.uploaders.values()):
+            await uploader.close()
+        _, still_running = await asyncio.wait(tasks, timeout=timeout)
+        for task in still_running:
+            task.cancel()
+        if still_running:
+            logger.warning("%d spools left to upload on the next start", len(still_running))
+            await asyncio.wait(still_running)
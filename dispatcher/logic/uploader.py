@@ -0,0 +1,186 @@
+# Copyright (C) 2019  Infobyte LLC (http://www.infobytesec.com/)
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+import itertools
+from typing import Dict
+
+from aiohttp import ClientSession, ClientError
+
+from common import codec
+import dispatcher.utils.logger as logging
+from dispatcher.config import instance as config
+from dispatcher.logic import metrics
+
+logger = logging.get_logger()
+
+JSON_HEADERS = {"Content-Type": "application/json"}
+
+
+def messages_url(path=""):
+    host = config.get('server', 'host')
+    port = config.get('server', 'port')
+    return f"http://{host}:{port}/messages{path}"
+
+
+class OutputTransport:
+    HTTP = "http"
+    SOCKET = "socket"
+
+
+class BatchUploader:
+    """Groups the messages of an executor in batches, bounded by size and time,
+    and sends them with at most `max_in_flight` batches on the way at the same
+    time."""
+
+    def __init__(self, batch_size: int, batch_timeout: float, max_in_flight: int):
+        self.batch_size = batch_size
+        self.batch_timeout = batch_timeout
+        self.__batch = []
+        self.__timer = None
+        self.__in_flight = asyncio.Semaphore(max_in_flight)
+        self.__tasks = set()
+
+    def __track(self, coro):
+        task = asyncio.create_task(coro)
+        self.__tasks.add(task)
+        task.add_done_callback(self.__tasks.discard)
+        return task
+
+    def __cancel_timer(self):
+        if self.__timer is not None:
+            self.__timer.cancel()
+            self.__timer = None
+
+    def __on_timeout(self):
+        self.__timer = None
+        self.__track(self.flush())
+
+    async def add(self, message: dict):
+        self.__batch.append(message)
+        if len(self.__batch) >= self.batch_size:
+            await self.flush()
+        elif self.__timer is None:
+            self.__timer = asyncio.get_event_loop().call_later(self.batch_timeout, self.__on_timeout)
+
+    async def flush(self):
+        self.__cancel_timer()
+        if not self.__batch:
+            return
+        batch, self.__batch = self.__batch, []
+        # Waits here when max_in_flight batches are on the way, so the reader
+        # stops consuming the executor output until one of them finishes
+        await self.__in_flight.acquire()
+        self.__track(self.__send(batch))
+
+    async def close(self):
+        await self.flush()
+        while self.__tasks:
+            await asyncio.gather(*self.__tasks)
+
+    async def __send(self, batch: list):
+        try:
+            await self.upload(batch)
+        finally:
+            self.__in_flight.release()
+
+    async def upload(self, batch: list):
+        raise NotImplementedError("Must be implemented")
+
+
+class MessageUploader(BatchUploader):
+    """Uploads the batches to the bulk endpoint of the server"""
+
+    def __init__(self, session: ClientSession, batch_size: int, batch_timeout: float, max_in_flight: int):
+        super().__init__(batch_size, batch_timeout, max_in_flight)
+        self.__session = session
+
+    async def upload(self, batch: list):
+        try:
+            with metrics.post_seconds.labels("bulk").time():
+                res = await self.__session.post(
+                    messages_url("/bulk"),
+                    data=codec.dumps(batch),
+                    headers=JSON_HEADERS,
+                    raise_for_status=False,
+                )
+            if res.status == 201:
+                logger.info("Batch of %d messages sent to server", len(batch))
+            else:
+                logger.error(
+                    "Invalid data supplied by the executor to the bulk message "
+                    "endpoint. Server responded: {} {}".format(res.status, await res.text())
+                )
+        except ClientError as e:
+            logger.error("Error sending batch of %d messages: %s", len(batch), e)
+
+
+class OutputChannel:
+    """Sends OUTPUT frames over the agent socket. Every frame has a sequence
+    number the server acknowledges with an OUTPUT_ACK once the messages are
+    stored, and at most `window` frames of every run together wait for their
+    ack."""
+
+    def __init__(self, send_f, window: int):
+        self.__send_f = send_f
+        self.__window = asyncio.Semaphore(window)
+        self.__pending: Dict[int, asyncio.Future] = {}
+        self.__seqs = itertools.count(1)
+        self.closed = False
+
+    async def send(self, messages: list, run_id: str = None):
+        async with self.__window:
+            if self.closed:
+                raise ConnectionError("The agent socket is closed")
+            seq = next(self.__seqs)
+            acked = asyncio.get_event_loop().create_future()
+            self.__pending[seq] = acked
+            frame = {"action": "OUTPUT", "seq": seq, "messages": messages}
+            if run_id is not None:
+                frame["run_id"] = run_id
+            await self.__send_f(frame)
+            try:
+                await acked
+            finally:
+                self.__pending.pop(seq, None)
+
+    def ack(self, seq: int):
+        acked = self.__pending.get(seq)
+        if acked is not None and not acked.done():
+            acked.set_result(None)
+
+    def close(self):
+        """Fails the frames waiting for an ack, the connection is lost"""
+        self.closed = True
+        for acked in self.__pending.values():
+            if not acked.done():
+                acked.set_exception(ConnectionError("The agent socket was closed before the ack"))
+
+
+class SocketUploader(BatchUploader):
+    """Sends the batches of a run through the OutputChannel of the agent socket"""
+
+    def __init__(self, channel: OutputChannel, batch_size: int, batch_timeout: float, max_in_flight: int,
+                 run_id: str = None):
+        super().__init__(batch_size, batch_timeout, max_in_flight)
+        self.__channel = channel
+        self.__run_id = run_id
+
+    async def upload(self, batch: list):
+        try:
+            await self.__channel.send(batch, self.__run_id)
+            logger.debug("Batch of %d messages acknowledged by the server", len(batch))
+        except ConnectionError as e:
+            logger.error("Error sending batch of %d messages: %s", len(batch), e)
@@ -0,0 +1,190 @@
+# Copyright (C) 2019  Infobyte LLC (http://www.infobytesec.com/)
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+import os
+from collections import deque
+from typing import Deque, Dict, Optional, Set
+
+from common import codec
+import dispatcher.utils.logger as logging
+from dispatcher.logic.line_processor import StdErrLineProcessor
+from dispatcher.logic.line_reader import LineReader
+from dispatcher.logic.process import spawn
+from dispatcher.models.executor import Executor
+
+logger = logging.get_logger()
+
+# A worker gets a job as a json line {"env": {...}} in its stdin, writes its
+# output lines to stdout and ends the job with {"__done__": true, "exit_code": 0}
+DONE_KEY = "__done__"
+DONE_PREFIX = '{"' + DONE_KEY + '"'
+
+
+def rss_bytes(pid: int) -> Optional[int]:
+    """Resident memory of a process, None where /proc is not available"""
+    try:
+        with open(f"/proc/{pid}/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+class Worker:
+
+    def __init__(self, process: asyncio.subprocess.Process, max_line: int):
+        self.process = process
+        self.lines = LineReader(process.stdout, max_line)
+        self.jobs_done = 0
+        self.base_rss: Optional[int] = None
+        self.stderr_task = asyncio.ensure_future(StdErrLineProcessor(process, max_line).process_f())
+
+    @property
+    def alive(self) -> bool:
+        return self.process.returncode is None
+
+    def rss_growth(self) -> int:
+        rss = rss_bytes(self.process.pid)
+        if rss is None:
+            return 0
+        if self.base_rss is None:
+            # Measured after the first job, once the worker finished warming up
+            self.base_rss = rss
+        return rss - self.base_rss
+
+    async def stop(self):
+        if self.alive:
+            self.process.stdin.close()
+            try:
+                await asyncio.wait_for(self.process.wait(), timeout=5)
+            except asyncio.TimeoutError:
+                self.process.kill()
+                await self.process.wait()
+        await self.stderr_task
+
+
+class JobLines:
+
+    def __init__(self, job: "WorkerJob"):
+        self.__job = job
+
+    async def readline(self) -> Optional[str]:
+        return await self.__job.readline()
+
+
+class WorkerJob:
+    """A job running in a pool worker, with the part of the Process interface
+    run_once uses. Its lines end at the done line of the worker."""
+
+    def __init__(self, pool: "WorkerPool", worker: Worker):
+        self.__pool = pool
+        self.__worker = worker
+        self.lines = JobLines(self)
+        self.stderr = None  # The worker stderr is logged by the pool
+        self.returncode: Optional[int] = None
+        self.__released = False
+
+    async def readline(self) -> Optional[str]:
+        if self.returncode is not None:
+            return None
+        line = await self.__worker.lines.readline()
+        if line is None:
+            # The worker died in the middle of the job
+            self.returncode = await self.__worker.process.wait() or 1
+            return None
+        if line.startswith(DONE_PREFIX):
+            done = codec.loads(line)
+            self.returncode = int(done.get("exit_code", 0))
+            return None
+        return line
+
+    def kill(self):
+        if self.__worker.alive:
+            self.__worker.process.kill()
+
+    async def wait(self) -> int:
+        if self.returncode is None:
+            # Killed, or the output was not read until the done line
+            self.kill()
+            self.returncode = await self.__worker.process.wait()
+        if not self.__released:
+            self.__released = True
+            await self.__pool.release(self.__worker)
+        return self.returncode
+
+
+class WorkerPool:
+    """Up to `executor.workers` long lived processes of an executor, started on
+    demand. A worker is replaced after `worker_max_jobs` jobs, or when its
+    memory grew more than `worker_max_rss_growth` MB since its first job."""
+
+    def __init__(self, executor: Executor, env: Dict[str, str]):
+        self.executor = executor
+        self.env = env
+        self.__slots = asyncio.Semaphore(executor.workers)
+        self.__idle: Deque[Worker] = deque()
+        self.__workers: Set[Worker] = set()
+
+    async def __spawn(self) -> Worker:
+        process = await spawn(self.executor, self.env, stdin=asyncio.subprocess.PIPE)
+        logger.info("Started worker %d of %s executor", process.pid, self.executor.name)
+        worker = Worker(process, self.executor.max_size)
+        self.__workers.add(worker)
+        return worker
+
+    async def submit(self, job_env: Dict[str, str]) -> WorkerJob:
+        await self.__slots.acquire()
+        try:
+            worker = None
+            while self.__idle and worker is None:
+                worker = self.__idle.pop()
+                if not worker.alive:
+                    await self.__discard(worker)
+                    worker = None
+            if worker is None:
+                worker = await self.__spawn()
+            worker.process.stdin.write(codec.dumps({"env": job_env}) + b'\n')
+            await worker.process.stdin.drain()
+        except BaseException:
+            self.__slots.release()
+            raise
+        return WorkerJob(self, worker)
+
+    def __must_recycle(self, worker: Worker) -> bool:
+        if self.executor.worker_max_jobs is not None and worker.jobs_done >= self.executor.worker_max_jobs:
+            return True
+        max_growth = self.executor.worker_max_rss_growth
+        return max_growth is not None and worker.rss_growth() > max_growth * 1024 * 1024
+
+    async def release(self, worker: Worker):
+        worker.jobs_done += 1
+        try:
+            if worker.alive and not self.__must_recycle(worker):
+                self.__idle.append(worker)
+            else:
+                logger.info("Recycling worker %d of %s executor after %d jobs",
+                            worker.process.pid, self.executor.name, worker.jobs_done)
+                await self.__discard(worker)
+        finally:
+            self.__slots.release()
+
+    async def __discard(self, worker: Worker):
+        self.__workers.discard(worker)
+        await worker.stop()
+
+    async def close(self):
+        self.__idle.clear()
+        workers, self.__workers = self.__workers, set()
+        await asyncio.gather(*(worker.stop() for worker in workers))
@@ -1,8 +1,14 @@
+import shlex
+
 from dispatcher.config import Sections
 from dispatcher.utils.control_values_utils import (
     control_int,
     control_str,
-    control_bool
+    control_str_nullable,
+    control_bool,
+    control_bool_nullable,
+    control_float,
+    control_list,
 )
 
 
@@ -10,7 +16,18 @@ class Executor:
     __control_dict = {
         Sections.EXECUTOR_DATA: {
            "cmd": control_str,
-           "max_size": control_int(True)
+           "max_size": control_int(True),
+           "shell": control_bool_nullable,
+           "spool": control_bool_nullable,
+           "build_cmd": control_str_nullable,
+           "build_source": control_list(can_repeat=False, nullable=True),
+           "batch_size": control_int(True),
+           "batch_timeout": control_float(True),
+           "max_in_flight": control_int(True),
+           "max_concurrent": control_int(True),
+           "workers": control_int(True),
+           "worker_max_jobs": control_int(True),
+           "worker_max_rss_growth": control_int(True),
         }
     }
 
@@ -22,7 +39,30 @@ class Executor:
         params_section = Sections.EXECUTOR_PARAMS.format(name)
         varenvs_section = Sections.EXECUTOR_VARENVS.format(name)
         self.cmd = config.get(executor_section, "cmd")
+        # With shell = false the cmd is split here once and run without /bin/sh
+        shell = config[executor_section].get("shell", "true").lower() in ["t", "true"]
+        self.argv = shlex.split(self.cmd) if not shell else None
+        # The build_cmd output is cached by the content of build_source, see artifacts
+        self.build_cmd = config[executor_section].get("build_cmd")
+        build_source = config[executor_section].get("build_source", "")
+        self.build_source = [source.strip() for source in build_source.split(",") if source.strip()]
         self.max_size = int(config[executor_section].get("max_size", 64 * 1024))
+        # Batched upload is enabled only when batch_size is set
+        batch_size = config[executor_section].get("batch_size")
+        self.batch_size = int(batch_size) if batch_size is not None else None
+        self.batch_timeout = float(config[executor_section].get("batch_timeout", 0.5))
+        self.max_in_flight = int(config[executor_section].get("max_in_flight", 4))
+        max_concurrent = config[executor_section].get("max_concurrent")
+        self.max_concurrent = int(max_concurrent) if max_concurrent is not None else None
+        # With workers set the cmd starts long lived workers, see worker_pool
+        workers = config[executor_section].get("workers")
+        self.workers = int(workers) if workers is not None else None
+        worker_max_jobs = config[executor_section].get("worker_max_jobs")
+        self.worker_max_jobs = int(worker_max_jobs) if worker_max_jobs is not None else None
+        worker_max_rss_growth = config[executor_section].get("worker_max_rss_growth")
+        self.worker_max_rss_growth = int(worker_max_rss_growth) if worker_max_rss_growth is not None else None
+        # With spool the output is written to disk first and uploaded in background
+        self.spool = config[executor_section].get("spool", "false").lower() in ["t", "true"]
         self.params = dict(config[params_section]) if params_section in config else {}
         self.params = {key: value.lower() in ["t", "true"] for key, value in self.params.items()}
         self.varenvs = dict(config[varenvs_section]) if varenvs_section in config else {}
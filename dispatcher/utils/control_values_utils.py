@@ -1,3 +1,6 @@
+from common.framing import FramingError, get_framer
+
+
 def control_int(nullable=False):
     def control(field_name, value):
         if value is None and nullable:
@@ -17,12 +20,19 @@ def control_str(field_name, value):
         raise ValueError(f"{field_name} must be a string")
 
 
+def control_str_nullable(field_name, value):
+    if value is not None:
+        control_str(field_name, value)
+
+
 def control_host(field_name, value):
     control_str(field_name, value)
 
 
-def control_list(can_repeat=True):
+def control_list(can_repeat=True, nullable=False):
     def control(field_name, value):
+        if value is None and nullable:
+            return
         if not isinstance(value, str):
             raise ValueError(f"Trying to parse {field_name} with value {value} and should be a list")
         listt = value.split(",")
@@ -36,3 +46,49 @@ def control_bool(field_name, value):
     if str(value).lower() not in ["true", "false", "t", "f"]:
         raise ValueError(f"Trying to parse {field_name} with value {value} and should be a bool")
 
+
+def control_bool_nullable(field_name, value):
+    if value is not None:
+        control_bool(field_name, value)
+
+
+def control_labels(field_name, value):
+    if value is None:
+        return
+    for label in value.split(","):
+        if label.strip() and "=" not in label:
+            raise ValueError(f"Trying to parse {field_name} with value {value} and should be a list of key=value")
+
+
+def control_float(nullable=False):
+    def control(field_name, value):
+        if value is None and nullable:
+            return
+        if value is None:
+            raise ValueError(f"Trying to parse {field_name} with None value and should be a float")
+        try:
+            float(value)
+        except ValueError:
+            raise ValueError(f"Trying to parse {field_name} with value {value} and should be a float")
+
+    return control
+
+
+def control_framing(field_name, value):
+    if value is None:
+        return
+    for name in value.split(","):
+        try:
+            get_framer(name.strip())
+        except FramingError:
+            raise ValueError(f"Trying to parse {field_name} with value {value} and {name} framing is not supported")
+
+
+def control_choice(choices, nullable=False):
+    def control(field_name, value):
+        if value is None and nullable:
+            return
+        if value not in choices:
+            raise ValueError(f"Trying to parse {field_name} with value {value} and should be one of {', '.join(choices)}")
+
+    return control
@@ -14,28 +14,40 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import logging
-import logging.handlers
+from pathlib import Path
 
+from common.log import (
+    FORMAT, RateLimitFilter, SampleFilter, rotating_file_handler, set_filter, start_listener, stop_logger_listeners,
+)
 from dispatcher.config import DispatcherGlobals
 
 
 MAX_LOG_FILE_SIZE = 5 * 1024 * 1024     # 5 MB
 MAX_LOG_FILE_BACKUP_COUNT = 5
 ROOT_LOGGER = u'pycon2020_dispatcher'
+FRAMES_LOGGER = "frames"        # A record per frame received from the server
+MESSAGES_LOGGER = "output"      # A record per line of executor output
 LOGGING_HANDLERS = []
 LVL_SETTABLE_HANDLERS = []
+listener = None
 
 
-def setup_logging():
+def setup_logging(level: int = None, log_path: Path = None):
+    """Starts the thread writing the logs, to the console and to the rotating
+    `log_path` file if given. Called again it restarts it."""
     logger = logging.getLogger(ROOT_LOGGER)
     logger.propagate = False
-    logger.setLevel(logging.DEBUG)
+    # The handlers replaced are closed, so the listener using them stops first
+    stop_logger_listeners(logger)
+    if level is not None:
+        DispatcherGlobals.LOGGING_LEVEL = level
+    logger.setLevel(DispatcherGlobals.LOGGING_LEVEL)
 
-    formatter = logging.Formatter(
-            '%(asctime)s - %(name)s - %(levelname)s {%(threadName)s} [%(filename)s:%(lineno)s - %(funcName)s()]  '
-            '%(message)s'
-    )
+    formatter = logging.Formatter(FORMAT)
     setup_console_logging(formatter)
+    if log_path is not None:
+        setup_file_logging(formatter, log_path)
+    start_logging_listener()
 
 
 def setup_console_logging(formatter):
@@ -44,16 +56,38 @@ def setup_console_logging(formatter):
     console_handler.setLevel(DispatcherGlobals.LOGGING_LEVEL)
     console_handler.name = "CONSOLE_HANDLER"
     add_handler(console_handler)
-    LVL_SETTABLE_HANDLERS.append(console_handler)
+
+
+def setup_file_logging(formatter, log_path: Path):
+    file_handler = rotating_file_handler(log_path, MAX_LOG_FILE_SIZE, MAX_LOG_FILE_BACKUP_COUNT)
+    file_handler.setFormatter(formatter)
+    file_handler.setLevel(DispatcherGlobals.LOGGING_LEVEL)
+    file_handler.name = "FILE_HANDLER"
+    add_handler(file_handler)
 
 
 def add_handler(handler):
-    logger = logging.getLogger(ROOT_LOGGER)
-    for hldr in logger.handlers:
+    # The handlers are run by the listener thread, not by the logger
+    for hldr in list(LOGGING_HANDLERS):
         if hldr.name == handler.name:
-            logger.removeHandler(hldr)
-    logger.addHandler(handler)
+            LOGGING_HANDLERS.remove(hldr)
+            LVL_SETTABLE_HANDLERS.remove(hldr)
+            hldr.close()
     LOGGING_HANDLERS.append(handler)
+    LVL_SETTABLE_HANDLERS.append(handler)
+
+
+def start_logging_listener():
+    global listener
+    stop_logger_listeners(logging.getLogger(ROOT_LOGGER))
+    listener = start_listener(logging.getLogger(ROOT_LOGGER), LOGGING_HANDLERS)
+
+
+def setup_hot_path_logging(rate_limit: float = None, sample: int = None):
+    """Limits the loggers called for every frame and every message, records
+    are dropped before being queued"""
+    set_filter(get_logger(FRAMES_LOGGER), RateLimitFilter(rate_limit) if rate_limit else None)
+    set_filter(get_logger(MESSAGES_LOGGER), SampleFilter(sample) if sample and sample > 1 else None)
 
 
 def get_logger(obj=None):
@@ -77,5 +111,6 @@ def get_logger(obj=None):
 def set_logging_level(level):
 
     DispatcherGlobals.LOGGING_LEVEL = level
+    logging.getLogger(ROOT_LOGGER).setLevel(level)
     for handler in LVL_SETTABLE_HANDLERS:
         handler.setLevel(level)
@@ -1,3 +1,10 @@
-g++ $C_PATH -o c.o
-./c.o
-rm c.o
\ No newline at end of file
+# With the build phase the dispatcher compiles c.c once and passes the binary,
+# see the build_cmd and build_source options of the executor
+if [ -n "$BUILD_ARTIFACT" ]; then
+  "$BUILD_ARTIFACT"
+else
+  BINARY=$(mktemp)
+  g++ $C_PATH -o $BINARY
+  $BINARY
+  rm $BINARY
+fi
@@ -0,0 +1,12 @@
+import json
+import os
+import sys
+
+# Worker version of python.py, it runs a job for every line read from stdin.
+# Set "workers" in the executor section of dispatcher.ini to use it.
+for line in sys.stdin:
+    job = json.loads(line)
+    env = job.get("env", {})
+    print(json.dumps(dict(msg="Soy python", color="goldenrod", by=env.get("EXECUTOR_CONFIG_BY", os.getpid()))))
+    exit_code = 1 if env.get("FAIL", os.getenv("FAIL")) else 0
+    print(json.dumps({"__done__": True, "exit_code": exit_code}), flush=True)
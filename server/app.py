@@ -1,24 +1,41 @@
+import argparse
 import asyncio
 import json
 from pathlib import Path
+from typing import Optional
 
 import aiohttp_jinja2
 import jinja2
 from aiohttp import web
 
-from server.data_structures import agents, update_websocket_queue
-from server.logger import get_logger, setup_logging
+from common import codec, event_loop
+from common.event_loop import LOOPS
+from common.log import LEVELS, parse_level
+from server import metrics
+from server.config import ServerGlobals
+from server.cluster.bus import BusHub
+from server.cluster.cluster import FORWARDED_HEADER, NodeAddress
+from server.cluster.workers import bus_url, run_workers, worker_id, worker_log_file, worker_nodes
+from server.data_structures import agents, cluster, messages, run_groups, runs
+from server.exceptions import AdminRESTError, JsonValidaitonError, ObjectNotFound
+from server.logger import MESSAGES_LOGGER, get_logger, setup_hot_path_logging, setup_logging
+from server.message_log import MessageLog
+from server.run_groups import merge_groups
+from server.runs import latency_stats, merge_runs
 from server.socket_server.server import start_socket_server
-from server.utils import json_payload
+from server.updates import handle_cluster_event, reset_messages, store_messages
+from server.utils import json_payload, json_list_payload, output_messages_payload, int_query, format_addr
 from server.websockets.handler import websocket_handler
 
 setup_logging()
 logger = get_logger()
+messages_logger = get_logger(MESSAGES_LOGGER)
 
 routes = web.RouteTableDef()
 
-app = web.Application()
-messages_list = []
+MAX_REQUEST_SIZE = 32 * 1024 * 1024    # 32 MB, bulk message batches
+
+app = web.Application(client_max_size=MAX_REQUEST_SIZE)
 
 
 @aiohttp_jinja2.template('index.html')
@@ -27,51 +44,271 @@ async def index(request):
 
 
 async def reset(request):
-    messages_list.clear()
-    await update_websocket_queue.put("msg")
+    reset_messages()
     return web.Response(status=201)
 
 
+def valid_messages(data: list) -> list:
+    """The messages of a request, all of them rejected when one does not
+    match the output schema"""
+    try:
+        return output_messages_payload(data)
+    except JsonValidaitonError:
+        metrics.messages_rejected.inc(len(data))
+        raise
+
+
 async def add_messages(request):
 
     raw_data = await request.read()  # Raises 400 if malformed data is passed
     data = json_payload(raw_data)
+    valid_messages([data])
+
+    store_messages([data])
+    metrics.messages_received.labels("http").inc()
+
+    messages_logger.debug("Received message %s", data)
+
+    return web.Response(status=201)
+
+
+async def add_messages_bulk(request):
 
-    messages_list.append(data)
+    raw_data = await request.read()  # Raises 400 if malformed data is passed
+    data = valid_messages(json_list_payload(raw_data, request.content_type))
+
+    store_messages(data)
+    metrics.messages_received.labels("bulk").inc(len(data))
 
-    logger.info(messages_list)
-    await update_websocket_queue.put("msg")
+    logger.info("Received %d messages", len(data))
 
     return web.Response(status=201)
 
 
+async def forward(node: NodeAddress, path: str, body: bytes = None, method: str = "POST") -> web.Response:
+    status, body, content_type = await cluster.forward(node, path, body, method)
+    return web.Response(status=status, body=body, content_type=content_type)
+
+
 async def run_agent(request):
 
     raw_data = await request.read()  # Raises 400 if malformed data is passed
     data = json_payload(raw_data)
-    logger.info(f"Running {data}")
+    logger.info("Running %s", data)
 
     if "name" not in data or "code_executor" not in data or "args" not in data:
         return web.Response(status=400)
 
+    forwarded = FORWARDED_HEADER in request.headers
+    if not cluster.owns(data["name"]) and not forwarded:
+        # The agent is connected to another node of the cluster
+        return await forward(cluster.owner(data["name"]), "/run", raw_data)
+
+    candidates = agents.by_name(data["name"])
+    if "addr" in data:
+        # Agents sharing a name are told apart by their "host:port" address
+        candidates = [agent for agent in candidates if format_addr(agent.addr) == data["addr"]]
+    # Without sharding an agent joins any node, the agents of the other nodes
+    # are candidates too, unless the request comes from one of them
+    remote = [] if cluster.sharded or forwarded else cluster.remote_agents_named(data["name"], data.get("addr"))
+    if not candidates and not remote:
+        return web.Response(status=400)
+    if len(candidates) + len(remote) > 1:
+        raise AdminRESTError(
+            f"There are {len(candidates) + len(remote)} agents named {data['name']}, select one by addr",
+            status_code=409,
+            addrs=[format_addr(agent.addr) for agent in candidates] + [addr for addr, _ in remote],
+        )
+    if remote:
+        _, node = remote[0]
+        return await forward(node, "/run", raw_data)
+
     data["args"] = json.loads(data['args'])
 
-    for agent in agents.values():
-        if agent.name == data["name"]:
-            await agent.queue.put(dict(action="RUN", code_executor=data['code_executor'], args=data['args']))
-            return web.Response()
+    agent = candidates[0]
+    run = runs.create(agent, data['code_executor'], data['args'])
+    await agent.queue.put(dict(action="RUN", code_executor=data['code_executor'], args=data['args'], run_id=run.id))
+    return web.json_response(dict(run_id=run.id))
+
 
-    return web.Response(status=400)
+async def run_group(request):
+
+    raw_data = await request.read()  # Raises 400 if malformed data is passed
+    data = json_payload(raw_data)
+    logger.info("Running group %s", data)
 
+    if "selector" not in data or "code_executor" not in data:
+        return web.Response(status=400)
 
-@aiohttp_jinja2.template('messages.html')
-def get_messages(request):
-    return dict(messages=messages_list)
+    args = data.get("args", {})
+    if isinstance(args, str):
+        try:
+            args = json.loads(args or "{}")
+        except ValueError:
+            raise AdminRESTError("args is not valid json", status_code=400)
+    if not isinstance(args, dict):
+        raise AdminRESTError("args must be a json object", status_code=400)
+
+    try:
+        # Only the agents offering the executor are targeted
+        targets = agents.select(data["selector"], executor=data["code_executor"])
+    except ValueError as e:
+        raise AdminRESTError(str(e), status_code=400)
+
+    # In a cluster the node receiving the request creates the group, and each
+    # node runs it on its own agents
+    group = run_groups.create(data["code_executor"], args, group_id=data.get("group_id"))
+    for agent in targets:
+        run = runs.create(agent, data["code_executor"], args, group_id=group.id)
+        group.runs.append(run)
+        agent.queue.put_nowait(
+            dict(action="RUN", code_executor=data["code_executor"], args=args, group_id=group.id, run_id=run.id)
+        )
+    body = codec.dumps(dict(data, args=args, group_id=group.id))
+    targeted = len(targets) + sum(part["agents"] for part in await from_other_nodes(request, body))
+
+    return web.json_response(dict(group_id=group.id, agents=targeted), status=201)
+
+
+async def from_other_nodes(request, body: bytes = None, path: str = None) -> list:
+    """Sends the request to the other nodes of the cluster, returns their json
+    responses. A request forwarded by another node is not sent again."""
+    if not cluster.enabled or FORWARDED_HEADER in request.headers:
+        return []
+    responses = await cluster.fan_out(path or request.path_qs, body, request.method)
+    return [codec.loads(body) for status, body, _ in responses if 200 <= status < 300]
+
+
+async def forward_to_creator(request, object_id: str) -> Optional[web.Response]:
+    """Forwards a request for a run to the node that created it, None when
+    the run is of this node"""
+    node = cluster.node_of_id(object_id)
+    if node is None or node.id == cluster.node_id or FORWARDED_HEADER in request.headers:
+        return None
+    return await forward(node, request.path_qs, await request.read(), request.method)
+
+
+async def get_run_group(request):
+    group = run_groups.get(request.match_info["group_id"])
+    parts = [group.to_dict()] if group is not None else []
+    parts.extend(await from_other_nodes(request))
+    if not parts:
+        raise ObjectNotFound()
+    return web.json_response(merge_groups(parts))
+
+
+async def get_runs(request):
+    filters = {key: request.query.get(key) for key in ("executor", "agent", "state", "group")}
+    limit = int_query(request, 'limit', 100, minimum=1, maximum=runs.max_runs)
+    found = [run.to_dict() for run in runs.query(limit=limit, **filters)]
+    remote = await from_other_nodes(request)
+    if remote:
+        found = merge_runs([found] + remote, limit)
+    return web.json_response(found)
+
+
+async def get_run(request):
+    forwarded = await forward_to_creator(request, request.match_info["run_id"])
+    if forwarded is not None:
+        return forwarded
+    run = runs.get(request.match_info["run_id"])
+    if run is None:
+        raise ObjectNotFound()
+    return web.json_response(run.to_dict())
+
+
+async def cancel_run(request):
+    forwarded = await forward_to_creator(request, request.match_info["run_id"])
+    if forwarded is not None:
+        return forwarded
+    run = runs.get(request.match_info["run_id"])
+    if run is None:
+        raise ObjectNotFound()
+    agent = agents.get(run.addr)
+    if run.finished or agent is None:
+        raise AdminRESTError(f"Run {run.id} is not running", status_code=409)
+    await agent.queue.put(dict(action="CANCEL", run_id=run.id))
+    return web.Response(status=202)
+
+
+async def get_run_stats(request):
+    by = request.query.get("by", "executor")
+    if by not in ("executor", "agent"):
+        raise AdminRESTError("by must be executor or agent", status_code=400)
+    if not cluster.enabled or FORWARDED_HEADER in request.headers:
+        return web.json_response(runs.latency_stats(by))
+    # Percentiles can't be merged, they are computed from the runs of every node
+    found = [run.to_dict() for run in runs.query()]
+    for page in await from_other_nodes(request, path=f"/runs?limit={runs.max_runs}"):
+        found.extend(page)
+    return web.json_response(latency_stats((run[by], run["queue_time"], run["run_time"]) for run in found))
+
+
+async def get_messages(request):
+    limit = int_query(request, 'limit', ServerGlobals.MESSAGES_PAGE_SIZE,
+                      minimum=1, maximum=ServerGlobals.MESSAGES_MAX_PAGE_SIZE)
+    after = int_query(request, 'after')
+    tail = int_query(request, 'tail', maximum=ServerGlobals.MESSAGES_MAX_PAGE_SIZE)
+    if tail is not None:
+        page = messages.tail(tail)
+    else:
+        page = messages.after(after or 0, limit)
+    return web.json_response(dict(
+        messages=page,
+        next=page[-1]['id'] if page else max(after or 0, messages.oldest_id - 1),
+        last_id=messages.last_id,
+    ), dumps=codec.dumps_str)
+
+
+async def export_messages(request):
+    response = web.StreamResponse(headers={'Content-Type': 'application/x-ndjson'})
+    await response.prepare(request)
+    # Only the messages stored when the export started are sent
+    after, last_id = messages.oldest_id - 1, messages.last_id
+    while after < last_id:
+        page = messages.after(after, min(ServerGlobals.MESSAGES_MAX_PAGE_SIZE, last_id - after))
+        if not page:
+            break
+        await response.write(b''.join(codec.dumps(message) + b'\n' for message in page))
+        after = page[-1]['id']
+    await response.write_eof()
+    return response
 
 
 @aiohttp_jinja2.template('agents.html')
 def get_agents(request):
-    return dict(agents=agents.values())
+    return dict(agents=list(agents.values()) + list(cluster.remote_agents.values()))
+
+
+async def start_message_log(app):
+    app['message_log_flusher'] = asyncio.ensure_future(messages.log.run_flusher())
+
+
+async def close_message_log(app):
+    app['message_log_flusher'].cancel()
+    # Fsyncs what the flusher did not
+    messages.log.close()
+
+
+async def start_agents_server(app):
+    app['agents_server'] = await start_socket_server(app['agents_port'], reuse_port=app['reuse_port'])
+
+
+async def close_agents_server(app):
+    # Stops accepting agents, the connected ones are closed with the loop
+    app['agents_server'].close()
+
+
+async def start_cluster(app):
+    if app['bus_hub'] is not None:
+        await app['bus_hub'].start(*app['bus_hub_address'])
+    await cluster.start(handle_cluster_event, lambda: messages.last_id)
+
+
+async def close_cluster(app):
+    await cluster.close()
+    if app['bus_hub'] is not None:
+        await app['bus_hub'].close()
 
 
 async def shutdown(app):
@@ -80,21 +317,132 @@ async def shutdown(app):
     app['websockets'].clear()
 
 
-if __name__ == '__main__':
+def parse_args():
+    parser = argparse.ArgumentParser(description="server")
+    parser.add_argument("--messages-max-count", type=int, default=ServerGlobals.MESSAGES_MAX_COUNT,
+                        help="Max amount of messages kept in memory")
+    parser.add_argument("--messages-max-bytes", type=int, default=ServerGlobals.MESSAGES_MAX_BYTES,
+                        help="Max size in bytes of the messages kept in memory")
+    parser.add_argument("--messages-log", default=ServerGlobals.MESSAGES_LOG_PATH,
+                        help="Folder of the on-disk message log, disabled if not set")
+    parser.add_argument("--messages-log-segment-bytes", type=int, default=ServerGlobals.MESSAGES_LOG_SEGMENT_BYTES,
+                        help="Size in bytes of each segment of the message log")
+    parser.add_argument("--messages-log-max-segments", type=int, default=ServerGlobals.MESSAGES_LOG_MAX_SEGMENTS,
+                        help="Max amount of segments kept, the oldest ones are deleted")
+    parser.add_argument("--messages-log-fsync-batch", type=int, default=ServerGlobals.MESSAGES_LOG_FSYNC_BATCH,
+                        help="Messages written between fsyncs of the message log")
+    parser.add_argument("--messages-log-fsync-interval", type=float,
+                        default=ServerGlobals.MESSAGES_LOG_FSYNC_INTERVAL,
+                        help="Max seconds between fsyncs of the message log")
+    parser.add_argument("--http-port", type=int, default=ServerGlobals.HTTP_PORT)
+    parser.add_argument("--agents-port", type=int, default=ServerGlobals.AGENTS_PORT)
+    parser.add_argument("--cluster-node-id", help="Id of this node, enables the cluster mode")
+    parser.add_argument("--cluster-nodes", default="",
+                        help="Comma separated id=host:http_port:agents_port of every node, this one included")
+    parser.add_argument("--cluster-bus", help="tcp://host:port of the bus hub joining the nodes")
+    parser.add_argument("--cluster-bus-hub", help="host:port where this node runs the bus hub")
+    parser.add_argument("--loop", choices=LOOPS, default=ServerGlobals.EVENT_LOOP,
+                        help="Event loop, auto uses uvloop when it is installed")
+    parser.add_argument("--log-level", choices=LEVELS, default=ServerGlobals.LOG_LEVEL)
+    parser.add_argument("--log-file", default=ServerGlobals.LOG_FILE,
+                        help="Rotating log file, only the console if not set")
+    parser.add_argument("--log-rate-limit", type=float, default=ServerGlobals.LOG_RATE_LIMIT,
+                        help="Max records per second of the frames logger, 0 disables the limit")
+    parser.add_argument("--log-sample", type=int, default=ServerGlobals.LOG_SAMPLE,
+                        help="Only one of every N records of the stored messages logger is written")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Worker processes sharing the ports, they can't be nodes of a cluster")
+    args = parser.parse_args()
+    if args.workers > 1 and args.cluster_node_id is not None:
+        parser.error("--workers can't be used with --cluster-node-id")
+    if args.cluster_node_id is not None and not (args.cluster_bus or "").startswith(("tcp://", "unix://")):
+        # Every node is a process of its own, they only meet through a hub
+        parser.error("--cluster-node-id requires --cluster-bus tcp://host:port")
+    if args.messages_log_max_segments is not None and args.messages_log_max_segments < 1:
+        parser.error("--messages-log-max-segments must be at least 1")
+    return args
+
+
+def serve(args, worker: int = None, run_dir: str = None):
+    """Runs the server, or the worker `worker` of a server with --workers"""
+    if worker is not None and args.log_file is not None:
+        setup_logging(parse_level(args.log_level), worker_log_file(args.log_file, worker))
+    messages.set_limits(args.messages_max_count, args.messages_max_bytes)
+    if args.messages_log is not None:
+        log_path = Path(args.messages_log).expanduser()
+        if worker is not None:
+            # Every worker keeps its own copy of the messages
+            log_path = log_path / worker_id(worker)
+        message_log = MessageLog(
+            log_path,
+            segment_max_bytes=args.messages_log_segment_bytes,
+            max_segments=args.messages_log_max_segments,
+            fsync_batch=args.messages_log_fsync_batch,
+            fsync_interval=args.messages_log_fsync_interval,
+        )
+        message_log.open()
+        messages.attach_log(message_log)
+        app.on_startup.append(start_message_log)
+        app.on_cleanup.append(close_message_log)
+
     templates_folder = Path(__file__).parent / 'templates'
     aiohttp_jinja2.setup(app, loader=jinja2.FileSystemLoader(templates_folder))
     app.add_routes([
         web.get('/', index),
         web.post('/reset', reset),
         web.get('/messages', get_messages),
+        web.get('/messages/export', export_messages),
         web.post('/messages', add_messages),
+        web.post('/messages/bulk', add_messages_bulk),
         web.get('/ws', websocket_handler),
         web.post('/run', run_agent),
+        web.post('/run/group', run_group),
+        web.get('/run/group/{group_id}', get_run_group),
+        web.get('/runs', get_runs),
+        web.get('/runs/stats', get_run_stats),
+        web.get('/runs/{run_id}', get_run),
+        web.post('/runs/{run_id}/cancel', cancel_run),
         web.get('/agents', get_agents),
+        web.get('/metrics', metrics.get_metrics),
     ])
     app['websockets'] = {}
     app.on_shutdown.append(shutdown)
 
-    start_socket_server()
-    web.run_app(app)
+    site_options = {}
+    app['bus_hub'] = None
+    if worker is not None:
+        # The workers are the nodes of a cluster without sharding, each one
+        # also listens on a unix socket to get the requests of its agents
+        nodes = worker_nodes(args.workers, run_dir, args.http_port, args.agents_port)
+        cluster.configure(worker_id(worker), nodes, bus_url(run_dir), sharded=False)
+        site_options = dict(reuse_port=True, path=nodes[worker].unix_path)
+    elif args.cluster_node_id is not None:
+        nodes = [NodeAddress.parse(node) for node in args.cluster_nodes.split(",") if node.strip()]
+        cluster.configure(args.cluster_node_id, nodes, args.cluster_bus)
+        if args.cluster_bus_hub is not None:
+            host, port = args.cluster_bus_hub.rsplit(":", 1)
+            app['bus_hub'], app['bus_hub_address'] = BusHub(), (host, int(port))
+    if cluster.enabled:
+        runs.id_prefix = cluster.id_prefix
+        app.on_startup.append(start_cluster)
+        app.on_cleanup.append(close_cluster)
+
+    # The agents server starts and stops with the app, in the loop of run_app
+    app['agents_port'], app['reuse_port'] = args.agents_port, worker is not None
+    app.on_startup.append(start_agents_server)
+    app.on_shutdown.append(close_agents_server)
+    # run_app uses the loop of the thread, created with the installed policy
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    web.run_app(app, port=args.http_port, **site_options)
 
+
+if __name__ == '__main__':
+    args = parse_args()
+    setup_logging(parse_level(args.log_level), args.log_file)
+    setup_hot_path_logging(args.log_rate_limit, args.log_sample)
+    # Before any loop is created, the workers inherit the policy
+    logger.info("Using the %s event loop", event_loop.install(args.loop))
+    if args.workers > 1:
+        run_workers(args.workers, lambda index, run_dir: serve(args, index, run_dir))
+    else:
+        serve(args)
@@ -0,0 +1,80 @@
+from asyncio import Event
+from collections import OrderedDict
+from typing import Set
+
+from server.logger import get_logger
+
+logger = get_logger()
+
+SUBSCRIBER_BUFFER_SIZE = 256
+
+
+class Subscription:
+    """Bounded buffer of the events published since the last read.
+
+    Events published with the same key are coalesced, only the last one is
+    kept. When the buffer is full the oldest event is dropped, so a slow
+    subscriber never holds more than `maxsize` events."""
+
+    def __init__(self, broadcaster: 'Broadcaster', maxsize: int):
+        self.__broadcaster = broadcaster
+        self.__events = OrderedDict()
+        self.__ready = Event()
+        self.maxsize = maxsize
+        self.dropped = 0
+
+    def push(self, event, key=None):
+        if key is None:
+            key = object()
+        elif key in self.__events:
+            del self.__events[key]
+        self.__events[key] = event
+        if len(self.__events) > self.maxsize:
+            self.__events.popitem(last=False)
+            self.dropped += 1
+        self.__ready.set()
+
+    async def get(self):
+        while not self.__events:
+            self.__ready.clear()
+            await self.__ready.wait()
+        _, event = self.__events.popitem(last=False)
+        return event
+
+    def get_all(self) -> list:
+        events = list(self.__events.values())
+        self.__events.clear()
+        return events
+
+    def __len__(self):
+        return len(self.__events)
+
+    def close(self):
+        self.__broadcaster.unsubscribe(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class Broadcaster:
+    """Fan-out of events to every subscriber. Publishing never blocks and an
+    event published without subscribers is discarded."""
+
+    def __init__(self, buffer_size: int = SUBSCRIBER_BUFFER_SIZE):
+        self.buffer_size = buffer_size
+        self.subscriptions: Set[Subscription] = set()
+
+    def subscribe(self) -> Subscription:
+        subscription = Subscription(self, self.buffer_size)
+        self.subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        self.subscriptions.discard(subscription)
+
+    def publish(self, event, key=None):
+        for subscription in self.subscriptions:
+            subscription.push(event, key)
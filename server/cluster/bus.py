@@ -0,0 +1,241 @@
+import asyncio
+import socket
+from collections import deque
+from typing import Callable, Deque, Dict, Optional, Tuple
+
+from common.framing import FramingError, get_framer
+from common.writer import FramedWriter
+from server.logger import get_logger
+
+logger = get_logger()
+
+EventHandler = Callable[[dict], None]
+
+RECONNECT_DELAY = 0.5   # seconds, doubled up to RECONNECT_MAX_DELAY
+RECONNECT_MAX_DELAY = 10.0
+MAX_PENDING_EVENTS = 10 * 1000    # published while disconnected, the oldest are dropped
+MAX_BACKLOG_MESSAGES = 10 * 1000  # kept by the hub for the nodes (re)joining
+
+# Events sent back to their sender too, every node applies them in the same order
+SEQUENCED_EVENTS = ("messages", "reset")
+
+
+class Bus:
+    """Carries the cluster events between the server nodes. An event sent by
+    a node reaches every other node, not the sender, except the
+    SEQUENCED_EVENTS which reach every node."""
+
+    async def start(self, handler: EventHandler):
+        raise NotImplementedError("Must be implemented")
+
+    def publish(self, event: dict):
+        raise NotImplementedError("Must be implemented")
+
+    async def close(self):
+        raise NotImplementedError("Must be implemented")
+
+
+class StreamBus(Bus):
+    """Client of a BusHub, it reconnects when the hub goes away. Up to
+    `max_pending` events published while disconnected are sent after the
+    hello, the nodes also sync their agents again after connecting."""
+
+    def __init__(self, address: str, hello: Callable[[], dict], max_pending: int = MAX_PENDING_EVENTS):
+        self.address = address
+        self.hello = hello
+        self.__pending: Deque[dict] = deque(maxlen=max_pending)
+        self.dropped = 0
+        self.__sender: Optional[FramedWriter] = None
+        self.__task: Optional[asyncio.Task] = None
+        self.__framer = get_framer("json-lp")
+
+    async def open_connection(self) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+        raise NotImplementedError("Must be implemented")
+
+    async def start(self, handler: EventHandler):
+        self.__task = asyncio.ensure_future(self.__run(handler))
+
+    async def __run(self, handler: EventHandler):
+        delay = RECONNECT_DELAY
+        while True:
+            try:
+                reader, writer = await self.open_connection()
+            except OSError as e:
+                logger.warning("Can't connect to the cluster bus at %s: %s", self.address, e)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, RECONNECT_MAX_DELAY)
+                continue
+            delay = RECONNECT_DELAY
+            logger.info("Connected to the cluster bus at %s", self.address)
+            self.__sender = FramedWriter(writer, self.__framer)
+            self.__sender.write(self.hello())
+            self.__send_pending()
+            try:
+                event = await self.__framer.read(reader)
+                while event is not None:
+                    self.__handle(handler, event)
+                    event = await self.__framer.read(reader)
+            except (ConnectionError, FramingError, asyncio.IncompleteReadError) as e:
+                logger.warning("Cluster bus connection lost: %s", e)
+            finally:
+                self.__sender = None
+                writer.close()
+
+    @staticmethod
+    def __handle(handler: EventHandler, event: dict):
+        # A bad event is skipped, it never stops the bus
+        try:
+            handler(event)
+        except Exception:
+            logger.exception("Error handling the %s cluster event", event.get("type"))
+
+    def __send_pending(self):
+        if self.dropped:
+            logger.warning("Dropped %d cluster events published while disconnected", self.dropped)
+            self.dropped = 0
+        while self.__pending:
+            self.__sender.write(self.__pending.popleft())
+
+    def publish(self, event: dict):
+        if self.__sender is not None:
+            self.__sender.write(event)
+            return
+        if len(self.__pending) == self.__pending.maxlen:
+            self.dropped += 1
+        self.__pending.append(event)
+
+    async def close(self):
+        if self.__sender is not None:
+            # The events already published are sent first
+            await self.__sender.close()
+        if self.__task is not None:
+            self.__task.cancel()
+
+
+class TcpBus(StreamBus):
+
+    def __init__(self, host: str, port: int, hello: Callable[[], dict]):
+        super().__init__(f"{host}:{port}", hello)
+        self.host = host
+        self.port = port
+
+    async def open_connection(self) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+        return await asyncio.open_connection(self.host, self.port)
+
+
+class UnixBus(StreamBus):
+    """Bus of the workers of a server, the hub runs in their parent process"""
+
+    def __init__(self, path: str, hello: Callable[[], dict]):
+        super().__init__(path, hello)
+        self.path = path
+
+    async def open_connection(self) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+        return await asyncio.open_unix_connection(self.path)
+
+
+class BusHub:
+    """Fans out the events of every connected node to the others. The first
+    event of a node is its hello, with its id; when the node disconnects the
+    hub sends a node_down event for it.
+
+    The hub gives the messages their ids, so they are the same in every
+    node: a messages event gets the `first_id` of its messages and, like a
+    reset, is sent to every node in the order of the hub. The events of the
+    last `backlog` messages are kept, a node joining gets the ones after the
+    `last_message_id` of its hello."""
+
+    def __init__(self, backlog: int = MAX_BACKLOG_MESSAGES):
+        self.backlog = backlog
+        self.last_message_id = 0
+        self.__nodes: Dict[FramedWriter, Optional[str]] = {}
+        self.__framer = get_framer("json-lp")
+        self.__backlog: Deque[dict] = deque()
+        self.__backlog_messages = 0
+        self.server = None
+
+    async def start(self, host: str, port: int):
+        self.server = await asyncio.start_server(self.__handle, host, port)
+        logger.info("Cluster bus hub listening on %s:%d", host, port)
+
+    async def start_unix(self, sock: socket.socket):
+        """Listens on a unix socket already bound, so the workers forked
+        before the hub started find it"""
+        self.server = await asyncio.start_unix_server(self.__handle, sock=sock)
+        logger.info("Cluster bus hub listening on %s", sock.getsockname())
+
+    def __broadcast(self, event: dict, sender: Optional[FramedWriter]):
+        # A node gets nothing before its hello, that sets where its backlog starts
+        for node, node_id in self.__nodes.items():
+            if node is not sender and node_id is not None:
+                node.write(event)
+
+    def __sequence(self, event: dict):
+        if event["type"] == "messages":
+            event["first_id"] = self.last_message_id + 1
+            self.last_message_id += len(event["messages"])
+            self.__backlog_messages += len(event["messages"])
+        else:
+            event["after_id"] = self.last_message_id
+        self.__backlog.append(event)
+        while self.__backlog_messages > self.backlog:
+            self.__backlog_messages -= len(self.__backlog.popleft().get("messages", ()))
+
+    def __join(self, node: FramedWriter, hello: dict):
+        last_id = hello.get("last_message_id", 0)
+        # A hub started again goes on from the ids of the nodes
+        self.last_message_id = max(self.last_message_id, last_id)
+        for event in self.__backlog:
+            if event["type"] == "messages":
+                missed = event["first_id"] + len(event["messages"]) - 1 > last_id
+            else:
+                # A reset applied twice changes nothing
+                missed = event["after_id"] >= last_id
+            if missed:
+                node.write(event)
+
+    async def __wait_nodes(self):
+        # A slow node stops the reading of every node, so the hub memory is bounded
+        for node in list(self.__nodes):
+            await node.wait_writable()
+
+    async def __handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        node = FramedWriter(writer, self.__framer)
+        self.__nodes[node] = None
+        try:
+            event = await self.__framer.read(reader)
+            while event is not None:
+                await self.__wait_nodes()
+                kind = event.get("type")
+                if kind == "hello":
+                    self.__join(node, event)
+                    self.__nodes[node] = event.get("node")
+                if kind in SEQUENCED_EVENTS:
+                    self.__sequence(event)
+                self.__broadcast(event, None if kind in SEQUENCED_EVENTS else node)
+                event = await self.__framer.read(reader)
+        except (ConnectionError, FramingError, asyncio.IncompleteReadError) as e:
+            logger.warning("Cluster node connection lost: %s", e)
+        node_id = self.__nodes.pop(node)
+        if node_id is not None:
+            self.__broadcast({"type": "node_down", "node": node_id}, None)
+        writer.close()
+
+    async def close(self):
+        for node in self.__nodes:
+            node.writer.close()
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+
+
+def create_bus(url: str, hello: Callable[[], dict]) -> Bus:
+    """"tcp://host:port" or "unix:///path" of a BusHub. A process hosts a
+    single node, its state is in module globals, so there is no in-process
+    bus."""
+    if url.startswith("tcp://"):
+        host, port = url[len("tcp://"):].rsplit(":", 1)
+        return TcpBus(host, int(port), hello)
+    if url.startswith("unix://"):
+        return UnixBus(url[len("unix://"):], hello)
+    raise ValueError(f"Unsupported cluster bus {url}")
@@ -0,0 +1,171 @@
+import asyncio
+from typing import Callable, Dict, List, Optional, Tuple
+
+from aiohttp import ClientSession, ClientError, UnixConnector
+
+from server.cluster.bus import Bus, EventHandler, create_bus
+from server.cluster.hash_ring import HashRing
+from server.logger import get_logger
+from server.models import Agent
+
+logger = get_logger()
+
+# Set on the requests sent to another node, that never forwards them again
+FORWARDED_HEADER = "X-Cluster-Forwarded-By"
+NODE_UNREACHABLE = b'{"error": "The cluster node is not reachable"}'
+
+
+class NodeAddress:
+
+    def __init__(self, node_id: str, host: str, http_port: int, agents_port: int, unix_path: str = None):
+        self.id = node_id
+        self.host = host
+        self.http_port = http_port
+        self.agents_port = agents_port
+        # Workers share their ports, each one is reached by its own socket
+        self.unix_path = unix_path
+
+    @classmethod
+    def parse(cls, value: str) -> "NodeAddress":
+        """From "id=host:http_port:agents_port\""""
+        try:
+            node_id, address = value.split("=", 1)
+            host, http_port, agents_port = address.rsplit(":", 2)
+            return cls(node_id.strip(), host, int(http_port), int(agents_port))
+        except ValueError:
+            raise ValueError(f"Invalid cluster node {value}, expected id=host:http_port:agents_port")
+
+    def __str__(self):
+        return f"Node[id:{self.id}, {self.host}:{self.http_port}/{self.agents_port}]"
+
+
+class Cluster:
+    """The other server nodes. Agents are assigned to a node by consistent
+    hashing of their name; the nodes share the new messages and the state of
+    their agents through the bus, so every dashboard shows all of them. The
+    messages get their ids from the bus hub, any node serves their pages.
+
+    Workers of one server are not sharded: they share the ports, and an agent
+    belongs to the worker it connected to.
+
+    Without configure() the server runs alone and owns every agent."""
+
+    def __init__(self):
+        self.node_id: Optional[str] = None
+        self.nodes: Dict[str, NodeAddress] = {}
+        self.ring: Optional[HashRing] = None
+        self.bus: Optional[Bus] = None
+        self.remote_agents: Dict[str, Agent] = {}
+        self.__remote_agent_nodes: Dict[str, str] = {}
+        self.__sessions: Dict[str, ClientSession] = {}
+        self.__last_message_id: Callable[[], int] = lambda: 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.bus is not None
+
+    def configure(self, node_id: str, nodes: List[NodeAddress], bus_url: str, sharded: bool = True):
+        self.nodes = {node.id: node for node in nodes}
+        if node_id not in self.nodes:
+            raise ValueError(f"The node {node_id} is not in the cluster nodes")
+        self.node_id = node_id
+        self.ring = HashRing(self.nodes) if sharded else None
+        self.bus = create_bus(bus_url, self.hello)
+
+    @property
+    def sharded(self) -> bool:
+        return self.ring is not None
+
+    def hello(self) -> dict:
+        return {"type": "hello", "node": self.node_id, "last_message_id": self.__last_message_id()}
+
+    async def start(self, handler: EventHandler, last_message_id: Callable[[], int]):
+        """Joins the bus, the hub sends the messages after `last_message_id()`"""
+        self.__last_message_id = last_message_id
+        shared = None
+        for node in self.nodes.values():
+            if node.unix_path:
+                self.__sessions[node.id] = ClientSession(connector=UnixConnector(node.unix_path))
+            else:
+                shared = shared or ClientSession()
+                self.__sessions[node.id] = shared
+        await self.bus.start(handler)
+        logger.info("Node %s of a cluster of %d nodes", self.node_id, len(self.nodes))
+
+    async def close(self):
+        await self.bus.close()
+        for session in set(self.__sessions.values()):
+            await session.close()
+
+    def owner(self, agent_name: str) -> Optional[NodeAddress]:
+        """The node of the agent when sharded, None otherwise"""
+        if not self.sharded:
+            return None
+        return self.nodes[self.ring.node_for(agent_name)]
+
+    def owns(self, agent_name: str) -> bool:
+        owner = self.owner(agent_name)
+        return owner is None or owner.id == self.node_id
+
+    @property
+    def id_prefix(self) -> str:
+        """Prefix of the ids of the runs created by this node"""
+        return f"{self.node_id}." if self.enabled else ""
+
+    def node_of_id(self, object_id: str) -> Optional[NodeAddress]:
+        """The node that created a run, from the prefix of its id"""
+        node_id, separator, _ = object_id.rpartition(".")
+        return self.nodes.get(node_id) if separator else None
+
+    def remote_agents_named(self, agent_name: str, addr: str = None) -> List[Tuple[str, NodeAddress]]:
+        """The address and node of the agents of the other nodes with the
+        name, and with the "host:port" address if given"""
+        return [
+            (agent_addr, self.nodes[self.__remote_agent_nodes[agent_addr]])
+            for agent_addr, agent in self.remote_agents.items()
+            if agent.name == agent_name and (addr is None or agent_addr == addr)
+            and self.__remote_agent_nodes[agent_addr] in self.nodes
+        ]
+
+    def publish(self, event_type: str, **payload):
+        if self.enabled:
+            self.bus.publish({"type": event_type, "node": self.node_id, **payload})
+
+    def remote_agent_changed(self, node_id: str, addr: str, data: Optional[dict]):
+        if data is None:
+            self.remote_agents.pop(addr, None)
+            self.__remote_agent_nodes.pop(addr, None)
+        else:
+            self.remote_agents[addr] = Agent.from_dict(data)
+            self.__remote_agent_nodes[addr] = node_id
+
+    def node_down(self, node_id: str) -> List[str]:
+        """Forgets the agents of a node that left, returns their addresses"""
+        addrs = [addr for addr, node in self.__remote_agent_nodes.items() if node == node_id]
+        for addr in addrs:
+            self.remote_agent_changed(node_id, addr, None)
+        return addrs
+
+    def request(self, node: NodeAddress, path: str, body: bytes = None, method: str = "POST"):
+        """Sends a request to another node, the response is a context manager"""
+        if node.unix_path:
+            url = f"http://localhost{path}"
+        else:
+            url = f"http://{node.host}:{node.http_port}{path}"
+        headers = {"Content-Type": "application/json", FORWARDED_HEADER: self.node_id}
+        return self.__sessions[node.id].request(method, url, data=body, headers=headers)
+
+    async def forward(self, node: NodeAddress, path: str, body: bytes = None,
+                      method: str = "POST") -> Tuple[int, bytes, str]:
+        """Sends a request to another node, returns its response"""
+        try:
+            async with self.request(node, path, body, method) as res:
+                return res.status, await res.read(), res.content_type
+        except ClientError as e:
+            logger.error("Error forwarding %s to %s: %s", path, node, e)
+            return 502, NODE_UNREACHABLE, "application/json"
+
+    async def fan_out(self, path: str, body: bytes = None, method: str = "GET") -> List[Tuple[int, bytes, str]]:
+        """Sends a request to every other node, returns their responses"""
+        others = [node for node in self.nodes.values() if node.id != self.node_id]
+        return await asyncio.gather(*(self.forward(node, path, body, method) for node in others))
@@ -0,0 +1,36 @@
+import hashlib
+from bisect import bisect
+from typing import Iterable, List, Tuple
+
+
+def hash_key(key: str) -> int:
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big')
+
+
+class HashRing:
+    """Consistent hashing of keys to nodes. Every node has `replicas` points
+    in the ring, so adding or removing a node only moves the keys of that
+    node."""
+
+    def __init__(self, nodes: Iterable[str] = (), replicas: int = 100):
+        self.replicas = replicas
+        self.__points: List[Tuple[int, str]] = []
+        for node in nodes:
+            self.add(node)
+
+    @property
+    def nodes(self) -> List[str]:
+        return sorted({node for _, node in self.__points})
+
+    def add(self, node: str):
+        self.__points.extend((hash_key(f"{node}#{replica}"), node) for replica in range(self.replicas))
+        self.__points.sort()
+
+    def remove(self, node: str):
+        self.__points = [point for point in self.__points if point[1] != node]
+
+    def node_for(self, key: str) -> str:
+        if not self.__points:
+            raise LookupError("The ring has no nodes")
+        position = bisect(self.__points, (hash_key(key), "")) % len(self.__points)
+        return self.__points[position][1]
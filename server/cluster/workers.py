@@ -0,0 +1,108 @@
+import asyncio
+import multiprocessing
+import os
+import shutil
+import signal
+import socket
+import tempfile
+from multiprocessing.connection import wait
+from pathlib import Path
+from typing import Callable, List
+
+from server.cluster.bus import BusHub
+from server.cluster.cluster import NodeAddress
+from server.logger import get_logger
+
+logger = get_logger()
+
+BUS_SOCKET = "bus.sock"
+STOP_TIMEOUT = 10   # seconds a worker has to close before being killed
+
+WorkerMain = Callable[[int, str], None]
+
+
+def worker_id(index: int) -> str:
+    return f"worker-{index}"
+
+
+def worker_nodes(count: int, run_dir: str, http_port: int, agents_port: int) -> List[NodeAddress]:
+    return [
+        NodeAddress(worker_id(index), "localhost", http_port, agents_port,
+                    unix_path=os.path.join(run_dir, f"{worker_id(index)}.sock"))
+        for index in range(count)
+    ]
+
+
+def worker_log_file(log_file: str, index: int) -> Path:
+    """The log file of a worker, e.g. server.worker-0.log for server.log. A
+    file rotated by many processes loses records."""
+    path = Path(log_file)
+    return path.with_name(f"{path.stem}.{worker_id(index)}{path.suffix}")
+
+
+def bus_url(run_dir: str) -> str:
+    return f"unix://{os.path.join(run_dir, BUS_SOCKET)}"
+
+
+def _worker(worker_main: WorkerMain, index: int, run_dir: str, hub_socket: socket.socket):
+    hub_socket.close()
+    # Out of the group of the parent, a Ctrl+C only reaches the parent, that
+    # stops the workers
+    os.setpgrp()
+    worker_main(index, run_dir)
+
+
+async def _run_hub(hub_socket: socket.socket, processes: List[multiprocessing.Process]):
+    hub = BusHub()
+    await hub.start_unix(hub_socket)
+
+    loop = asyncio.get_event_loop()
+    stop = asyncio.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop.set)
+    # A worker exiting stops the server, it is not forked again from a
+    # process with a running loop
+    worker_exited = loop.run_in_executor(None, wait, [process.sentinel for process in processes])
+    stop_requested = asyncio.ensure_future(stop.wait())
+    await asyncio.wait([worker_exited, stop_requested], return_when=asyncio.FIRST_COMPLETED)
+    if worker_exited.done():
+        logger.error("A worker exited, stopping the server")
+    stop_requested.cancel()
+
+    for process in processes:
+        if process.is_alive():
+            process.terminate()
+    await loop.run_in_executor(None, _join, processes)
+    await hub.close()
+
+
+def _join(processes: List[multiprocessing.Process]):
+    for process in processes:
+        process.join(STOP_TIMEOUT)
+        if process.is_alive():
+            logger.warning("Killing %s", process.name)
+            process.kill()
+            process.join()
+
+
+def run_workers(count: int, worker_main: WorkerMain):
+    """Forks `count` workers running `worker_main(index, run_dir)`, and runs
+    in this process the hub of the bus joining them"""
+    run_dir = tempfile.mkdtemp(prefix="asyncio-server-")
+    hub_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    hub_socket.bind(os.path.join(run_dir, BUS_SOCKET))
+    hub_socket.listen()
+
+    # The workers are forked before this process starts its loop
+    context = multiprocessing.get_context("fork")
+    processes = [
+        context.Process(target=_worker, args=(worker_main, index, run_dir, hub_socket), name=worker_id(index))
+        for index in range(count)
+    ]
+    for process in processes:
+        process.start()
+    logger.info("Started %d workers", count)
+    try:
+        asyncio.run(_run_hub(hub_socket, processes))
+    finally:
+        shutil.rmtree(run_dir, ignore_errors=True)
@@ -0,0 +1,24 @@
+class ServerGlobals:
+
+    HTTP_PORT = 8080
+    AGENTS_PORT = 8888
+    EVENT_LOOP = "auto"
+
+    LOG_LEVEL = "DEBUG"
+    LOG_FILE = None
+    LOG_RATE_LIMIT = 100    # records per second of the frames logger
+    LOG_SAMPLE = 100        # one of every N records of the messages logger
+    AGENTS_MAX_FRAME_SIZE = 64 * 1024 * 1024
+    AGENTS_WRITE_HIGH_WATER = 1024 * 1024
+    AGENTS_WRITE_LOW_WATER = 256 * 1024
+
+    MESSAGES_MAX_COUNT = 100 * 1000
+    MESSAGES_MAX_BYTES = None
+    MESSAGES_PAGE_SIZE = 500
+    MESSAGES_MAX_PAGE_SIZE = 10 * 1000
+
+    MESSAGES_LOG_PATH = None
+    MESSAGES_LOG_SEGMENT_BYTES = 64 * 1024 * 1024
+    MESSAGES_LOG_MAX_SEGMENTS = None
+    MESSAGES_LOG_FSYNC_BATCH = 10 * 1000
+    MESSAGES_LOG_FSYNC_INTERVAL = 1.0
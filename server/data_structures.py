@@ -1,8 +1,14 @@
-from typing import Dict
-from server.models import Agent
-
-from asyncio import Queue
-
-agents: Dict[tuple, Agent] = {}
-update_websocket_queue: Queue = Queue()
+from server.broadcaster import Broadcaster
+from server.cluster.cluster import Cluster
+from server.config import ServerGlobals
+from server.message_store import MessageStore
+from server.registry import AgentRegistry
+from server.run_groups import RunGroups
+from server.runs import RunTracker
 
+agents: AgentRegistry = AgentRegistry()
+messages: MessageStore = MessageStore(ServerGlobals.MESSAGES_MAX_COUNT, ServerGlobals.MESSAGES_MAX_BYTES)
+update_broadcaster: Broadcaster = Broadcaster()
+run_groups: RunGroups = RunGroups()
+runs: RunTracker = RunTracker()
+cluster: Cluster = Cluster()
@@ -32,4 +32,9 @@ class ObjectNotFound(AdminRESTError):
 
 class JsonValidaitonError(AdminRESTError):
     status_code = 400
-    error = 'Invalid json payload'
\ No newline at end of file
+    error = 'Invalid json payload'
+
+
+class QueryValidationError(AdminRESTError):
+    status_code = 400
+    error = 'Invalid query parameter'
\ No newline at end of file
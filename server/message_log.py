@@ -0,0 +1,315 @@
+import asyncio
+import mmap
+import os
+import struct
+from array import array
+from bisect import bisect_left, bisect_right
+from pathlib import Path
+from typing import Iterator, List, Optional, Tuple
+
+from server.logger import get_logger
+
+logger = get_logger()
+
+RECORD_HEADER = struct.Struct('>QI')    # message id, payload length
+INDEX_ENTRY = struct.Struct('>QQ')      # message id, offset of the record in the segment
+
+
+def fsync_files(fds: List[int]):
+    """Fsyncs and closes the descriptors, run in a thread out of the loop"""
+    try:
+        for fd in fds:
+            os.fsync(fd)
+    finally:
+        for fd in fds:
+            os.close(fd)
+
+
+class Segment:
+    """A log file and its offset index. The file name is the id of its first
+    message, so segments sort by name."""
+
+    def __init__(self, log_path: Path, first_id: int):
+        self.first_id = first_id
+        self.log_path = log_path / f"{first_id:020d}.log"
+        self.index_path = log_path / f"{first_id:020d}.idx"
+        self.ids = array('Q')
+        self.offsets = array('Q')
+        self.size = 0
+        self.__log_file = None
+        self.__index_file = None
+        self.__mmap: Optional[mmap.mmap] = None
+
+    def load(self):
+        self.size = self.log_path.stat().st_size if self.log_path.exists() else 0
+        if self.index_path.exists():
+            with open(self.index_path, 'rb') as index_file:
+                raw = index_file.read()
+            for position in range(0, len(raw) - len(raw) % INDEX_ENTRY.size, INDEX_ENTRY.size):
+                message_id, offset = INDEX_ENTRY.unpack_from(raw, position)
+                self.ids.append(message_id)
+                self.offsets.append(offset)
+        self.__recover()
+
+    def __recover(self):
+        # The log and the index are buffered separately, so after a crash the
+        # index can point past the end of the log. Those entries and the last
+        # valid one are dropped, and the records from there on are scanned
+        # again, so missing index entries are rebuilt and a partially written
+        # record at the end of the file is truncated
+        valid = bisect_left(self.offsets, self.size)
+        del self.ids[valid:]
+        del self.offsets[valid:]
+        offset = self.offsets.pop() if self.offsets else 0
+        if self.ids:
+            self.ids.pop()
+        if self.index_path.exists():
+            os.truncate(self.index_path, len(self.ids) * INDEX_ENTRY.size)
+        recovered = []
+        with open(self.log_path, 'rb') as log_file:
+            log_file.seek(offset)
+            while True:
+                header = log_file.read(RECORD_HEADER.size)
+                if len(header) < RECORD_HEADER.size:
+                    break
+                message_id, length = RECORD_HEADER.unpack(header)
+                if len(log_file.read(length)) < length:
+                    break
+                recovered.append((message_id, offset))
+                offset += RECORD_HEADER.size + length
+        if offset < self.size:
+            logger.warning("Truncating partial record at the end of %s", self.log_path)
+            os.truncate(self.log_path, offset)
+            self.size = offset
+        with open(self.index_path, 'ab') as index_file:
+            for message_id, record_offset in recovered:
+                index_file.write(INDEX_ENTRY.pack(message_id, record_offset))
+                self.ids.append(message_id)
+                self.offsets.append(record_offset)
+
+    def open_for_append(self):
+        self.__log_file = open(self.log_path, 'ab')
+        self.__index_file = open(self.index_path, 'ab')
+
+    def append(self, message_id: int, payload: bytes):
+        self.__log_file.write(RECORD_HEADER.pack(message_id, len(payload)))
+        self.__log_file.write(payload)
+        self.__index_file.write(INDEX_ENTRY.pack(message_id, self.size))
+        self.ids.append(message_id)
+        self.offsets.append(self.size)
+        self.size += RECORD_HEADER.size + len(payload)
+
+    def flush(self):
+        if self.__log_file is None:
+            return
+        self.__log_file.flush()
+        self.__index_file.flush()
+
+    def sync_files(self) -> List[int]:
+        """Flushes the buffers and returns duplicates of the descriptors of
+        the files for fsync_files(), which work even once the files are
+        closed"""
+        if self.__log_file is None:
+            return []
+        self.flush()
+        return [os.dup(self.__log_file.fileno()), os.dup(self.__index_file.fileno())]
+
+    def seal(self):
+        self.flush()
+        self.__log_file.close()
+        self.__index_file.close()
+        self.__log_file = self.__index_file = None
+
+    @property
+    def last_id(self) -> int:
+        return self.ids[-1] if self.ids else self.first_id - 1
+
+    def __view(self) -> mmap.mmap:
+        if self.__mmap is None or len(self.__mmap) < self.size:
+            # The active segment grows, it is mapped again when needed
+            self.flush()
+            if self.__mmap is not None:
+                self.__mmap.close()
+            with open(self.log_path, 'rb') as log_file:
+                self.__mmap = mmap.mmap(log_file.fileno(), self.size, access=mmap.ACCESS_READ)
+        return self.__mmap
+
+    def read(self, position: int) -> Tuple[int, bytes]:
+        view = self.__view()
+        message_id, length = RECORD_HEADER.unpack_from(view, self.offsets[position])
+        start = self.offsets[position] + RECORD_HEADER.size
+        return message_id, view[start:start + length]
+
+    def close(self):
+        if self.__log_file is not None:
+            self.seal()
+        if self.__mmap is not None:
+            self.__mmap.close()
+            self.__mmap = None
+
+    def delete(self):
+        self.close()
+        self.log_path.unlink()
+        if self.index_path.exists():
+            self.index_path.unlink()
+
+
+class MessageLog:
+    """Append-only log of json encoded messages split in segment files.
+
+    Writes are buffered and fsync'ed every `fsync_batch` messages, or every
+    `fsync_interval` seconds, by the flusher task in a thread of the default
+    executor. When the active segment reaches `segment_max_bytes` a new one
+    is started, and the oldest segments are deleted when there are more than
+    `max_segments`."""
+
+    def __init__(self, path: Path, segment_max_bytes: int = 64 * 1024 * 1024, max_segments: int = None,
+                 fsync_batch: int = 10 * 1000, fsync_interval: float = 1.0):
+        if max_segments is not None and max_segments < 1:
+            raise ValueError("The message log keeps at least one segment")
+        self.path = Path(path)
+        self.segment_max_bytes = segment_max_bytes
+        self.max_segments = max_segments
+        self.fsync_batch = fsync_batch
+        self.fsync_interval = fsync_interval
+        self.segments: List[Segment] = []
+        self.__first_ids: List[int] = []
+        self.__unsynced = 0
+        # Duplicated descriptors of the files written since the last fsync
+        self.__unsynced_files: List[int] = []
+        self.__wakeup: Optional[asyncio.Event] = None
+
+    def open(self):
+        self.path.mkdir(parents=True, exist_ok=True)
+        for log_path in sorted(self.path.glob('*.log')):
+            segment = Segment(self.path, int(log_path.stem))
+            segment.load()
+            self.segments.append(segment)
+        if not self.segments:
+            self.segments.append(Segment(self.path, 1))
+        self.segments[-1].open_for_append()
+        self.__first_ids = [segment.first_id for segment in self.segments]
+        logger.info("Message log opened at %s with %d segments, last id %d",
+                    self.path, len(self.segments), self.last_id)
+
+    @property
+    def first_id(self) -> int:
+        return self.segments[0].first_id
+
+    @property
+    def last_id(self) -> int:
+        for segment in reversed(self.segments):
+            if segment.ids:
+                return segment.last_id
+        return self.segments[-1].first_id - 1
+
+    def append(self, message_id: int, payload: bytes):
+        active = self.segments[-1]
+        if active.size >= self.segment_max_bytes:
+            active = self.__rotate(message_id)
+        active.append(message_id, payload)
+        self.__unsynced += 1
+        if self.__unsynced >= self.fsync_batch:
+            self.__request_sync()
+
+    def __request_sync(self):
+        if self.__wakeup is not None:
+            self.__wakeup.set()
+        else:
+            # No flusher running in a loop, e.g. in a script
+            fsync_files(self.__take_unsynced())
+
+    def __take_unsynced(self) -> List[int]:
+        if self.__unsynced:
+            self.__unsynced_files.extend(self.segments[-1].sync_files())
+            self.__unsynced = 0
+        files, self.__unsynced_files = self.__unsynced_files, []
+        return files
+
+    async def sync(self):
+        """Flushes the buffers, the fsync runs in a thread so the loop never
+        waits for the disk"""
+        files = self.__take_unsynced()
+        if files:
+            await asyncio.get_event_loop().run_in_executor(None, fsync_files, files)
+
+    def __rotate(self, next_id: int) -> Segment:
+        # The sealed segment is fsync'ed with the next sync
+        self.__unsynced_files.extend(self.segments[-1].sync_files())
+        self.__unsynced = 0
+        self.segments[-1].seal()
+        segment = Segment(self.path, next_id)
+        segment.open_for_append()
+        self.segments.append(segment)
+        self.__first_ids.append(next_id)
+        self.compact()
+        self.__request_sync()
+        return segment
+
+    def compact(self):
+        """Deletes the oldest segments exceeding max_segments"""
+        if self.max_segments is None:
+            return
+        while len(self.segments) > self.max_segments:
+            segment = self.segments.pop(0)
+            self.__first_ids.pop(0)
+            logger.info("Deleting segment %s", segment.log_path)
+            segment.delete()
+
+    def clear(self, next_id: int):
+        """Deletes every segment, the new messages start at next_id"""
+        for segment in self.segments:
+            segment.delete()
+        self.segments = [Segment(self.path, next_id)]
+        self.segments[0].open_for_append()
+        self.__first_ids = [next_id]
+        self.__unsynced = 0
+
+    def read_after(self, after_id: int, limit: int) -> List[Tuple[int, bytes]]:
+        records = []
+        segment_position = max(bisect_right(self.__first_ids, after_id + 1) - 1, 0)
+        for segment in self.segments[segment_position:]:
+            position = bisect_left(segment.ids, after_id + 1)
+            while position < len(segment.ids) and len(records) < limit:
+                records.append(segment.read(position))
+                position += 1
+            if len(records) >= limit:
+                break
+        return records
+
+    def read_tail(self, limit: int) -> Iterator[Tuple[int, bytes]]:
+        """Replays the last `limit` messages, oldest first"""
+        selected = []
+        remaining = limit
+        for segment in reversed(self.segments):
+            if remaining <= 0:
+                break
+            count = min(remaining, len(segment.ids))
+            selected.append((segment, len(segment.ids) - count))
+            remaining -= count
+        for segment, start in reversed(selected):
+            for position in range(start, len(segment.ids)):
+                yield segment.read(position)
+
+    async def run_flusher(self):
+        # Created here, in the loop running the flusher
+        self.__wakeup = asyncio.Event()
+        try:
+            while True:
+                try:
+                    await asyncio.wait_for(self.__wakeup.wait(), self.fsync_interval)
+                except asyncio.TimeoutError:
+                    pass
+                self.__wakeup.clear()
+                try:
+                    await self.sync()
+                except OSError as e:
+                    # The flusher keeps running, the next batches are fsync'ed
+                    logger.error("Can't fsync the message log at %s: %s", self.path, e)
+        finally:
+            self.__wakeup = None
+
+    def close(self):
+        fsync_files(self.__take_unsynced())
+        for segment in self.segments:
+            segment.close()
@@ -0,0 +1,182 @@
+import sys
+from typing import Iterator, List, Optional
+
+from common import codec
+from server.logger import get_logger
+from server.message_log import MessageLog
+
+logger = get_logger()
+
+
+class StoredMessage:
+    """A message in memory. msg and color, required by the output schema, are
+    slots; any other key goes to `extra`, which is None for most messages."""
+
+    __slots__ = ('id', 'msg', 'color', 'extra', 'size')
+
+    def __init__(self, message_id: int, message: dict, size: int = 0):
+        self.id = message_id
+        self.msg = message.get('msg')
+        color = message.get('color')
+        # There are a few colors, all the messages share the same strings
+        self.color = sys.intern(color) if isinstance(color, str) else color
+        extra = {key: value for key, value in message.items() if key not in ('msg', 'color', 'id')}
+        self.extra = extra or None
+        self.size = size
+
+    def to_dict(self) -> dict:
+        message = {'msg': self.msg, 'color': self.color}
+        if self.extra is not None:
+            message.update(self.extra)
+        message['id'] = self.id
+        return message
+
+
+class MessageStore:
+    """Ring buffer of the messages received by the server.
+
+    Every message gets a monotonically increasing id, ids are never reused
+    even after a reset. When `max_count` messages or `max_bytes` bytes of
+    json are exceeded the oldest messages are evicted.
+
+    With a MessageLog attached every message is also written to disk, and the
+    messages evicted from memory are read from the log."""
+
+    def __init__(self, max_count: int = None, max_bytes: int = None):
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        # Evicted slots are set to None and compacted once they are the half
+        # of the list, so eviction and lookups by id are O(1)
+        self.__items: List[Optional[StoredMessage]] = []
+        self.__start = 0
+        self.__next_id = 1
+        self.size_bytes = 0
+        self.log: Optional[MessageLog] = None
+
+    def attach_log(self, log: MessageLog):
+        """Uses an opened log as backend, loading its last messages in memory"""
+        self.log = log
+        self.__next_id = max(self.__next_id, log.last_id + 1)
+        replay = self.max_count if self.max_count is not None else 10 * 1000
+        for message_id, payload in log.read_tail(replay):
+            size = len(payload) if self.max_bytes is not None else 0
+            self.__items.append(StoredMessage(message_id, codec.loads(payload), size))
+            self.size_bytes += size
+        self.__evict()
+
+    def set_limits(self, max_count: int = None, max_bytes: int = None):
+        if max_bytes is not None and self.max_bytes is None:
+            # Sizes are only computed while there is a bytes limit
+            for item in self.__items[self.__start:]:
+                message = item.to_dict()
+                del message['id']
+                item.size = len(codec.dumps(message))
+            self.size_bytes = sum(item.size for item in self.__items[self.__start:])
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        self.__evict()
+
+    @property
+    def first_id(self) -> int:
+        if len(self) == 0:
+            return self.__next_id
+        return self.__items[self.__start].id
+
+    @property
+    def oldest_id(self) -> int:
+        """Id of the oldest message available, in memory or in the log"""
+        if self.log is not None and self.log.last_id >= self.log.first_id:
+            return min(self.log.first_id, self.first_id)
+        return self.first_id
+
+    @property
+    def last_id(self) -> int:
+        return self.__next_id - 1
+
+    def __len__(self):
+        return len(self.__items) - self.__start
+
+    def append(self, message: dict) -> int:
+        message_id = self.__next_id
+        self.__next_id += 1
+        size = 0
+        if self.max_bytes is not None or self.log is not None:
+            payload = codec.dumps(message)
+            size = len(payload) if self.max_bytes is not None else 0
+            if self.log is not None:
+                self.log.append(message_id, payload)
+        self.__items.append(StoredMessage(message_id, message, size))
+        self.size_bytes += size
+        self.__evict()
+        return message_id
+
+    def extend(self, messages: List[dict], first_id: int = None) -> List[int]:
+        """Stores the messages, with consecutive ids from `first_id` if given.
+        Those ids are given by the cluster: the messages already stored are
+        skipped, and after a gap the ids go on from `first_id`"""
+        if first_id is not None:
+            stored = self.__next_id - first_id
+            if stored > 0:
+                messages = messages[stored:]
+            elif stored < 0:
+                self.__skip_to(first_id)
+        return [self.append(message) for message in messages]
+
+    def __skip_to(self, next_id: int):
+        # The ids in memory are consecutive, the messages there are dropped
+        # but the ones in the log are still read from it
+        logger.warning("Missed the messages %d to %d", self.__next_id, next_id - 1)
+        self.__items = []
+        self.__start = 0
+        self.size_bytes = 0
+        self.__next_id = next_id
+
+    def clear(self):
+        self.__items = []
+        self.__start = 0
+        self.size_bytes = 0
+        if self.log is not None:
+            self.log.clear(self.__next_id)
+
+    def __evict(self):
+        while len(self) > 0 and (
+                (self.max_count is not None and len(self) > self.max_count)
+                or (self.max_bytes is not None and self.size_bytes > self.max_bytes)):
+            self.size_bytes -= self.__items[self.__start].size
+            self.__items[self.__start] = None
+            self.__start += 1
+        if self.__start > 1024 and self.__start * 2 > len(self.__items):
+            del self.__items[:self.__start]
+            self.__start = 0
+
+    def after(self, after_id: int, limit: int) -> List[dict]:
+        """Returns up to `limit` messages with id greater than `after_id`"""
+        if self.log is not None and after_id + 1 < self.first_id:
+            # The oldest part of the page was evicted from memory
+            page = [
+                {**codec.loads(payload), 'id': message_id}
+                for message_id, payload in self.log.read_after(after_id, min(limit, self.first_id - after_id - 1))
+                if message_id < self.first_id
+            ]
+            if len(page) < limit:
+                page += self.after(self.first_id - 1, limit - len(page))
+            return page
+        position = self.__start + max(after_id + 1 - self.first_id, 0)
+        return [item.to_dict() for item in self.__items[position:position + limit]]
+
+    def tail(self, limit: int) -> List[dict]:
+        """Returns the last `limit` messages"""
+        position = max(len(self.__items) - limit, self.__start)
+        return [item.to_dict() for item in self.__items[position:]]
+
+    def get(self, message_id: int) -> Optional[dict]:
+        if self.log is not None and message_id < self.first_id:
+            found = self.after(message_id - 1, 1)
+            return found[0] if found and found[0]['id'] == message_id else None
+        if not self.first_id <= message_id <= self.last_id:
+            return None
+        return self.__items[self.__start + message_id - self.first_id].to_dict()
+
+    def __iter__(self) -> Iterator[dict]:
+        for position in range(self.__start, len(self.__items)):
+            yield self.__items[position].to_dict()
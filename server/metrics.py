@@ -0,0 +1,52 @@
+from aiohttp import web
+
+from common.metrics import CONTENT_TYPE, REGISTRY, merge_expositions
+from server.cluster.cluster import FORWARDED_HEADER
+from server.data_structures import agents, cluster, messages, update_broadcaster
+
+FAST_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+# Actions of the frames sent by the agents, any other is counted as "unknown"
+AGENT_ACTIONS = ("JOIN", "RUN_STATUS", "OUTPUT")
+
+messages_received = REGISTRY.counter("server_messages_received", "Output messages stored", ["source"])
+messages_rejected = REGISTRY.counter("server_messages_rejected", "Output messages rejected by the schema")
+messages_stored = REGISTRY.gauge("server_messages_stored", "Output messages kept in memory")
+messages_stored_bytes = REGISTRY.gauge("server_messages_stored_bytes", "Size of the messages kept in memory")
+
+frames_received = REGISTRY.counter("server_frames_received", "Frames received from the agents", ["action"])
+frames_sent = REGISTRY.counter("server_frames_sent", "Frames sent to the agents", ["action"])
+process_seconds = REGISTRY.histogram(
+    "server_process_frame_seconds", "Time processing a frame of an agent", ["action"], FAST_BUCKETS
+)
+agent_connections = REGISTRY.gauge("server_agent_connections", "Open agent sockets")
+write_queue = REGISTRY.gauge("server_agent_write_queue_bytes", "Bytes queued to be written to the agent sockets")
+
+agents_joined = REGISTRY.gauge("server_agents", "Agents joined, to this node or to another one", ["node"])
+websockets = REGISTRY.gauge("server_websockets", "Dashboards connected")
+websocket_queue = REGISTRY.gauge("server_websocket_queue_events", "Events waiting to be sent to the dashboards")
+
+messages_stored.set_function(lambda: len(messages))
+messages_stored_bytes.set_function(lambda: messages.size_bytes)
+agents_joined.labels("local").set_function(lambda: len(agents))
+agents_joined.labels("remote").set_function(lambda: len(cluster.remote_agents))
+websockets.set_function(lambda: len(update_broadcaster.subscriptions))
+websocket_queue.set_function(lambda: sum(len(subscription) for subscription in update_broadcaster.subscriptions))
+
+
+def agent_action(message: dict) -> str:
+    action = message.get('action')
+    return action if action in AGENT_ACTIONS else "unknown"
+
+
+async def get_metrics(request):
+    if not cluster.enabled or cluster.sharded:
+        # The nodes of a cluster are scraped one by one
+        return web.Response(body=REGISTRY.expose(), headers={"Content-Type": CONTENT_TYPE})
+    # Workers share the port, any of them answers with the metrics of all,
+    # told apart by a worker label
+    exposition = REGISTRY.expose({"worker": cluster.node_id})
+    if FORWARDED_HEADER not in request.headers:
+        responses = await cluster.fan_out(request.path_qs)
+        exposition = merge_expositions([exposition] + [body for status, body, _ in responses if status == 200])
+    return web.Response(body=exposition, headers={"Content-Type": CONTENT_TYPE})
@@ -1,12 +1,56 @@
+import time
 from asyncio import Queue
-from typing import List, Dict
+from typing import List, Dict, Optional
 
+DEFAULT_COLOR = "black"
+FLASH_DURATION = 1.0  # seconds a transient color is shown
 
-class CodeExecutor:
+
+class Colored:
+    """State shown as a color in the dashboard. A transient color goes back to
+    the default one FLASH_DURATION seconds after it was set, the decay is
+    computed when the state is read so nothing waits for it."""
+
+    def __init__(self):
+        self.color = DEFAULT_COLOR
+        self.color_changed_at = time.time()
+        self.color_transient = False
+
+    def set_color(self, color: str, transient: bool = False):
+        self.color = color
+        self.color_changed_at = time.time()
+        self.color_transient = transient
+
+    def color_decay_in(self) -> Optional[float]:
+        if not self.color_transient:
+            return None
+        return max(self.color_changed_at + FLASH_DURATION - time.time(), 0)
+
+    def current_color(self) -> str:
+        return DEFAULT_COLOR if self.color_decay_in() == 0 else self.color
+
+    def restore_color(self, data: dict):
+        """Sets the color of a to_dict snapshot, with the decay it had left"""
+        self.color = data.get('color', DEFAULT_COLOR)
+        self.color_transient = data.get('decay_in') is not None
+        if self.color_transient:
+            self.color_changed_at = time.time() - FLASH_DURATION + data['decay_in']
+
+
+class CodeExecutor(Colored):
     def __init__(self, name: str, args: Dict[str, bool]):
+        super().__init__()
         self.name: str = name
         self.args: Dict[str, bool] = args
-        self.color = "black"
+
+    def to_dict(self):
+        return dict(name=self.name, args=self.args, color=self.current_color(), decay_in=self.color_decay_in())
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "CodeExecutor":
+        executor = cls(name=data['name'], args=data.get('args', {}))
+        executor.restore_color(data)
+        return executor
 
     def __str__(self):
         return f"CodExec[name:{self.name}, args:{self.args}]"
@@ -15,14 +59,36 @@ class CodeExecutor:
         return self.__str__()
 
 
-class Agent:
+class Agent(Colored):
 
-    def __init__(self, name: str, executors: Dict[str, CodeExecutor], addr: tuple, queue: Queue):
+    def __init__(self, name: str, executors: Dict[str, CodeExecutor], addr: tuple, queue: Queue,
+                 labels: Dict[str, str] = None):
+        super().__init__()
         self.name: str = name
         self.executors: Dict[str, CodeExecutor] = executors
+        self.labels: Dict[str, str] = labels or {}
         self.addr = addr
         self.queue = queue
-        self.color = "black"
+
+    def to_dict(self):
+        return dict(
+            name=self.name,
+            addr=f"{self.addr[0]}:{self.addr[1]}",
+            labels=self.labels,
+            color=self.current_color(),
+            decay_in=self.color_decay_in(),
+            executors=[executor.to_dict() for executor in self.executors.values()],
+        )
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Agent":
+        """An agent connected to another node of the cluster, it has no queue"""
+        host, port = data['addr'].rsplit(':', 1)
+        executors = [CodeExecutor.from_dict(executor) for executor in data.get('executors', [])]
+        agent = cls(name=data['name'], executors={executor.name: executor for executor in executors},
+                    addr=(host, int(port)), queue=None, labels=data.get('labels'))
+        agent.restore_color(data)
+        return agent
 
     def __str__(self):
         return f"Agent[name:{self.name}, addr{self.addr}, exec:{self.executors}]"
@@ -0,0 +1,112 @@
+from fnmatch import fnmatchcase
+from typing import Dict, Iterator, List, Optional
+
+from server.models import Agent
+
+
+class AgentRegistry:
+    """Connected agents indexed by socket address, by name, by the name of
+    their executors and by their labels.
+
+    Agents with the same name are kept apart by their address. The indexes
+    are updated without awaiting, so every coroutine sees them consistent."""
+
+    def __init__(self):
+        self.__by_addr: Dict[tuple, Agent] = {}
+        self.__by_name: Dict[str, Dict[tuple, Agent]] = {}
+        self.__by_executor: Dict[str, Dict[tuple, Agent]] = {}
+        self.__by_label: Dict[tuple, Dict[tuple, Agent]] = {}
+
+    @staticmethod
+    def __index(index: Dict, key, agent: Agent):
+        index.setdefault(key, {})[agent.addr] = agent
+
+    @staticmethod
+    def __unindex(index: Dict, key, agent: Agent):
+        agents = index.get(key)
+        if agents is not None:
+            agents.pop(agent.addr, None)
+            if not agents:
+                del index[key]
+
+    def add(self, agent: Agent):
+        if agent.addr in self.__by_addr:
+            self.remove(agent.addr)
+        self.__by_addr[agent.addr] = agent
+        self.__index(self.__by_name, agent.name, agent)
+        for executor_name in agent.executors:
+            self.__index(self.__by_executor, executor_name, agent)
+        for label in agent.labels.items():
+            self.__index(self.__by_label, label, agent)
+
+    def remove(self, addr: tuple) -> Optional[Agent]:
+        agent = self.__by_addr.pop(addr, None)
+        if agent is not None:
+            self.__unindex(self.__by_name, agent.name, agent)
+            for executor_name in agent.executors:
+                self.__unindex(self.__by_executor, executor_name, agent)
+            for label in agent.labels.items():
+                self.__unindex(self.__by_label, label, agent)
+        return agent
+
+    def get(self, addr: tuple, default=None) -> Optional[Agent]:
+        return self.__by_addr.get(addr, default)
+
+    def by_name(self, name: str) -> List[Agent]:
+        return list(self.__by_name.get(name, {}).values())
+
+    def with_executor(self, executor_name: str) -> List[Agent]:
+        return list(self.__by_executor.get(executor_name, {}).values())
+
+    def with_label(self, key: str, value: str) -> List[Agent]:
+        return list(self.__by_label.get((key, value), {}).values())
+
+    def select(self, selector: dict, executor: str = None) -> List[Agent]:
+        """Returns the agents matching every condition of the selector, "all",
+        "name" (a glob) and "labels" (a dict), and offering the executor"""
+        if not isinstance(selector, dict) or not selector:
+            raise ValueError("The selector must be a non empty object")
+        unknown = set(selector) - {"all", "name", "labels"}
+        if unknown:
+            raise ValueError(f"Unrecognized selector keys {sorted(unknown)}")
+        if "all" in selector and selector["all"] is not True:
+            raise ValueError("all must be true")
+        name = selector.get("name")
+        if name is not None and not isinstance(name, str):
+            raise ValueError("name must be a string")
+        labels = selector.get("labels") or {}
+        if not isinstance(labels, dict) or not all(
+            isinstance(key, str) and isinstance(value, str) for key, value in labels.items()
+        ):
+            raise ValueError("labels must be an object of strings")
+        # The candidates come from the most selective index available
+        if executor is not None:
+            candidates = self.__by_executor.get(executor, {}).values()
+        elif labels:
+            candidates = self.__by_label.get(next(iter(labels.items())), {}).values()
+        elif name is not None and not any(char in name for char in "*?["):
+            candidates = self.__by_name.get(name, {}).values()
+        else:
+            candidates = self.__by_addr.values()
+
+        return [
+            agent for agent in candidates
+            if (name is None or fnmatchcase(agent.name, name))
+            and (executor is None or executor in agent.executors)
+            and all(agent.labels.get(key) == value for key, value in labels.items())
+        ]
+
+    def values(self) -> List[Agent]:
+        return list(self.__by_addr.values())
+
+    def __getitem__(self, addr: tuple) -> Agent:
+        return self.__by_addr[addr]
+
+    def __contains__(self, addr: tuple) -> bool:
+        return addr in self.__by_addr
+
+    def __iter__(self) -> Iterator[tuple]:
+        return iter(list(self.__by_addr))
+
+    def __len__(self):
+        return len(self.__by_addr)
@@ -0,0 +1,70 @@
+import time
+import uuid
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+from server.runs import Run
+
+
+class RunGroup:
+    """The runs of a RUN sent to many agents at once"""
+
+    def __init__(self, group_id: str, code_executor: str, args: dict):
+        self.id = group_id
+        self.code_executor = code_executor
+        self.args = args
+        self.created_at = time.time()
+        self.runs: List[Run] = []
+
+    def counts(self) -> Dict[str, int]:
+        counts = {}
+        for run in self.runs:
+            counts[run.state] = counts.get(run.state, 0) + 1
+        return counts
+
+    @property
+    def finished(self) -> bool:
+        return all(run.finished for run in self.runs)
+
+    def to_dict(self) -> dict:
+        return dict(
+            id=self.id,
+            code_executor=self.code_executor,
+            args=self.args,
+            created_at=self.created_at,
+            finished=self.finished,
+            counts=self.counts(),
+            runs=[dict(id=run.id, agent=run.agent_name, addr=run.agent_addr, state=run.state, message=run.message)
+                  for run in self.runs],
+        )
+
+
+def merge_groups(parts: List[dict]) -> dict:
+    """A group from the parts of it created by each node of a cluster"""
+    group = dict(parts[0], created_at=min(part["created_at"] for part in parts),
+                 finished=all(part["finished"] for part in parts), counts={}, runs=[])
+    for part in parts:
+        for state, count in part["counts"].items():
+            group["counts"][state] = group["counts"].get(state, 0) + count
+        group["runs"].extend(part["runs"])
+    return group
+
+
+class RunGroups:
+    """The latest `max_groups` run groups, by id"""
+
+    def __init__(self, max_groups: int = 1000):
+        self.max_groups = max_groups
+        self.__groups: Dict[str, RunGroup] = OrderedDict()
+
+    def create(self, code_executor: str, args: dict, group_id: str = None) -> RunGroup:
+        """A new group, or in a cluster the part of the group `group_id`
+        created by another node with the agents of this one"""
+        group = RunGroup(group_id or uuid.uuid4().hex, code_executor, args)
+        self.__groups[group.id] = group
+        while len(self.__groups) > self.max_groups:
+            self.__groups.popitem(last=False)
+        return group
+
+    def get(self, group_id: str) -> Optional[RunGroup]:
+        return self.__groups.get(group_id)
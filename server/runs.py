@@ -0,0 +1,213 @@
+import time
+import uuid
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from server.models import Agent
+from server.utils import format_addr
+
+
+class RunState:
+    QUEUED = "queued"
+    STARTED = "started"
+    FINISHED = "finished"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+
+    FINAL = (FINISHED, FAILED, CANCELLED)
+    TRANSITIONS = {
+        QUEUED: (STARTED, FAILED, CANCELLED),
+        STARTED: (FINISHED, FAILED, CANCELLED),
+    }
+
+
+def state_from_status(message: dict) -> Optional[str]:
+    """State of a RUN_STATUS message, dispatchers not sending "state" only
+    send the running/successful flags"""
+    if "state" in message:
+        return message["state"]
+    if "successful" in message:
+        return RunState.FINISHED if message["successful"] else RunState.FAILED
+    if "running" in message:
+        return RunState.STARTED if message["running"] else RunState.FAILED
+    return None
+
+
+class Run:
+    """A RUN sent to an agent, with the time it entered each state"""
+
+    def __init__(self, run_id: str, agent: Agent, executor: str, args: dict, group_id: str = None):
+        self.id = run_id
+        self.agent_name = agent.name
+        self.agent_addr = format_addr(agent.addr)
+        self.addr = agent.addr
+        self.executor = executor
+        self.args = args
+        self.group_id = group_id
+        self.state = RunState.QUEUED
+        self.timestamps: Dict[str, float] = {RunState.QUEUED: time.time()}
+        self.message: Optional[str] = None
+
+    def can_transition(self, state: str) -> bool:
+        return state in RunState.TRANSITIONS.get(self.state, ())
+
+    @property
+    def finished(self) -> bool:
+        return self.state in RunState.FINAL
+
+    @property
+    def queue_time(self) -> Optional[float]:
+        if RunState.STARTED not in self.timestamps:
+            return None
+        return self.timestamps[RunState.STARTED] - self.timestamps[RunState.QUEUED]
+
+    @property
+    def run_time(self) -> Optional[float]:
+        if not self.finished or RunState.STARTED not in self.timestamps:
+            return None
+        return self.timestamps[self.state] - self.timestamps[RunState.STARTED]
+
+    def to_dict(self) -> dict:
+        return dict(
+            id=self.id,
+            agent=self.agent_name,
+            addr=self.agent_addr,
+            executor=self.executor,
+            args=self.args,
+            group_id=self.group_id,
+            state=self.state,
+            timestamps=self.timestamps,
+            queue_time=self.queue_time,
+            run_time=self.run_time,
+            message=self.message,
+        )
+
+
+def percentile(values: List[float], fraction: float) -> Optional[float]:
+    if not values:
+        return None
+    position = min(int(round(fraction * (len(values) - 1))), len(values) - 1)
+    return values[position]
+
+
+class RunTracker:
+    """History of the latest `max_runs` runs, indexed by executor, agent name,
+    state and group"""
+
+    def __init__(self, max_runs: int = 10 * 1000):
+        self.max_runs = max_runs
+        # In a cluster the ids start with the id of the node, so a request
+        # for a run is sent to the node that created it
+        self.id_prefix = ""
+        self.__runs: Dict[str, Run] = OrderedDict()
+        self.__indexes: Dict[str, Dict[str, Dict[str, Run]]] = {
+            "executor": {}, "agent": {}, "state": {}, "group": {},
+        }
+
+    @staticmethod
+    def __keys(run: Run) -> Dict[str, Optional[str]]:
+        return dict(executor=run.executor, agent=run.agent_name, state=run.state, group=run.group_id)
+
+    def __index(self, run: Run):
+        for index, key in self.__keys(run).items():
+            if key is not None:
+                self.__indexes[index].setdefault(key, OrderedDict())[run.id] = run
+
+    def __unindex(self, run: Run):
+        for index, key in self.__keys(run).items():
+            runs = self.__indexes[index].get(key)
+            if runs is not None:
+                runs.pop(run.id, None)
+                if not runs:
+                    del self.__indexes[index][key]
+
+    def create(self, agent: Agent, executor: str, args: dict, group_id: str = None) -> Run:
+        run = Run(self.id_prefix + uuid.uuid4().hex, agent, executor, args, group_id)
+        self.__runs[run.id] = run
+        self.__index(run)
+        while len(self.__runs) > self.max_runs:
+            _, evicted = self.__runs.popitem(last=False)
+            self.__unindex(evicted)
+        return run
+
+    def get(self, run_id: str) -> Optional[Run]:
+        return self.__runs.get(run_id)
+
+    def transition(self, run_id: str, state: str, message: str = None) -> Optional[Run]:
+        run = self.__runs.get(run_id)
+        if run is None or not run.can_transition(state):
+            return None
+        # Only the state index changes, the others keep the creation order
+        runs = self.__indexes["state"][run.state]
+        del runs[run.id]
+        if not runs:
+            del self.__indexes["state"][run.state]
+        run.state = state
+        run.timestamps[state] = time.time()
+        run.message = message
+        self.__indexes["state"].setdefault(state, OrderedDict())[run.id] = run
+        return run
+
+    def agent_disconnected(self, agent: Agent):
+        """The runs not finished by a disconnected agent are failed"""
+        for run in self.query(agent=agent.name):
+            if run.addr == agent.addr and not run.finished:
+                self.transition(run.id, RunState.FAILED, "Agent disconnected")
+
+    def query(self, executor: str = None, agent: str = None, state: str = None, group: str = None,
+              limit: int = None) -> List[Run]:
+        """The runs matching every filter, newest first"""
+        filters = dict(executor=executor, agent=agent, state=state, group=group)
+        selected = [
+            self.__indexes[index].get(key, {}) for index, key in filters.items() if key is not None
+        ]
+        if not selected:
+            candidates = self.__runs
+        else:
+            candidates = min(selected, key=len)
+        runs = []
+        for run in reversed(candidates.values()):
+            if all(key is None or self.__keys(run)[index] == key for index, key in filters.items()):
+                runs.append(run)
+                if limit is not None and len(runs) >= limit:
+                    break
+        return runs
+
+    def latency_stats(self, by: str) -> Dict[str, dict]:
+        """Percentiles of queue and run times of the runs in the history,
+        grouped by executor or agent"""
+        return latency_stats(
+            (key, run.queue_time, run.run_time) for key, runs in self.__indexes[by].items() for run in runs.values()
+        )
+
+
+def latency_stats(times: Iterable[Tuple[str, Optional[float], Optional[float]]]) -> Dict[str, dict]:
+    """Percentiles of the (key, queue time, run time) of each run, by key"""
+    counts: Dict[str, int] = {}
+    queue_times: Dict[str, List[float]] = {}
+    run_times: Dict[str, List[float]] = {}
+    for key, queue_time, run_time in times:
+        counts[key] = counts.get(key, 0) + 1
+        if queue_time is not None:
+            queue_times.setdefault(key, []).append(queue_time)
+        if run_time is not None:
+            run_times.setdefault(key, []).append(run_time)
+    return {
+        key: dict(
+            runs=count,
+            queue_time=percentiles(queue_times.get(key, [])),
+            run_time=percentiles(run_times.get(key, [])),
+        )
+        for key, count in counts.items()
+    }
+
+
+def merge_runs(pages: List[List[dict]], limit: int) -> List[dict]:
+    """The latest `limit` runs of the pages of the nodes of a cluster"""
+    found = [run for page in pages for run in page]
+    return sorted(found, key=lambda run: run["timestamps"][RunState.QUEUED], reverse=True)[:limit]
+
+
+def percentiles(values: List[float]) -> Dict[str, Optional[float]]:
+    values = sorted(values)
+    return {f"p{int(p * 100)}": percentile(values, p) for p in (0.5, 0.9, 0.99)}
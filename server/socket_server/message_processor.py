@@ -1,8 +1,12 @@
-from asyncio import Queue, sleep
+from asyncio import Queue
 
+from common.schema import OUTPUT_MESSAGE
+from server import metrics
 from server.logger import get_logger
 from server.models import Agent, CodeExecutor
-from server.data_structures import update_websocket_queue, agents
+from server.data_structures import agents, runs
+from server.runs import state_from_status
+from server.updates import publish_agent, store_messages
 
 logger = get_logger()
 
@@ -16,47 +20,58 @@ async def process_message(message: dict, queue: Queue, addr: tuple):
             executor['name']:
                 CodeExecutor(name=executor['name'], args=executor['args']) for executor in message['executors']
         }
-        agent = Agent(name=message['name'], executors=executors, addr=addr, queue=queue)
-        agents[agent.addr] = agent
-        await update_websocket_queue.put("agent")
+        agent = Agent(name=message['name'], executors=executors, addr=addr, queue=queue,
+                      labels=message.get('labels'))
+        agents.add(agent)
+        publish_agent(agent.addr)
     if message['action'] == 'RUN_STATUS':
         if 'executor_name' not in message:
             logger.warning("Invalid join message")
             raise ValueError("Invalid join message")
         agent = agents[addr]
+        if 'run_id' in message:
+            state = state_from_status(message)
+            if state is not None:
+                runs.transition(message['run_id'], state, message.get('message'))
         if message["executor_name"] in agent.executors:
 
             if "running" in message:
                 if message["running"]:
                     executor_color(agent, message['executor_name'], "goldenrod")
                 else:
-                    executor_color(agent, message['executor_name'], "red")
-                    await update_websocket_queue.put("agent")
-                    await sleep(1)
-                    executor_color(agent, message['executor_name'], "black")
+                    executor_color(agent, message['executor_name'], "red", transient=True)
 
             if "successful" in message:
                 if message["successful"]:
                     color = "darkgreen"
                 else:
                     color = "magenta"
-                executor_color(agent, message['executor_name'], color)
-                await update_websocket_queue.put("agent")
-                await sleep(1)
-                executor_color(agent, message['executor_name'], "black")
+                executor_color(agent, message['executor_name'], color, transient=True)
         else:
-            agent.color = "red"
-            await update_websocket_queue.put("agent")
-            await sleep(1)
-            agent.color = "black"
+            agent.set_color("red", transient=True)
 
-        await update_websocket_queue.put("agent")
+        publish_agent(addr)
+    if message['action'] == 'OUTPUT':
+        # Executor output multiplexed on the agent socket, it is acknowledged
+        # once stored so the dispatcher can send more
+        if 'seq' not in message or not isinstance(message.get('messages'), list):
+            logger.warning("Invalid output message")
+            raise ValueError("Invalid output message")
+        valid = [output for output in message['messages'] if OUTPUT_MESSAGE.validate(output) is None]
+        metrics.messages_received.labels("socket").inc(len(valid))
+        if len(valid) < len(message['messages']):
+            metrics.messages_rejected.inc(len(message['messages']) - len(valid))
+            logger.warning("Dropped %d invalid output messages from %s", len(message['messages']) - len(valid), addr)
+        store_messages(valid)
+        await queue.put({'action': 'OUTPUT_ACK', 'seq': message['seq']})
 
 
-def executor_color(agent, executor_name, color):
-    agent.executors[executor_name].color = color
+def executor_color(agent, executor_name, color, transient=False):
+    agent.executors[executor_name].set_color(color, transient)
 
 
 async def disconnected_agent(addr: tuple):
-    del agents[addr]
-    await update_websocket_queue.put("agent")
+    agent = agents.remove(addr)
+    if agent is not None:
+        runs.agent_disconnected(agent)
+    publish_agent(addr)
@@ -1,59 +1,118 @@
 import asyncio
-import json
 from asyncio import StreamReader, StreamWriter, Queue
-
-from server.logger import get_logger
+from typing import Set
+
+from common.framing import Framer, FramingError, LineFramer, get_framer, negotiate
+from common.writer import FramedWriter
+from server.config import ServerGlobals
+from server.data_structures import cluster
+from server import metrics
+from server.logger import FRAMES_LOGGER, get_logger
 from server.socket_server.message_processor import process_message, disconnected_agent
 
 logger = get_logger()
-
-
-async def read_data(reader: StreamReader):
-    data = await reader.readline()
-    return json.loads(data) if len(data) > 0 else None
-
-
-async def handle_write(writer: StreamWriter, queue: Queue, addr: tuple):
+frames_logger = get_logger(FRAMES_LOGGER)
+
+connections: Set["AgentConnection"] = set()
+metrics.agent_connections.set_function(lambda: len(connections))
+metrics.write_queue.set_function(lambda: sum(connection.sender.depth for connection in connections))
+
+
+class AgentConnection:
+    """The socket of an agent, it starts with json lines and switches to the
+    framing negotiated in the JOIN"""
+
+    def __init__(self, reader: StreamReader, writer: StreamWriter):
+        self.reader = reader
+        self.writer = writer
+        self.addr = writer.get_extra_info('peername')
+        self.framer: Framer = LineFramer()
+        self.sender = FramedWriter(
+            writer, self.framer, ServerGlobals.AGENTS_WRITE_HIGH_WATER, ServerGlobals.AGENTS_WRITE_LOW_WATER
+        )
+
+    async def read(self):
+        return await self.framer.read(self.reader)
+
+    def write(self, message: dict):
+        self.sender.write(message)
+
+    async def send(self, message: dict):
+        await self.sender.send(message)
+
+    def redirect(self, message: dict) -> bool:
+        """Sends an agent joining the wrong node of the cluster to its owner"""
+        if message.get('action') != 'JOIN' or not cluster.sharded or cluster.owns(message.get('name', '')):
+            return False
+        owner = cluster.owner(message['name'])
+        logger.info("Redirecting agent %s to %s", message['name'], owner)
+        self.write({'action': 'REDIRECT', 'host': owner.host, 'port': owner.agents_port})
+        return True
+
+    def negotiate(self, message: dict):
+        if message.get('action') != 'JOIN' or 'framing' not in message:
+            return
+        framing = negotiate(message['framing'])
+        # The ack is the last json line, both ends use the new framing after it
+        self.write({'action': 'JOIN_ACK', 'framing': framing})
+        self.framer = self.sender.framer = get_framer(framing, ServerGlobals.AGENTS_MAX_FRAME_SIZE)
+        logger.info("Agent %s uses %s framing", self.addr, framing)
+
+
+async def handle_write(connection: AgentConnection, queue: Queue):
+    # The messages already queued are taken without waiting, so the sender
+    # writes them to the socket together
     message = await queue.get()
     while message is not None:
-        logger.info(f"Send to {addr}: {message}")
-        data = json.dumps(message)
-        writer.write(f"{data}\n".encode())
-        await writer.drain()
+        frames_logger.debug("Send to %s: %s", connection.addr, message)
+        metrics.frames_sent.labels(message.get('action')).inc()
+        await connection.send(message)
         message = await queue.get()
-
-
-async def handle_read(reader: StreamReader, queue: Queue, addr: tuple):
-    message = await read_data(reader)
-    while message:
-        logger.info("Received %r from %r" % (message, addr))
-        try:
-            await process_message(message, queue, addr)
-        except (ValueError, KeyError) as e:
-            logger.debug("Error parsing socket data", exc_info=e)
-        message = await read_data(reader)
+    await connection.sender.close()
+
+
+async def handle_read(connection: AgentConnection, queue: Queue):
+    try:
+        message = await connection.read()
+        while message:
+            frames_logger.debug("Received %r from %r", message, connection.addr)
+            action = metrics.agent_action(message)
+            metrics.frames_received.labels(action).inc()
+            if connection.redirect(message):
+                break
+            try:
+                connection.negotiate(message)
+                with metrics.process_seconds.labels(action).time():
+                    await process_message(message, queue, connection.addr)
+            except (ValueError, KeyError) as e:
+                logger.debug("Error parsing socket data", exc_info=e)
+            message = await connection.read()
+    except (FramingError, ValueError, asyncio.IncompleteReadError) as e:
+        logger.warning("Closing connection of %s: %s", connection.addr, e)
     await queue.put(None)
 
 
 async def handle(reader: StreamReader, writer: StreamWriter):
-    addr = writer.get_extra_info('peername')
+    connection = AgentConnection(reader, writer)
     queue = Queue()
 
-    await asyncio.gather(handle_read(reader=reader, queue=queue, addr=addr),
-                         handle_write(writer=writer, queue=queue, addr=addr))
+    connections.add(connection)
+    try:
+        await asyncio.gather(handle_read(connection=connection, queue=queue),
+                             handle_write(connection=connection, queue=queue))
+    finally:
+        connections.discard(connection)
 
-    await disconnected_agent(addr)
+    await disconnected_agent(connection.addr)
     logger.info("Close the client socket")
     writer.close()
 
 
-def start_socket_server():
+async def start_socket_server(port: int = ServerGlobals.AGENTS_PORT, reuse_port: bool = False):
 
-    loop = asyncio.get_event_loop()
-    coro = asyncio.start_server(handle, '0.0.0.0', 8888)
-    server = loop.run_until_complete(coro)
+    # With reuse_port the workers of the server bind the same port
+    server = await asyncio.start_server(handle, '0.0.0.0', port, reuse_port=reuse_port)
 
-    # Serve requests until Ctrl+C is pressed
     logger.info('Serving on {}'.format(server.sockets[0].getsockname()))
 
     return server
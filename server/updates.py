@@ -0,0 +1,102 @@
+from typing import List
+
+from server.data_structures import agents, cluster, messages, update_broadcaster
+from server.utils import format_addr
+
+AGENT = "agent"
+REMOTE_AGENT = "remote_agent"
+MESSAGES = "msg"
+RESET = "reset"
+
+
+def publish_agent(addr: tuple):
+    # Only the address is published, the state is read when the delta is built
+    update_broadcaster.publish((AGENT, addr), key=(AGENT, addr))
+    agent = agents.get(addr)
+    cluster.publish("agent", addr=format_addr(addr), agent=agent.to_dict() if agent is not None else None)
+
+
+def publish_remote_agent(addr: str):
+    update_broadcaster.publish((REMOTE_AGENT, addr), key=(REMOTE_AGENT, addr))
+
+
+def publish_messages(new_messages: List[dict]):
+    update_broadcaster.publish((MESSAGES, new_messages))
+
+
+def store_messages(new_messages: List[dict]):
+    """Stores the messages received from the executors and publishes them to
+    the websockets. In a cluster they go to the bus hub first, which gives
+    them the same ids in every node, and are stored when it sends them back"""
+    if cluster.enabled:
+        cluster.publish("messages", messages=new_messages)
+    else:
+        add_messages(new_messages)
+
+
+def add_messages(new_messages: List[dict], first_id: int = None):
+    ids = messages.extend(new_messages, first_id)
+    stored = [messages.get(message_id) for message_id in ids]
+    publish_messages([message for message in stored if message is not None])
+
+
+def reset_messages():
+    """Deletes the stored messages, of every node of the cluster"""
+    if cluster.enabled:
+        cluster.publish("reset")
+    else:
+        clear_messages()
+
+
+def clear_messages():
+    messages.clear()
+    update_broadcaster.publish((RESET, None), key=RESET)
+
+
+def handle_cluster_event(event: dict):
+    kind = event.get("type")
+    if kind == "hello":
+        # A node (re)joined, it gets the state of the agents of this one
+        for agent in agents.values():
+            cluster.publish("agent", addr=format_addr(agent.addr), agent=agent.to_dict())
+    elif kind == "messages":
+        add_messages(event["messages"], event["first_id"])
+    elif kind == "reset":
+        clear_messages()
+    elif kind == "agent":
+        cluster.remote_agent_changed(event["node"], event["addr"], event.get("agent"))
+        publish_remote_agent(event["addr"])
+    elif kind == "node_down":
+        for addr in cluster.node_down(event["node"]):
+            publish_remote_agent(addr)
+
+
+def build_delta(events: list) -> dict:
+    """Merges the pending events of a subscriber in a single update with the
+    new messages and the agents whose state changed."""
+    reset = False
+    new_messages = []
+    changed_agents = {}
+    changed_remote_agents = {}
+    for kind, value in events:
+        if kind == RESET:
+            reset = True
+            new_messages.clear()
+        elif kind == MESSAGES:
+            new_messages.extend(value)
+        elif kind == AGENT:
+            changed_agents[value] = agents.get(value)
+        elif kind == REMOTE_AGENT:
+            changed_remote_agents[value] = cluster.remote_agents.get(value)
+
+    # Remote agents are keyed by their address already formatted
+    changed_agents = {format_addr(addr): agent for addr, agent in changed_agents.items()}
+    changed_agents.update(changed_remote_agents)
+    return {
+        'action': 'delta',
+        'reset': reset,
+        'messages': new_messages,
+        'cursor': messages.last_id,
+        'agents': [agent.to_dict() for agent in changed_agents.values() if agent is not None],
+        'removed_agents': [addr for addr, agent in changed_agents.items() if agent is None],
+    }
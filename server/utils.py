@@ -1,10 +1,51 @@
-from .exceptions import JsonValidaitonError
-import json
+from common import codec
+from common.schema import OUTPUT_MESSAGE
+from .exceptions import JsonValidaitonError, QueryValidationError
 
 
 def json_payload(raw_payload: bytearray):
-    payload = raw_payload.decode(encoding='UTF-8')
     try:
-        return json.loads(payload)
-    except ValueError as e:
-        raise JsonValidaitonError('Payload is not json serialisable')
\ No newline at end of file
+        return codec.loads(raw_payload)
+    except codec.DecodeError as e:
+        raise JsonValidaitonError('Payload is not json serialisable') from e
+
+
+def ndjson_payload(raw_payload: bytearray):
+    try:
+        return [codec.loads(line) for line in raw_payload.splitlines() if line.strip()]
+    except codec.DecodeError as e:
+        raise JsonValidaitonError('Payload is not newline delimited json') from e
+
+
+def json_list_payload(raw_payload: bytearray, content_type: str):
+    if content_type in ('application/x-ndjson', 'application/jsonlines'):
+        return ndjson_payload(raw_payload)
+    data = json_payload(raw_payload)
+    if not isinstance(data, list):
+        raise JsonValidaitonError('Payload must be a json array')
+    return data
+
+
+def output_messages_payload(messages: list) -> list:
+    """Rejects the payload when any message does not match the output schema"""
+    for position, message in enumerate(messages):
+        error = OUTPUT_MESSAGE.validate(message)
+        if error is not None:
+            raise JsonValidaitonError(error, position=position)
+    return messages
+
+
+def int_query(request, name: str, default: int = None, minimum: int = 0, maximum: int = None):
+    if name not in request.query:
+        return default
+    try:
+        value = int(request.query[name])
+    except ValueError:
+        raise QueryValidationError(f'{name} must be an integer')
+    if value < minimum:
+        raise QueryValidationError(f'{name} must be greater or equal than {minimum}')
+    return min(value, maximum) if maximum is not None else value
+
+
+def format_addr(addr: tuple) -> str:
+    return f"{addr[0]}:{addr[1]}"
@@ -1,14 +1,32 @@
-from asyncio import Queue
-
-import aiohttp
+import asyncio
 
 from aiohttp import web
 
-from server.data_structures import update_websocket_queue
+from common.codec import dumps_str
+from server.broadcaster import Subscription
+from server.data_structures import update_broadcaster
 from server.logger import get_logger
+from server.updates import build_delta
 
 logger = get_logger()
 
+UPDATE_INTERVAL = 0.1  # seconds, at most one update is sent per interval
+
+
+async def send_updates(ws_current: web.WebSocketResponse, subscription: Subscription):
+    dropped = subscription.dropped
+    while True:
+        first_event = await subscription.get()
+        await asyncio.sleep(UPDATE_INTERVAL)
+        events = [first_event] + subscription.get_all()
+
+        if subscription.dropped != dropped:
+            # Some events were lost, the browser must fetch everything again
+            dropped = subscription.dropped
+            await ws_current.send_json({'action': 'resync'}, dumps=dumps_str)
+        else:
+            await ws_current.send_json(build_delta(events), dumps=dumps_str)
+
 
 async def websocket_handler(request):
     ws_current = web.WebSocketResponse()
@@ -20,17 +38,13 @@ async def websocket_handler(request):
 
     await ws_current.send_json({'action': 'connect'})
 
-    while True:
-        msg = await update_websocket_queue.get()
-
-        if msg == "agent":
-            await ws_current.send_json({'action': 'update'})
-        elif msg == "msg":
-            await ws_current.send_json({'action': 'update_msg'})
-        else:
-            break
-
-    await ws_current.send_json({'action': 'disconnect', 'agents': []})
+    with update_broadcaster.subscribe() as subscription:
+        sender = asyncio.ensure_future(send_updates(ws_current, subscription))
+        try:
+            async for _ in ws_current:  # The browser sends nothing, this only waits for the disconnection
+                pass
+        finally:
+            sender.cancel()
 
     logger.info('ws disconnected.')
 
@@ -2,9 +2,8 @@ import asyncio
 import json
 
 # Based on echo server of asyncio documentation example
-async def socket_client(message, loop):
-    reader, writer = await asyncio.open_connection('127.0.0.1', 8888,
-                                                   loop=loop)
+async def socket_client(message):
+    reader, writer = await asyncio.open_connection('127.0.0.1', 8888)
 
     print('Send: %r' % message)
     writer.write(f"{message}\n".encode())
@@ -39,6 +38,4 @@ if __name__ == '__main__':
         ]
     }
 
-    loop = asyncio.get_event_loop()
-    loop.run_until_complete(socket_client(json.dumps(message_dict), loop))
-    loop.close()
+    asyncio.run(socket_client(json.dumps(message_dict)))
@@ -0,0 +1,88 @@
+import asyncio
+import fcntl
+import os
+from types import SimpleNamespace
+
+import pytest
+
+from dispatcher.logic.artifacts import ArtifactCache, BuildError
+
+# Counts the builds in $BUILDS and copies the source to the artifact
+BUILD_CMD = 'echo build >> "$BUILDS" && cat $BUILD_SOURCE > "$BUILD_ARTIFACT"'
+
+
+def executor(source, build_cmd: str = BUILD_CMD) -> SimpleNamespace:
+    return SimpleNamespace(name="scanner", build_cmd=build_cmd, build_source=[str(source)])
+
+
+def builds(tmp_path) -> int:
+    builds_path = tmp_path / "builds"
+    return len(builds_path.read_text().splitlines()) if builds_path.exists() else 0
+
+
+@pytest.fixture
+def env(tmp_path) -> dict:
+    return {"PATH": os.environ["PATH"], "BUILDS": str(tmp_path / "builds")}
+
+
+def write_source(tmp_path, name: str, content: str):
+    source = tmp_path / name
+    source.write_text(content)
+    return source
+
+
+def test_builds_once(tmp_path, env, monkeypatch):
+    cache = ArtifactCache(tmp_path / "cache", max_artifacts=5)
+    source = write_source(tmp_path, "source.txt", "v1")
+
+    async def get_concurrently():
+        return await asyncio.gather(*(cache.get(executor(source), env) for _ in range(3)))
+
+    artifacts = asyncio.run(get_concurrently())
+    assert len(set(artifacts)) == 1
+    assert artifacts[0].read_text() == "v1"
+    assert builds(tmp_path) == 1
+
+    # A relative source is the same file
+    monkeypatch.chdir(tmp_path)
+    assert asyncio.run(cache.get(executor("source.txt"), env)) == artifacts[0]
+    assert builds(tmp_path) == 1
+
+    source.write_text("v2")
+    artifact = asyncio.run(cache.get(executor(source), env))
+    assert artifact != artifacts[0]
+    assert artifact.read_text() == "v2"
+    assert builds(tmp_path) == 2
+
+
+def test_failed_build(tmp_path, env):
+    cache = ArtifactCache(tmp_path / "cache", max_artifacts=5)
+    source = write_source(tmp_path, "source.txt", "v1")
+    with pytest.raises(BuildError):
+        asyncio.run(cache.get(executor(source, build_cmd="exit 1"), env))
+    with pytest.raises(BuildError):
+        asyncio.run(cache.get(executor(tmp_path / "missing.txt"), env))
+    assert [path for path in (tmp_path / "cache").iterdir() if path.is_dir()] == []
+
+
+def test_evicts_the_least_recently_used(tmp_path, env):
+    cache = ArtifactCache(tmp_path / "cache", max_artifacts=2)
+    sources = [write_source(tmp_path, f"source{number}.txt", str(number)) for number in range(4)]
+    first = asyncio.run(cache.get(executor(sources[0]), env))
+    second = asyncio.run(cache.get(executor(sources[1]), env))
+    # Used again, the second one is the least recently used
+    os.utime(first.parent, (os.stat(second.parent).st_mtime + 1,) * 2)
+    third = asyncio.run(cache.get(executor(sources[2]), env))
+    assert first.exists() and third.exists()
+    assert not second.parent.exists()
+    assert not (cache.path / f"{second.parent.name}.lock").exists()
+
+    # Locked by another dispatcher building it, it is evicted later
+    with open(cache.path / f"{first.parent.name}.lock", 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        os.utime(first.parent, (0, 0))
+        fourth = asyncio.run(cache.get(executor(sources[3]), env))
+        assert first.exists() and third.exists() and fourth.exists()
+    cache.evict()
+    assert not first.exists()
+    assert third.exists() and fourth.exists()
@@ -0,0 +1,203 @@
+import asyncio
+import json
+
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+import server.app
+from server.cluster.bus import BusHub, TcpBus
+from server.cluster.cluster import FORWARDED_HEADER, Cluster, NodeAddress
+from server.cluster.hash_ring import HashRing
+from server.run_groups import merge_groups
+from server.runs import merge_runs
+
+KEYS = [f"agent-{number}" for number in range(1000)]
+
+
+def assignments(ring: HashRing) -> dict:
+    return {key: ring.node_for(key) for key in KEYS}
+
+
+def test_hash_ring_only_moves_the_keys_of_a_node():
+    ring = HashRing(["a", "b", "c"])
+    before = assignments(ring)
+    assert set(before.values()) == {"a", "b", "c"}
+
+    ring.add("d")
+    added = assignments(ring)
+    moved = [key for key in KEYS if added[key] != before[key]]
+    assert moved and all(added[key] == "d" for key in moved)
+
+    ring.remove("d")
+    assert assignments(ring) == before
+
+    ring.remove("b")
+    removed = assignments(ring)
+    assert all(removed[key] == before[key] for key in KEYS if before[key] != "b")
+    assert "b" not in removed.values()
+
+
+class Node:
+    """A bus client recording the events it gets"""
+
+    def __init__(self, port: int, node_id: str, last_message_id: int = 0):
+        self.events = []
+        self.bus = TcpBus("127.0.0.1", port, lambda: dict(type="hello", node=node_id,
+                                                          last_message_id=last_message_id))
+
+    async def start(self):
+        await self.bus.start(self.events.append)
+
+    def of_type(self, kind: str) -> list:
+        return [event for event in self.events if event["type"] == kind]
+
+
+async def start_hub(backlog: int = 100) -> BusHub:
+    hub = BusHub(backlog)
+    await hub.start("127.0.0.1", 0)
+    return hub
+
+
+def hub_port(hub: BusHub) -> int:
+    return hub.server.sockets[0].getsockname()[1]
+
+
+def test_hub_fans_out_and_numbers_the_messages():
+
+    async def fan_out():
+        hub = await start_hub()
+        nodes = [Node(hub_port(hub), node_id) for node_id in ("a", "b", "c")]
+        for node in nodes:
+            await node.start()
+            await asyncio.sleep(0.1)
+        a, b, c = nodes
+
+        a.bus.publish(dict(type="agent", node="a", addr="1.2.3.4:5", agent=None))
+        a.bus.publish(dict(type="messages", node="a", messages=[{"msg": "1"}, {"msg": "2"}]))
+        b.bus.publish(dict(type="messages", node="b", messages=[{"msg": "3"}]))
+        await asyncio.sleep(0.1)
+        # The sender gets its messages back, with the ids of the hub
+        for node in nodes:
+            assert [(event["first_id"], len(event["messages"])) for event in node.of_type("messages")] == [
+                (1, 2), (3, 1)
+            ]
+        assert not a.of_type("agent")
+        assert len(b.of_type("agent")) == len(c.of_type("agent")) == 1
+        assert [event["node"] for event in a.of_type("hello")] == ["b", "c"]
+
+        await c.bus.close()
+        await asyncio.sleep(0.1)
+        assert a.of_type("node_down") == b.of_type("node_down") == [dict(type="node_down", node="c")]
+
+        await a.bus.close()
+        await b.bus.close()
+        await hub.close()
+
+    asyncio.run(fan_out())
+
+
+def test_hub_sends_the_missed_messages_to_a_joining_node():
+
+    async def join():
+        hub = await start_hub(backlog=3)
+        a = Node(hub_port(hub), "a")
+        await a.start()
+        await asyncio.sleep(0.1)
+        for number in range(1, 6):
+            a.bus.publish(dict(type="messages", node="a", messages=[{"msg": str(number)}]))
+        a.bus.publish(dict(type="reset", node="a"))
+        await asyncio.sleep(0.1)
+
+        # It had the message 3, the ones before are not in the backlog anyway
+        b = Node(hub_port(hub), "b", last_message_id=3)
+        await b.start()
+        await asyncio.sleep(0.1)
+        assert [event.get("first_id") for event in b.events] == [4, 5, None]
+        assert b.events[-1]["type"] == "reset"
+
+        # A hub started again goes on from the ids of the nodes
+        restarted = await start_hub()
+        c = Node(hub_port(restarted), "c", last_message_id=5)
+        await c.start()
+        await asyncio.sleep(0.1)
+        c.bus.publish(dict(type="messages", node="c", messages=[{"msg": "6"}]))
+        await asyncio.sleep(0.1)
+        assert c.of_type("messages")[0]["first_id"] == 6
+
+        for node in (a, b, c):
+            await node.bus.close()
+        await hub.close()
+        await restarted.close()
+
+    asyncio.run(join())
+
+
+def test_merge_groups():
+    parts = [
+        dict(id="group", code_executor="ex", args={}, created_at=20.0, finished=True,
+             counts={"finished": 2}, runs=["a.1", "a.2"]),
+        dict(id="group", code_executor="ex", args={}, created_at=10.0, finished=False,
+             counts={"finished": 1, "running": 1}, runs=["b.1", "b.2"]),
+    ]
+    group = merge_groups(parts)
+    assert group["created_at"] == 10.0
+    assert not group["finished"]
+    assert group["counts"] == {"finished": 3, "running": 1}
+    assert group["runs"] == ["a.1", "a.2", "b.1", "b.2"]
+
+
+def run(run_id: str, queued: float) -> dict:
+    return dict(id=run_id, timestamps=dict(queued=queued))
+
+
+def test_merge_runs():
+    pages = [
+        [run("a.3", 30.0), run("a.1", 10.0)],
+        [run("b.4", 40.0), run("b.2", 20.0)],
+        [],
+    ]
+    assert [found["id"] for found in merge_runs(pages, 3)] == ["b.4", "a.3", "b.2"]
+    assert [found["id"] for found in merge_runs(pages, 10)] == ["b.4", "a.3", "b.2", "a.1"]
+
+
+def test_forwarded_requests_are_not_forwarded_again(monkeypatch):
+    received = []
+
+    async def other_node_run(request):
+        received.append((request.headers.get(FORWARDED_HEADER), await request.json()))
+        return web.json_response(dict(run_id="b.1"))
+
+    async def forward_once():
+        other_node = web.Application()
+        other_node.add_routes([web.post('/run', other_node_run)])
+        async with TestServer(other_node) as other_server:
+            hub = await start_hub()
+            cluster = Cluster()
+            # Workers are not sharded, an agent can be in any of them
+            cluster.configure("a", [
+                NodeAddress("a", "127.0.0.1", 0, 0),
+                NodeAddress("b", "127.0.0.1", other_server.port, 0),
+            ], f"tcp://127.0.0.1:{hub_port(hub)}", sharded=False)
+            await cluster.start(lambda event: None, lambda: 0)
+            cluster.remote_agent_changed("b", "10.0.0.2:4000", dict(name="scanner", addr="10.0.0.2:4000"))
+            monkeypatch.setattr(server.app, "cluster", cluster)
+
+            this_node = web.Application()
+            this_node.add_routes([web.post('/run', server.app.run_agent)])
+            async with TestClient(TestServer(this_node)) as client:
+                body = json.dumps(dict(name="scanner", code_executor="ex", args="{}"))
+                response = await client.post('/run', data=body)
+                assert response.status == 200
+                assert await response.json() == dict(run_id="b.1")
+                assert received == [("a", json.loads(body))]
+
+                # The agent is not here, a request forwarded by another node
+                # is answered without forwarding it again
+                response = await client.post('/run', data=body, headers={FORWARDED_HEADER: "b"})
+                assert response.status == 400
+                assert len(received) == 1
+
+            await cluster.close()
+            await hub.close()
+
+    asyncio.run(forward_once())
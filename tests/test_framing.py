@@ -0,0 +1,88 @@
+import asyncio
+import zlib
+
+import pytest
+
+from common import framing
+from common.framing import FramingError, LengthPrefixedFramer, available_framings, get_framer, negotiate
+
+MESSAGES = [
+    dict(action="JOIN", name="agent"),
+    dict(action="OUTPUT", seq=1, messages=[dict(msg="x" * 10 * 1024, color="darkgreen")]),
+]
+
+COMPRESSIONS = ["zlib"] + (["zstd"] if framing.zstandard is not None else [])
+
+
+def read_all(framer, data: bytes) -> list:
+
+    async def read():
+        reader = asyncio.StreamReader()
+        reader.feed_data(data)
+        reader.feed_eof()
+        messages = []
+        message = await framer.read(reader)
+        while message is not None:
+            messages.append(message)
+            message = await framer.read(reader)
+        return messages
+
+    return asyncio.run(read())
+
+
+def compressed_frame(compression: str, payload: bytes) -> bytes:
+    compressor, _ = framing._compressions()[compression]
+    compressed = compressor(payload)
+    return LengthPrefixedFramer.HEADER.pack(len(compressed), LengthPrefixedFramer.FLAG_COMPRESSED) + compressed
+
+
+@pytest.mark.parametrize("name", available_framings())
+def test_round_trip(name):
+    framer = get_framer(name)
+    assert read_all(framer, b''.join(framer.encode(message) for message in MESSAGES)) == MESSAGES
+
+
+@pytest.mark.parametrize("compression", COMPRESSIONS)
+def test_big_frames_are_compressed(compression):
+    framer = get_framer(f"json-lp+{compression}")
+    small, big = (framer.encode(message) for message in MESSAGES)
+    assert small[LengthPrefixedFramer.HEADER.size - 1] == 0
+    assert big[LengthPrefixedFramer.HEADER.size - 1] == LengthPrefixedFramer.FLAG_COMPRESSED
+    assert len(big) < 1024
+
+
+@pytest.mark.parametrize("compression", COMPRESSIONS)
+def test_decompression_is_bounded(compression):
+    framer = get_framer(f"json-lp+{compression}", max_frame_size=64 * 1024)
+    # A few hundred bytes expanding past the max frame size
+    bomb = compressed_frame(compression, b'[' + b'0,' * 1024 * 1024 + b'0]')
+    assert len(bomb) < 64 * 1024
+    with pytest.raises(FramingError, match="exceeds the max frame size"):
+        read_all(framer, bomb)
+
+
+def test_invalid_compressed_frames():
+    framer = get_framer("json-lp+zlib")
+    with pytest.raises(FramingError, match="Invalid compressed frame"):
+        read_all(framer, LengthPrefixedFramer.HEADER.pack(4, LengthPrefixedFramer.FLAG_COMPRESSED) + b'nope')
+    truncated = zlib.compress(b'{"action": "JOIN"}')[:-4]
+    with pytest.raises(FramingError, match="Truncated"):
+        read_all(framer, LengthPrefixedFramer.HEADER.pack(len(truncated), LengthPrefixedFramer.FLAG_COMPRESSED)
+                 + truncated)
+
+
+def test_frame_limits():
+    framer = get_framer("json-lp", max_frame_size=16)
+    with pytest.raises(FramingError):
+        framer.encode(dict(msg="more than sixteen bytes"))
+    with pytest.raises(FramingError, match="exceeds the max frame size"):
+        read_all(framer, LengthPrefixedFramer.HEADER.pack(17, 0) + b'x' * 17)
+    with pytest.raises(FramingError, match="frame header"):
+        read_all(framer, b'\x00\x00')
+
+
+def test_negotiate():
+    assert negotiate(["unknown", "json-lp+zlib", "json-lp"]) == "json-lp+zlib"
+    assert negotiate(["unknown"]) == framing.LINES
+    with pytest.raises(FramingError):
+        get_framer("json-lp+unknown")
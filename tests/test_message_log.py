@@ -0,0 +1,130 @@
+import asyncio
+import json
+import os
+
+import pytest
+
+from server.message_log import RECORD_HEADER, MessageLog
+from server.message_store import MessageStore
+
+MESSAGES = 100
+
+
+def payload(message_id: int) -> bytes:
+    return json.dumps(dict(msg=f"message {message_id}", color="darkgreen")).encode()
+
+
+def write_log(path, count: int = MESSAGES) -> MessageLog:
+    log = MessageLog(path)
+    log.open()
+    for message_id in range(1, count + 1):
+        log.append(message_id, payload(message_id))
+    log.close()
+    return log
+
+
+def reopen(path) -> MessageLog:
+    log = MessageLog(path)
+    log.open()
+    return log
+
+
+def assert_readable(log: MessageLog):
+    records = log.read_after(0, MESSAGES * 2)
+    assert [message_id for message_id, _ in records] == list(range(1, log.last_id + 1))
+    for message_id, data in records:
+        assert data == payload(message_id)
+
+
+def test_replay(tmp_path):
+    write_log(tmp_path)
+    log = reopen(tmp_path)
+    assert log.last_id == MESSAGES
+    assert_readable(log)
+    log.append(MESSAGES + 1, payload(MESSAGES + 1))
+    assert log.last_id == MESSAGES + 1
+    assert_readable(log)
+    log.close()
+
+
+def test_replay_rebuilds_missing_index_entries(tmp_path):
+    write_log(tmp_path)
+    index_path, = tmp_path.glob('*.idx')
+    os.truncate(index_path, index_path.stat().st_size // 2)
+    log = reopen(tmp_path)
+    assert log.last_id == MESSAGES
+    assert_readable(log)
+    log.close()
+
+
+def test_torn_log(tmp_path):
+    write_log(tmp_path)
+    log_path, = tmp_path.glob('*.log')
+    size = log_path.stat().st_size
+    with open(log_path, 'ab') as log_file:
+        # A record whose payload was not completely written
+        log_file.write(RECORD_HEADER.pack(MESSAGES + 1, 100) + b'{"msg": ')
+    log = reopen(tmp_path)
+    assert log_path.stat().st_size == size
+    assert log.last_id == MESSAGES
+    assert_readable(log)
+    log.close()
+
+
+def test_index_past_end_of_log(tmp_path):
+    write_log(tmp_path)
+    log_path, = tmp_path.glob('*.log')
+    size = log_path.stat().st_size
+    os.truncate(log_path, size - 1400)
+    log = reopen(tmp_path)
+    assert log_path.stat().st_size <= size - 1400
+    assert 0 < log.last_id < MESSAGES
+    assert_readable(log)
+    log.close()
+
+    store = MessageStore()
+    log = reopen(tmp_path)
+    store.attach_log(log)
+    assert store.last_id == log.last_id
+    assert store.append(dict(msg="after recovery", color="darkgreen")) == log.last_id
+    log.close()
+
+
+def test_keeps_the_active_segment(tmp_path):
+    with pytest.raises(ValueError):
+        MessageLog(tmp_path, max_segments=0)
+    log = MessageLog(tmp_path, segment_max_bytes=1, max_segments=1)
+    log.open()
+    for message_id in range(1, 4):
+        log.append(message_id, payload(message_id))
+    assert len(log.segments) == 1
+    assert log.last_id == 3
+    log.close()
+
+
+def test_flusher_survives_fsync_errors(tmp_path, monkeypatch):
+    fsynced = []
+
+    def failing_fsync(fd):
+        fsynced.append(fd)
+        if len(fsynced) == 1:
+            raise OSError("disk error")
+
+    monkeypatch.setattr(os, "fsync", failing_fsync)
+
+    async def flush_twice():
+        log = MessageLog(tmp_path, fsync_batch=1)
+        log.open()
+        flusher = asyncio.ensure_future(log.run_flusher())
+        await asyncio.sleep(0)
+        for message_id in range(1, 3):
+            log.append(message_id, payload(message_id))
+            await asyncio.sleep(0.05)
+        assert not flusher.done()
+        flusher.cancel()
+        log.close()
+
+    asyncio.run(flush_twice())
+    # The first fsync failed, the log and the index of the second message
+    # were fsync'ed by the flusher still running
+    assert len(fsynced) == 3
@@ -0,0 +1,86 @@
+from server.message_log import MessageLog
+from server.message_store import MessageStore
+
+
+def message(number: int) -> dict:
+    return dict(msg=f"message {number}", color="darkgreen")
+
+
+def fill(store: MessageStore, count: int) -> list:
+    return store.extend([message(number) for number in range(1, count + 1)])
+
+
+def ids(page: list) -> list:
+    return [found['id'] for found in page]
+
+
+def test_paging():
+    store = MessageStore()
+    assert fill(store, 10) == list(range(1, 11))
+    assert ids(store.after(0, 4)) == [1, 2, 3, 4]
+    assert ids(store.after(4, 4)) == [5, 6, 7, 8]
+    assert ids(store.after(8, 4)) == [9, 10]
+    assert store.after(10, 4) == []
+    assert ids(store.tail(3)) == [8, 9, 10]
+    assert store.get(5) == dict(message(5), id=5)
+    assert store.get(11) is None
+
+
+def test_extra_keys_are_kept():
+    store = MessageStore()
+    message_id = store.append(dict(message(1), agent="scanner"))
+    assert store.get(message_id) == dict(message(1), agent="scanner", id=message_id)
+
+
+def test_evicts_by_count():
+    store = MessageStore(max_count=5)
+    fill(store, 12)
+    assert len(store) == 5
+    assert store.first_id == store.oldest_id == 8
+    # A cursor older than the evicted messages goes on from the oldest one
+    assert ids(store.after(2, 3)) == [8, 9, 10]
+    assert store.get(3) is None
+
+
+def test_evicts_by_bytes():
+    store = MessageStore(max_bytes=200)
+    fill(store, 20)
+    assert 0 < store.size_bytes <= 200
+    assert ids(list(store)) == list(range(21 - len(store), 21))
+    store.set_limits(max_count=2)
+    assert ids(list(store)) == [19, 20]
+
+
+def test_ids_are_not_reused_after_clear():
+    store = MessageStore()
+    fill(store, 3)
+    store.clear()
+    assert len(store) == 0 and store.after(0, 10) == []
+    assert store.append(message(4)) == 4
+
+
+def test_evicted_pages_are_read_from_the_log(tmp_path):
+    log = MessageLog(tmp_path)
+    log.open()
+    store = MessageStore(max_count=3)
+    store.attach_log(log)
+    fill(store, 10)
+    assert store.first_id == 8
+    assert store.oldest_id == 1
+    page = store.after(2, 4)
+    assert page == [dict(message(number), id=number) for number in range(3, 7)]
+    # The page goes on from the log to the memory
+    assert ids(store.after(5, 4)) == [6, 7, 8, 9]
+    assert store.get(2) == dict(message(2), id=2)
+    log.close()
+
+
+def test_ids_given_by_the_cluster():
+    store = MessageStore()
+    assert store.extend([message(1), message(2)], first_id=1) == [1, 2]
+    # Sent again after a reconnection, only the new one is stored
+    assert store.extend([message(2), message(3)], first_id=2) == [3]
+    # The messages 4 and 5 were missed
+    assert store.extend([message(6)], first_id=6) == [6]
+    assert ids(list(store)) == [6]
+    assert store.append(message(7)) == 7
@@ -0,0 +1,71 @@
+import pytest
+
+from common.metrics import Registry, merge_expositions
+
+
+def exposed(registry: Registry, constant_labels: dict = None) -> list:
+    return registry.expose(constant_labels).decode().splitlines()
+
+
+def test_counter_and_gauge():
+    registry = Registry()
+    received = registry.counter("messages_received", "Messages received", ["source"])
+    received.labels("http").inc()
+    received.labels("bulk").inc(3)
+    queue = registry.gauge("queue_depth", "Queued events")
+    queue.set_function(lambda: 7)
+    assert exposed(registry) == [
+        "# HELP messages_received_total Messages received",
+        "# TYPE messages_received_total counter",
+        'messages_received_total{source="http"} 1',
+        'messages_received_total{source="bulk"} 3',
+        "# HELP queue_depth Queued events",
+        "# TYPE queue_depth gauge",
+        "queue_depth 7",
+    ]
+
+
+def test_histogram():
+    registry = Registry()
+    latency = registry.histogram("latency_seconds", "Latency", buckets=(0.1, 1.0))
+    for value in (0.05, 0.5, 0.5, 5.0):
+        latency.observe(value)
+    assert exposed(registry)[2:] == [
+        'latency_seconds_bucket{le="0.1"} 1',
+        'latency_seconds_bucket{le="1.0"} 3',
+        'latency_seconds_bucket{le="+Inf"} 4',
+        "latency_seconds_sum 6.05",
+        "latency_seconds_count 4",
+    ]
+
+
+def test_labels():
+    registry = Registry()
+    errors = registry.counter("errors", "Errors", ["message"])
+    errors.labels('a "quoted"\nline').inc()
+    assert exposed(registry, {"worker": "worker-0"})[2] == (
+        'errors_total{message="a \\"quoted\\"\\nline",worker="worker-0"} 1'
+    )
+    with pytest.raises(ValueError):
+        errors.labels("one", "two")
+    with pytest.raises(ValueError):
+        registry.counter("errors", "Errors again")
+
+
+def test_merge_expositions():
+    workers = []
+    for worker, count in (("worker-0", 1), ("worker-1", 2)):
+        registry = Registry()
+        registry.counter("runs", "Runs").inc(count)
+        registry.gauge("agents", "Agents").set(count * 10)
+        workers.append(registry.expose({"worker": worker}))
+    assert merge_expositions(workers).decode().splitlines() == [
+        "# HELP runs_total Runs",
+        "# TYPE runs_total counter",
+        'runs_total{worker="worker-0"} 1',
+        'runs_total{worker="worker-1"} 2',
+        "# HELP agents Agents",
+        "# TYPE agents gauge",
+        'agents{worker="worker-0"} 10',
+        'agents{worker="worker-1"} 20',
+    ]
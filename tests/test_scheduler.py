@@ -0,0 +1,117 @@
+import asyncio
+
+from dispatcher.logic.scheduler import JobScheduler, JobState
+
+
+class Runs:
+    """Jobs that run until they are released, recording the most running at once"""
+
+    def __init__(self):
+        self.running = []
+        self.done = []
+        self.max_running = 0
+        self.max_running_by_executor = {}
+        self.__release = asyncio.Event()
+
+    async def run(self, data: dict):
+        self.running.append(data)
+        self.max_running = max(self.max_running, len(self.running))
+        executor_running = sum(1 for running in self.running if running["executor"] == data["executor"])
+        self.max_running_by_executor[data["executor"]] = max(
+            self.max_running_by_executor.get(data["executor"], 0), executor_running
+        )
+        try:
+            await self.__release.wait()
+            self.done.append(data)
+        finally:
+            self.running.remove(data)
+
+    def release(self):
+        self.__release.set()
+
+
+def submit(scheduler: JobScheduler, executor: str, count: int) -> list:
+    return [scheduler.submit(executor, dict(executor=executor, number=number)) for number in range(count)]
+
+
+def test_concurrency_limits():
+
+    async def run_limited():
+        runs = Runs()
+        scheduler = JobScheduler(runs.run, max_concurrent=3, max_pending=10, executor_limits={"slow": 1})
+        submit(scheduler, "slow", 3)
+        submit(scheduler, "fast", 4)
+        await asyncio.sleep(0.05)
+        # One slow job, the others wait for its slot and leave the global
+        # slots to the fast ones
+        assert [data["executor"] for data in runs.running] == ["slow", "fast", "fast"]
+        assert scheduler.pending_count() == 4
+        runs.release()
+        await scheduler.drain()
+        assert len(runs.done) == 7
+        assert runs.max_running == 3
+        assert runs.max_running_by_executor["slow"] == 1
+        assert scheduler.list_jobs() == []
+
+    asyncio.run(run_limited())
+
+
+def test_rejects_jobs_over_max_pending():
+
+    async def run_full():
+        runs = Runs()
+        scheduler = JobScheduler(runs.run, max_concurrent=1, max_pending=2, executor_limits={})
+        jobs = submit(scheduler, "ex", 4)
+        # Pending until the first one gets the slot
+        assert jobs[2] is None and jobs[3] is None
+        await asyncio.sleep(0.05)
+        assert scheduler.submit("ex", dict(executor="ex", number=4)) is not None
+        assert scheduler.is_full()
+        runs.release()
+        await scheduler.drain()
+        assert len(runs.done) == 3
+
+    asyncio.run(run_full())
+
+
+def test_cancel():
+
+    async def run_cancelled():
+        runs = Runs()
+        scheduler = JobScheduler(runs.run, max_concurrent=1, max_pending=10, executor_limits={})
+        running, pending = submit(scheduler, "ex", 2)
+        await asyncio.sleep(0.05)
+        assert running.state == JobState.RUNNING
+        assert pending.state == JobState.PENDING
+        assert scheduler.find("number", 1) is pending
+
+        assert scheduler.cancel(pending.id)
+        assert scheduler.cancel(running.id)
+        assert not scheduler.cancel(1000)
+        await asyncio.sleep(0.05)
+        assert running.task.cancelled() and pending.task.cancelled()
+        assert runs.running == [] and runs.done == []
+        assert scheduler.list_jobs() == []
+
+        # The slot of the cancelled job is free again
+        job, = submit(scheduler, "ex", 1)
+        await asyncio.sleep(0.05)
+        assert job.state == JobState.RUNNING
+        scheduler.cancel_all()
+        await scheduler.drain()
+
+    asyncio.run(run_cancelled())
+
+
+def test_drain_cancels_after_timeout():
+
+    async def run_drained():
+        runs = Runs()
+        scheduler = JobScheduler(runs.run, max_concurrent=2, max_pending=10, executor_limits={})
+        jobs = submit(scheduler, "ex", 3)
+        await scheduler.drain(timeout=0.05)
+        assert all(job.task.cancelled() for job in jobs)
+        assert runs.done == [] and runs.running == []
+        assert scheduler.list_jobs() == []
+
+    asyncio.run(run_drained())
@@ -0,0 +1,123 @@
+import asyncio
+import json
+
+import pytest
+from aiohttp import ClientSession, web
+from aiohttp.test_utils import TestServer
+
+from dispatcher.config import instance as config
+from dispatcher.logic.spool import REJECTED_FOLDER, Spool, SpoolManager
+
+
+def line(number: int, bad: bool = False) -> bytes:
+    return json.dumps(dict(msg=f"line {number}", color="darkgreen", bad=bad)).encode() + b'\n'
+
+
+class BulkEndpoint:
+    """Stores the lines of the bulk uploads, a batch with a bad line is
+    rejected, and the first `failures` uploads get a 503"""
+
+    def __init__(self, failures: int = 0):
+        self.failures = failures
+        self.stored = []
+
+    async def handle(self, request):
+        if self.failures:
+            self.failures -= 1
+            return web.Response(status=503)
+        messages = [json.loads(data) for data in (await request.read()).splitlines()]
+        if any(message["bad"] for message in messages):
+            return web.json_response(dict(error="Invalid message"), status=400)
+        self.stored.extend(message["msg"] for message in messages)
+        return web.Response(status=201)
+
+
+def with_server(endpoint: BulkEndpoint, test):
+    """Runs `test(manager)` with a SpoolManager uploading to `endpoint`"""
+
+    async def run(spool_path):
+        app = web.Application()
+        app.add_routes([web.post('/messages/bulk', endpoint.handle)])
+        async with TestServer(app) as server:
+            config['server'] = {'host': server.host, 'port': str(server.port)}
+            try:
+                async with ClientSession() as session:
+                    return await test(SpoolManager(session, spool_path))
+            finally:
+                config.remove_section('server')
+
+    return run
+
+
+def test_spool_checkpoint(tmp_path):
+    spool = Spool(tmp_path / "run.ndjson")
+    spool.open()
+    for number in range(3):
+        spool.append(dict(msg=f"line {number}"))
+    line_size = len(spool.read_pending(1))
+    first = spool.read_pending(line_size + 5)
+    # Only whole lines, even when the max cuts a line
+    assert first.count(b'\n') == 1
+    spool.checkpoint(len(first))
+    assert spool.read_pending(1).count(b'\n') == 1
+    spool.close()
+
+    reopened = Spool(tmp_path / "run.ndjson")
+    assert reopened.offset == len(first)
+    assert [json.loads(data)["msg"] for data in reopened.read_pending(1024).splitlines()] == ["line 1", "line 2"]
+    reopened.delete()
+    assert list(tmp_path.iterdir()) == []
+
+
+@pytest.mark.parametrize("bad_lines", [[], [3], [0, 7], list(range(8))])
+def test_rejected_lines_are_found(tmp_path, bad_lines):
+    endpoint = BulkEndpoint()
+    data = b''.join(line(number, number in bad_lines) for number in range(8))
+
+    async def upload(manager):
+        return await manager.upload(data, "run.ndjson")
+
+    assert asyncio.run(with_server(endpoint, upload)(tmp_path)) == len(data)
+    assert endpoint.stored == [f"line {number}" for number in range(8) if number not in bad_lines]
+    rejected_path = tmp_path / REJECTED_FOLDER / "run.ndjson"
+    if bad_lines:
+        assert rejected_path.read_bytes() == b''.join(line(number, True) for number in bad_lines)
+    else:
+        assert not rejected_path.exists()
+
+
+def test_transient_errors_leave_the_batch_to_retry(tmp_path):
+    endpoint = BulkEndpoint(failures=1)
+    data = line(0) + line(1)
+
+    async def upload(manager):
+        return await manager.upload(data, "run.ndjson")
+
+    assert asyncio.run(with_server(endpoint, upload)(tmp_path)) == 0
+    assert endpoint.stored == []
+    assert not (tmp_path / REJECTED_FOLDER).exists()
+
+
+def test_drain_and_resume(tmp_path):
+    # Left by a previous dispatcher, the first line was uploaded
+    left = Spool(tmp_path / "left.ndjson")
+    left.open()
+    for number in range(3):
+        left.append(dict(msg=f"left {number}", color="darkgreen", bad=False))
+    left.close()
+    left.checkpoint(len(left.read_pending(1)))
+
+    endpoint = BulkEndpoint(failures=1)
+
+    async def drain(manager):
+        manager.resume()
+        uploader = manager.open("run")
+        for number in range(3):
+            await uploader.add(dict(msg=f"line {number}", color="darkgreen", bad=number == 1))
+        await uploader.close()
+        await manager.close(timeout=10)
+
+    asyncio.run(with_server(endpoint, drain)(tmp_path))
+    assert sorted(endpoint.stored) == ["left 1", "left 2", "line 0", "line 2"]
+    assert sorted(path.name for path in tmp_path.iterdir()) == [REJECTED_FOLDER]
+    assert (tmp_path / REJECTED_FOLDER / "run.ndjson").read_bytes().count(b'\n') == 1